@@ -1,5 +1,7 @@
+from .archive import *
 from .compile import *
 from .database import *
+from .git_cache import *
 from .repo import *
 from . import parse
 from . import utils
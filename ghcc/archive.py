@@ -0,0 +1,423 @@
+import contextlib
+import fnmatch
+import io
+import json
+import os
+import posixpath
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Set
+
+from flutes.run import run_command
+
+__all__ = [
+    "ARCHIVE_TYPES",
+    "get_archive_path",
+    "find_archive",
+    "get_index_path",
+    "remove_archive",
+    "subtree_filter",
+    "create_archive",
+    "extract_archive",
+]
+
+ARCHIVE_TYPES = {
+    # compression type -> archive extension
+    "gzip": ".tar.gz",
+    "xz": ".tar.xz",
+    "zstd": ".tar.zst",
+}
+
+INDEX_EXTENSION = ".index"
+
+# Patterns (in lowercase) of files that are extracted by :meth:`subtree_filter` regardless of their location, as they
+# could be included by files in the selected subtrees.
+BUILD_INPUT_PATTERNS = [
+    "*makefile*",
+    "*.mk",
+    "*.mak",
+    "*.am",
+    "*.in",
+    "*.ac",
+    "configure",
+    "cmakelists.txt",
+    "*.cmake",
+    "*.h",
+    "*.hh",
+    "*.hpp",
+    "*.hxx",
+    "*.inc",
+    "*.def",
+]
+
+
+def get_archive_path(
+    archive_folder: str,
+    repo_owner: str,
+    repo_name: str,
+    compression_type: str = "gzip",
+) -> str:
+    r"""Return the absolute path of the archive for a repository, e.g. ``archive_folder/torvalds/linux.tar.gz``.
+
+    :param archive_folder: Path to the folder where archives are stored.
+    :param repo_owner: Owner of the repository.
+    :param repo_name: Name of the repository.
+    :param compression_type: The compression type, see :attr:`ARCHIVE_TYPES` for valid values.
+    """
+    if compression_type not in ARCHIVE_TYPES:
+        raise ValueError(f"Invalid compression type '{compression_type}'")
+    archive_extension = ARCHIVE_TYPES[compression_type]
+    return os.path.abspath(
+        os.path.join(archive_folder, f"{repo_owner}/{repo_name}{archive_extension}")
+    )
+
+
+def find_archive(
+    archive_folder: str,
+    repo_owner: str,
+    repo_name: str,
+    compression_type: Optional[str] = None,
+) -> Optional[str]:
+    r"""Find an existing archive for a repository, in any of the supported formats.
+
+    :param archive_folder: Path to the folder where archives are stored.
+    :param repo_owner: Owner of the repository.
+    :param repo_name: Name of the repository.
+    :param compression_type: If not ``None``, archives of this type are preferred over other types.
+    :return: The absolute path to the archive, or ``None`` if no archives exist.
+    """
+    compression_types = list(ARCHIVE_TYPES.keys())
+    if compression_type is not None:
+        compression_types.remove(compression_type)
+        compression_types.insert(0, compression_type)
+    for archive_type in compression_types:
+        path = get_archive_path(archive_folder, repo_owner, repo_name, archive_type)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def get_index_path(archive_path: str) -> str:
+    r"""Return the path of the index for an archive created with ``indexed=True``. The index might not exist."""
+    return archive_path + INDEX_EXTENSION
+
+
+def remove_archive(archive_path: str) -> None:
+    r"""Remove an archive along with its index, if they exist."""
+    for path in [archive_path, get_index_path(archive_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def subtree_filter(
+    folder_name: str,
+    directories: Iterable[str],
+    patterns: Optional[List[str]] = None,
+) -> Optional[Callable[[str], bool]]:
+    r"""Create a filter for :meth:`extract_archive` that selects the subtrees under the specified directories, files
+    matching the patterns, and Git metadata.
+
+    :param folder_name: Name of the archived folder, i.e., the top-level folder in the archive.
+    :param directories: Paths of directories to extract, relative to the archived folder.
+    :param patterns: Shell-style patterns (in lowercase) of file names that are extracted anywhere in the archive.
+        Defaults to :attr:`BUILD_INPUT_PATTERNS`.
+    :return: The filter, or ``None`` if the entire archive should be extracted, i.e., the archived folder itself is
+        one of the directories.
+    """
+    if patterns is None:
+        patterns = BUILD_INPUT_PATTERNS
+    prefixes = {
+        posixpath.normpath(posixpath.join(folder_name, directory))
+        for directory in directories
+    }
+    if folder_name in prefixes:
+        return None
+
+    def select(name: str) -> bool:
+        name = posixpath.normpath(name)
+        parts = name.split("/")
+        if any("/".join(parts[:idx]) in prefixes for idx in range(1, len(parts) + 1)):
+            return True
+        if ".git" in parts or parts[-1] == ".gitmodules":
+            return True
+        base_name = parts[-1].lower()
+        return any(fnmatch.fnmatchcase(base_name, pattern) for pattern in patterns)
+
+    return select
+
+
+def _get_compression_type(archive_path: str) -> str:
+    for compression_type, extension in ARCHIVE_TYPES.items():
+        if archive_path.endswith(extension):
+            return compression_type
+    raise ValueError(f"Unsupported archive format for '{archive_path}'")
+
+
+def _compress_program(
+    compression_type: str, level: Optional[int] = None, threads: int = 1
+) -> List[str]:
+    # Arguments for the compression program used by `tar --use-compress-program`.
+    if compression_type == "gzip":
+        # gzip is single-threaded, `threads` is ignored.
+        return ["gzip"] + ([f"-{level}"] if level is not None else [])
+    program = [compression_type, f"-T{threads}"]
+    if level is not None:
+        if compression_type == "zstd" and level > 19:
+            program.append("--ultra")
+        program.append(f"-{level}")
+    return program
+
+
+def _filter_data(
+    program: List[str], data: bytes, deadline: Optional[float] = None
+) -> bytes:
+    # Run `data` through the compression program, e.g. `program + ["-dc"]` for decompression.
+    timeout = None if deadline is None else max(deadline - time.time(), 0.0)
+    process = subprocess.run(
+        program,
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout,
+    )
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, program, output=process.stderr
+        )
+    return process.stdout
+
+
+def _create_indexed_archive(
+    archive_path: str,
+    directory: str,
+    program: List[str],
+    compression_type: str,
+    chunk_size: int,
+    deadline: Optional[float] = None,
+) -> None:
+    # The tarball is split into chunks of whole members, and each chunk is compressed separately. Concatenated
+    # compressed streams are valid for all supported compression types, so the archive can still be extracted as a
+    # whole, while each chunk can also be decompressed on its own.
+    #
+    # Chunks are written to temporary files, and all of them are compressed by a single compressor process, which
+    # compresses each input file into a separate stream. This avoids starting a process per chunk, at the cost of
+    # temporarily storing the uncompressed tarball on disk, next to the archive.
+    parent_dir, folder_name = os.path.split(os.path.abspath(directory))
+    extension = ARCHIVE_TYPES[compression_type][len(".tar") :]
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(archive_path))
+    ) as chunk_dir:
+        chunk_members: List[List[str]] = []
+        buffer = io.BytesIO()
+        members: List[str] = []
+
+        def flush_chunk() -> None:
+            with open(os.path.join(chunk_dir, str(len(chunk_members))), "wb") as f:
+                f.write(buffer.getvalue())
+            chunk_members.append(members[:])
+            buffer.seek(0)
+            buffer.truncate()
+            members.clear()
+
+        tar = tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT)
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            rel_root = os.path.relpath(root, parent_dir)
+            names = [rel_root] if root == directory else []
+            # Symlinks to directories are listed in `dirs`, but not walked into.
+            names.extend(
+                os.path.join(rel_root, name)
+                for name in sorted(files)
+                + [name for name in dirs if os.path.islink(os.path.join(root, name))]
+            )
+            names.extend(
+                os.path.join(rel_root, name)
+                for name in dirs
+                if not os.path.islink(os.path.join(root, name))
+            )
+            for name in names:
+                tar.add(os.path.join(parent_dir, name), arcname=name, recursive=False)
+                members.append(name)
+                if buffer.tell() >= chunk_size:
+                    flush_chunk()
+        tar.close()  # writes the end-of-archive marker into the last chunk
+        flush_chunk()
+
+        # Compressed files replace the uncompressed chunks (`zstd` keeps its input files unless `--rm` is specified).
+        chunk_names = [str(idx) for idx in range(len(chunk_members))]
+        timeout = None if deadline is None else max(deadline - time.time(), 0.0)
+        run_command(
+            program + (["--rm"] if compression_type == "zstd" else []) + chunk_names,
+            timeout=timeout,
+            cwd=chunk_dir,
+        )
+        chunks = []
+        with open(archive_path, "wb") as f:
+            for name, chunk_member_names in zip(chunk_names, chunk_members):
+                offset = f.tell()
+                with open(os.path.join(chunk_dir, name + extension), "rb") as chunk:
+                    shutil.copyfileobj(chunk, f)
+                chunks.append(
+                    {
+                        "offset": offset,
+                        "size": f.tell() - offset,
+                        "members": chunk_member_names,
+                    }
+                )
+
+    with open(get_index_path(archive_path), "w") as f:
+        json.dump({"chunks": chunks}, f)
+
+
+def create_archive(
+    archive_path: str,
+    directory: str,
+    compression_type: Optional[str] = None,
+    level: Optional[int] = None,
+    threads: int = 1,
+    timeout: Optional[float] = None,
+    indexed: bool = False,
+    chunk_size: int = 4 * 1024 * 1024,
+) -> None:
+    r"""Create a compressed tarball of a directory.
+
+    :param archive_path: Path to the archive to create.
+    :param directory: The directory to archive. Paths in the archive are relative to the parent of the directory.
+    :param compression_type: The compression type, see :attr:`ARCHIVE_TYPES` for valid values. If ``None``, the type is
+        inferred from the extension of :attr:`archive_path`.
+    :param level: The compression level, or ``None`` for the default level of the compressor. Valid values are 1~9
+        for gzip and xz, and 1~22 for zstd.
+    :param threads: Number of threads used for compression, or 0 to use all available cores. Ignored for gzip.
+    :param timeout: Timeout for archiving, or ``None`` (default) for unlimited time.
+    :param indexed: If ``True``, the archive is compressed in independent chunks, and an index of the members in each
+        chunk is stored alongside the archive (see :meth:`get_index_path`). This allows :meth:`extract_archive` to
+        extract selected members by only decompressing chunks containing them. Indexed archives are slightly larger,
+        and remain readable by ``tar``. All chunks are compressed by a single compressor process, but the uncompressed
+        tarball is temporarily stored in the folder of the archive.
+    :param chunk_size: Size (in bytes) of uncompressed data in each chunk of indexed archives.
+    """
+    if compression_type is None:
+        compression_type = _get_compression_type(archive_path)
+    program = _compress_program(compression_type, level, threads)
+    index_path = get_index_path(archive_path)
+    if os.path.exists(index_path):
+        # Remove the index first, so that a stale index is never used with a new archive.
+        os.remove(index_path)
+    if indexed:
+        deadline = None if timeout is None else time.time() + timeout
+        _create_indexed_archive(
+            archive_path, directory, program, compression_type, chunk_size, deadline
+        )
+        return
+    parent_dir, folder_name = os.path.split(os.path.abspath(directory))
+    run_command(
+        [
+            "tar",
+            "-I",
+            " ".join(program),
+            "-cf",
+            os.path.abspath(archive_path),
+            folder_name,
+        ],
+        timeout=timeout,
+        cwd=parent_dir,
+    )
+
+
+def _extract_members(
+    tar: tarfile.TarFile,
+    directory: str,
+    select: Callable[[str], bool],
+    extracted: Set[str],
+    deadline: Optional[float] = None,
+) -> None:
+    # Extract selected members in a single pass over the tarball, which could be a stream.
+    kwargs = (
+        {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+    )
+    for member in tar:
+        if deadline is not None and time.time() > deadline:
+            raise subprocess.TimeoutExpired(["extract", directory], 0.0)
+        if not select(member.name):
+            continue
+        if member.islnk() and member.linkname not in extracted:
+            continue  # the target of the hard link is not extracted
+        tar.extract(member, directory, **kwargs)
+        extracted.add(member.name)
+
+
+@contextlib.contextmanager
+def _decompress_stream(archive_path: str, compression_type: str) -> Iterator[IO[bytes]]:
+    command = _compress_program(compression_type) + [
+        "-dc",
+        os.path.abspath(archive_path),
+    ]
+    with subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ) as process:
+        assert process.stdout is not None and process.stderr is not None
+        try:
+            yield process.stdout
+        except tarfile.TarError:
+            # The tarball is truncated if decompression failed, in which case the decompressor error is reported.
+            process.stdout.read()
+            if process.wait() == 0:
+                raise
+        except BaseException:
+            process.kill()
+            raise
+        process.stdout.read()  # drain the padding after the end-of-archive marker
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode, command, output=process.stderr.read()
+            )
+
+
+def extract_archive(
+    archive_path: str,
+    directory: str,
+    timeout: Optional[float] = None,
+    select: Optional[Callable[[str], bool]] = None,
+) -> None:
+    r"""Extract a compressed tarball created by :meth:`create_archive`. The compression type is inferred from the
+    extension of the archive.
+
+    :param archive_path: Path to the archive.
+    :param directory: The directory to extract into.
+    :param timeout: Timeout for extraction, or ``None`` (default) for unlimited time.
+    :param select: If not ``None``, only members whose names satisfy the filter are extracted, see
+        :meth:`subtree_filter`. For indexed archives, only chunks containing selected members are decompressed;
+        otherwise, the archive is decompressed as a stream and other members are skipped without being written.
+    """
+    compression_type = _get_compression_type(archive_path)
+    if select is None:
+        run_command(
+            ["tar", "-I", compression_type, "-xf", os.path.abspath(archive_path)],
+            timeout=timeout,
+            cwd=directory,
+        )
+        return
+
+    deadline = None if timeout is None else time.time() + timeout
+    index_path = get_index_path(archive_path)
+    if not os.path.exists(index_path):
+        with _decompress_stream(archive_path, compression_type) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                _extract_members(tar, directory, select, set(), deadline)
+        return
+
+    with open(index_path) as f:
+        chunks = json.load(f)["chunks"]
+    program = _compress_program(compression_type)
+    extracted: Set[str] = set()
+    with open(archive_path, "rb") as f:
+        for chunk in chunks:
+            if not any(select(name) for name in chunk["members"]):
+                continue
+            f.seek(chunk["offset"])
+            data = _filter_data(program + ["-dc"], f.read(chunk["size"]), deadline)
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+                _extract_members(tar, directory, select, extracted, deadline)
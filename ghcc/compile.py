@@ -1,30 +1,43 @@
+import contextlib
 import hashlib
 import os
 import pickle
+import queue
 import shutil
+import struct
 import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
-from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Union
 
 from flutes.run import run_command
 
 from .database import RepoDB
-from .repo import clean
+from .repo import WorkspaceSnapshot, clean
 from .utils.docker import run_docker_command
+from .utils.job_pool import JobTokenPool
 
 MOCK_PATH = os.path.abspath(
     os.path.join(os.path.split(__file__)[0], "..", "..", "scripts", "mock_path")
 )
 
-ELF_FILE_TAG = b"ELF"  # Linux
+ELF_MAGIC = b"\x7fELF"
+# Environment variable for the path of the manifest, to which the mock compilers append the path of each output.
+OUTPUT_MANIFEST_ENV = "MOCK_GCC_OUTPUT_MANIFEST"
 
 __all__ = [
     "contains_files",
     "find_cmakefile",
     "find_makefiles",
+    "BuildIndex",
+    "index_build_files",
     "CompileErrorType",
     "CompileResult",
+    "ELFInfo",
+    "read_elf_header",
     "unsafe_make",
     "docker_make",
     "compile_and_move",
@@ -61,17 +74,99 @@ def find_makefiles(path: str) -> List[str]:
     :param path: Path to the directory to scan.
     :return: A list of absolute paths to subdirectories that contain Makefiles.
     """
-    directories = []
-    for subdir, _, _ in os.walk(path):
-        if contains_files(subdir, ["makefile"]):
-            directories.append(subdir)
-    return directories
+    return index_build_files(path).makefile_dirs
+
+
+class BuildIndex(NamedTuple):
+    r"""Locations of build files under a directory, collected by :meth:`index_build_files`. Directories are listed in
+    the order of a top-down traversal, the same as :meth:`os.walk`.
+    """
+
+    makefile_dirs: List[str]  # directories containing a Makefile (case-insensitive)
+    cmake_dirs: List[str]  # directories containing a CMakeLists.txt
+    configure_dirs: List[str]  # directories containing a `configure` script
+    autoconf_dirs: List[str]  # directories containing configure.ac or configure.in
+    autogen_dirs: List[str]  # directories containing an autogen.sh script
+    total_size: int  # apparent size in bytes, as in `du -bs` (hard links counted twice)
+    num_files: int  # number of files (including symlinks) in the directory tree
+
+
+def index_build_files(path: str) -> BuildIndex:
+    r"""Find build files and compute the size of a directory tree in a single pass, listing each directory once with
+    :meth:`os.scandir`. Prefer this over separate calls to :meth:`find_cmakefile`, :meth:`contains_files`, and
+    :meth:`flutes.get_folder_size`, each of which walks or lists directories again.
+
+    Symlinks to directories are not followed. Unreadable directories are skipped.
+
+    :param path: Path to the directory to scan.
+    :return: The build index. Directory paths are joined onto :attr:`path`.
+    """
+    makefile_dirs: List[str] = []
+    cmake_dirs: List[str] = []
+    configure_dirs: List[str] = []
+    autoconf_dirs: List[str] = []
+    autogen_dirs: List[str] = []
+    total_size = os.lstat(path).st_size
+    num_files = 0
+    stack = [path]
+    while len(stack) > 0:
+        directory = stack.pop()
+        subdirs: List[str] = []
+        has_makefile = has_cmake = has_configure = has_autoconf = has_autogen = False
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        total_size += entry.stat(follow_symlinks=False).st_size
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                            continue
+                        num_files += 1
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    name = entry.name
+                    lower_name = name.lower()
+                    if lower_name == "makefile":
+                        has_makefile = True
+                    elif lower_name in ["configure.ac", "configure.in"]:
+                        has_autoconf = True
+                    elif name == "CMakeLists.txt":
+                        has_cmake = True
+                    elif name == "configure":
+                        has_configure = True
+                    elif name == "autogen.sh":
+                        has_autogen = True
+        except OSError:
+            continue
+        for flag, directories in [
+            (has_makefile, makefile_dirs),
+            (has_cmake, cmake_dirs),
+            (has_configure, configure_dirs),
+            (has_autoconf, autoconf_dirs),
+            (has_autogen, autogen_dirs),
+        ]:
+            if flag:
+                directories.append(directory)
+        # Visit subdirectories in listing order, as `os.walk` does.
+        stack.extend(reversed(subdirs))
+    return BuildIndex(
+        makefile_dirs,
+        cmake_dirs,
+        configure_dirs,
+        autoconf_dirs,
+        autogen_dirs,
+        total_size,
+        num_files,
+    )
 
 
 class CompileErrorType(Enum):
     Timeout = auto()
     CompileFailed = auto()
     Unknown = auto()
+    RestoreFailed = auto()  # the workspace snapshot could not be restored
 
 
 class CompileResult(NamedTuple):
@@ -79,6 +174,8 @@ class CompileResult(NamedTuple):
     elf_files: List[str]  # list of paths to ELF files
     error_type: Optional[CompileErrorType] = None
     captured_output: Optional[str] = None
+    # metadata of each ELF file, if read while collecting the files; `None` entries are not read yet
+    elf_info: Optional[List[Optional["ELFInfo"]]] = None
 
 
 def _create_result(
@@ -86,28 +183,140 @@ def _create_result(
     elf_files: Optional[List[str]] = None,
     error_type: Optional[CompileErrorType] = None,
     captured_output: Optional[str] = None,
+    elf_info: Optional[List[Optional["ELFInfo"]]] = None,
 ) -> CompileResult:
     if elf_files is None:
         elf_files = []
+    if elf_info is None:
+        elf_info = []
     return CompileResult(
         success,
         elf_files=elf_files,
         error_type=error_type,
         captured_output=captured_output,
+        elf_info=elf_info,
     )
 
 
-def _check_elf_fn(directory: str, file: str) -> bool:
+class ELFInfo(NamedTuple):
+    r"""Metadata of an ELF file, read by :meth:`read_elf_header`. Shared objects that request a program interpreter
+    are position-independent executables, and have the type ``"pie-executable"``.
+    """
+    elf_class: int  # 32 or 64 (bits)
+    elf_type: str  # "relocatable", "executable", "shared-object", etc.
+    machine: str  # target architecture, e.g. "x86-64"
+
+
+_ELF_TYPES = {1: "relocatable", 2: "executable", 3: "shared-object", 4: "core"}
+_ELF_MACHINES = {
+    2: "sparc",
+    3: "x86",
+    8: "mips",
+    20: "powerpc",
+    21: "powerpc64",
+    22: "s390",
+    40: "arm",
+    43: "sparcv9",
+    62: "x86-64",
+    183: "aarch64",
+    243: "riscv",
+}
+_PT_INTERP = 3
+
+
+def read_elf_header(path: str) -> Optional[ELFInfo]:
+    r"""Read the class, type, and machine of an ELF file from its header. This replaces calling the ``file`` utility,
+    which requires spawning a process for each file.
+
+    :param path: Path to the file.
+    :return: Metadata of the ELF file, or ``None`` if the file is not an ELF file or could not be read.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(64)
+            if (
+                len(header) < 52
+                or header[:4] != ELF_MAGIC
+                or header[4] not in [1, 2]
+                or header[5] not in [1, 2]
+            ):
+                return None
+            elf_class = 64 if header[4] == 2 else 32
+            endian = "<" if header[5] == 1 else ">"
+            e_type, e_machine = struct.unpack_from(endian + "HH", header, 16)
+            elf_type = _ELF_TYPES.get(e_type, "unknown")
+            machine = _ELF_MACHINES.get(e_machine, f"unknown-{e_machine}")
+            if elf_type == "shared-object":
+                # Position-independent executables are shared objects that request a program interpreter.
+                if elf_class == 64:
+                    (ph_offset,) = struct.unpack_from(endian + "Q", header, 32)
+                    ph_size, ph_count = struct.unpack_from(endian + "HH", header, 54)
+                else:
+                    (ph_offset,) = struct.unpack_from(endian + "I", header, 28)
+                    ph_size, ph_count = struct.unpack_from(endian + "HH", header, 42)
+                f.seek(ph_offset)
+                program_headers = f.read(ph_size * ph_count)
+                for offset in range(0, len(program_headers) - 3, max(ph_size, 4)):
+                    (p_type,) = struct.unpack_from(
+                        endian + "I", program_headers, offset
+                    )
+                    if p_type == _PT_INTERP:
+                        elf_type = "pie-executable"
+                        break
+    except (OSError, struct.error):
+        return None
+    return ELFInfo(elf_class, elf_type, machine)
+
+
+def _check_elf_fn(directory: str, file: str) -> Optional[ELFInfo]:
     r"""Checks whether the specified file is a binary file.
 
     :param directory: The directory containing the Makefile.
     :param file: The path to the file to check, relative to the directory.
-    :return: If ``True``, the file is a binary (ELF) file.
+    :return: Metadata of the file if it is a binary (ELF) file, so that the header is not read again, or ``None``
+        otherwise.
     """
     path = os.path.join(directory, file)
-    output = subprocess.check_output(["file", path], timeout=10)
-    output = output[len(path) :]  # first part is file name
-    return ELF_FILE_TAG in output
+    if os.path.islink(path):
+        return None
+    return read_elf_header(path)
+
+
+def _read_output_manifest(directory: str, manifest_path: str) -> List[str]:
+    r"""Read the paths of outputs recorded by the mock compilers, relative to the directory. Outputs outside the
+    directory, and outputs that no longer exist (e.g., temporary files created by ``configure``) are skipped.
+    """
+    try:
+        with open(manifest_path) as f:
+            paths = f.read().split("\n")
+    except OSError:
+        return []
+    files = []
+    for path in dict.fromkeys(paths):  # deduplicate while keeping the order
+        if not path:
+            continue
+        file = os.path.relpath(path, directory)
+        if file.startswith(os.pardir + os.sep) or not os.path.isfile(path):
+            continue
+        files.append(file)
+    return files
+
+
+def _list_untracked_files(directory: str, timeout: Optional[float] = None) -> List[str]:
+    r"""Use Git to find all unversioned files under the directory, relative to the directory."""
+    output = run_command(
+        ["git", "ls-files", "--others"],
+        cwd=directory,
+        timeout=timeout,
+        return_output=True,
+    ).captured_output
+    assert output is not None
+    return [
+        # files containing escape characters are in quotes
+        file if file[0] != '"' else file[1:-1]
+        for file in output.decode("unicode_escape").split("\n")
+        if file
+    ]  # file names could contain spaces
 
 
 def _make_skeleton(
@@ -117,7 +326,10 @@ def _make_skeleton(
     verbose: bool = True,
     *,
     make_fn,
-    check_file_fn: Callable[[str, str], bool] = _check_elf_fn,
+    check_file_fn: Callable[[str, str], Union[bool, Optional[ELFInfo]]] = _check_elf_fn,
+    use_output_manifest: bool = False,
+    workspace: Optional[WorkspaceSnapshot] = None,
+    jobs: int = 1,
 ) -> CompileResult:
     r"""A composable routine for different compilation methods. Different routines can be composed by specifying
     different ``make_fn``\ s and ``check_file_fn``\ s.
@@ -127,20 +339,45 @@ def _make_skeleton(
     :param env: A dictionary of environment variables.
     :param verbose: If ``True``, print out executed commands and outputs.
     :param make_fn: The function to call for compilation. The function takes as input variables ``directory``,
-        ``timeout``, and ``env``.
+        ``timeout``, ``env``, ``verbose``, and ``jobs``.
     :param check_file_fn: A function to determine whether a generated file should be collected, i.e., whether it is a
         binary file. The function takes as input variables ``directory`` and ``file``, where ``file`` is the path of the
-        file to check, relative to ``directory``. Defaults to :meth:`_check_elf_fn`, which checks whether the file is an
-        ELF file.
+        file to check, relative to ``directory``. The file is collected if the return value is truthy, and if the value
+        is an :class:`ELFInfo`, it is stored in :attr:`CompileResult.elf_info`. Defaults to :meth:`_check_elf_fn`,
+        which checks whether the file is an ELF file.
+    :param use_output_manifest: If ``True``, the mock compilers and linkers record their outputs in a manifest, and
+        only files in the manifest are checked, instead of all unversioned files. This also collects versioned files
+        overwritten by the mock compilers. All unversioned files are checked if the manifest is missing or empty. This
+        requires ``make_fn`` to run the mock compilers with the same paths as the host, i.e., not in a Docker container
+        with different mappings.
+    :param workspace: If not ``None``, the snapshot of the repository is restored before compilation, instead of
+        cleaning the repository with Git. Git is still used if the snapshot cannot be restored, unless the workspace
+        is a view of a subtree (see :meth:`WorkspaceSnapshot.subtree`), as other parts of the repository could be
+        built concurrently. In this case, compilation fails with the error type ``RestoreFailed``.
+    :param jobs: Number of parallel jobs for ``make``.
     """
     directory = os.path.abspath(directory)
-
-    try:
-        # Clean unversioned files by previous compilations.
+    # Clean unversioned files by previous compilations.
+    if workspace is None:
+        clean(directory)
+    elif not workspace.restore():
+        if workspace.is_subtree:
+            # Cleaning with Git resets the whole repository, which would interfere with concurrent builds.
+            return _create_result(
+                error_type=CompileErrorType.RestoreFailed,
+                captured_output=f"Failed to restore workspace under {directory}",
+            )
         clean(directory)
 
+    manifest_path = None
+    if use_output_manifest:
+        fd, manifest_path = tempfile.mkstemp(prefix="ghcc-outputs-", suffix=".txt")
+        os.close(fd)
+        env = {**(env or {}), OUTPUT_MANIFEST_ENV: manifest_path}
+
+    try:
         # Call the actual function for `make`.
-        make_fn(directory, timeout=timeout, env=env, verbose=verbose)
+        make_fn(directory, timeout=timeout, env=env, verbose=verbose, jobs=jobs)
         result = _create_result(True)
 
     except subprocess.TimeoutExpired as e:
@@ -158,40 +395,41 @@ def _make_skeleton(
         )
 
     try:
-        # Use Git to find all unversioned files -- these would be the products of compilation.
-        output = run_command(
-            ["git", "ls-files", "--others"],
-            cwd=directory,
-            timeout=timeout,
-            return_output=True,
-        ).captured_output
-        assert output is not None
-        diff_files = [
-            # files containing escape characters are in quotes
-            file if file[0] != '"' else file[1:-1]
-            for file in output.decode("unicode_escape").split("\n")
-            if file
-        ]  # file names could contain spaces
+        diff_files = []
+        if manifest_path is not None:
+            diff_files = _read_output_manifest(directory, manifest_path)
+            os.remove(manifest_path)
+        if len(diff_files) == 0:
+            # Use Git to find all unversioned files -- these would be the products of compilation. This is also the
+            # fallback when the manifest is missing or empty, e.g., if the build does not go through the mock compilers.
+            diff_files = _list_untracked_files(directory, timeout)
 
         # Inspect each file and find ELF files.
         for file in diff_files:
-            if check_file_fn(directory, file):
+            checked = check_file_fn(directory, file)
+            if checked:
                 result.elf_files.append(file)
+                result.elf_info.append(
+                    checked if isinstance(checked, ELFInfo) else None
+                )
     except subprocess.TimeoutExpired as e:
         return _create_result(
             elf_files=result.elf_files,
+            elf_info=result.elf_info,
             error_type=CompileErrorType.Timeout,
             captured_output=e.output,
         )
     except subprocess.CalledProcessError as e:
         return _create_result(
             elf_files=result.elf_files,
+            elf_info=result.elf_info,
             error_type=CompileErrorType.Unknown,
             captured_output=e.output,
         )
     except OSError as e:
         return _create_result(
             elf_files=result.elf_files,
+            elf_info=result.elf_info,
             error_type=CompileErrorType.Unknown,
             captured_output=str(e),
         )
@@ -204,6 +442,7 @@ def _unsafe_make(
     timeout: Optional[float] = None,
     env: Optional[Dict[str, str]] = None,
     verbose: bool = False,
+    jobs: int = 1,
 ) -> None:
     env = {"PATH": f"{MOCK_PATH}:{os.environ['PATH']}", **(env or {})}
     # Try GNU Automake first. Note that errors are ignored because it's possible that the original files still work.
@@ -267,7 +506,7 @@ def _unsafe_make(
     # `-B/--always-make` could give strange errors for certain Makefiles, e.g. ones containing "%:"
     try:
         run_command(
-            ["make", "--keep-going", "-j1"],
+            ["make", "--keep-going", f"-j{jobs}"],
             env=env,
             cwd=directory,
             timeout=timeout,
@@ -281,7 +520,7 @@ def _unsafe_make(
             # Try again using BSD Make instead of GNU Make. Note BSD Make does not have a flag equivalent to
             # `-B/--always-make`.
             run_command(
-                ["bmake", "-k", "-j1"],
+                ["bmake", "-k", f"-j{jobs}"],
                 env=env,
                 cwd=directory,
                 timeout=timeout,
@@ -294,6 +533,8 @@ def unsafe_make(
     timeout: Optional[float] = None,
     env: Optional[Dict[str, str]] = None,
     verbose: bool = False,
+    workspace: Optional[WorkspaceSnapshot] = None,
+    jobs: int = 1,
 ) -> CompileResult:
     r"""Run ``make`` in the given directory and collect compilation outputs.
 
@@ -305,12 +546,23 @@ def unsafe_make(
     :param timeout: Maximum time allowed for compilation, in seconds. Defaults to ``None`` (unlimited time).
     :param env: The environment variables to use when calling ``make``.
     :param verbose: If ``True``, print out executed commands and outputs.
+    :param workspace: If not ``None``, the snapshot of the repository to restore before compilation.
+    :param jobs: Number of parallel jobs for ``make``.
     :return: An instance of :class:`CompileResult` indicating the result. Fields ``success`` and ``elf_files`` are not
         ``None``.
 
         - If compilation failed, the fields ``error_type`` and ``captured_output`` are also not ``None``.
     """
-    return _make_skeleton(directory, timeout, env, verbose, make_fn=_unsafe_make)
+    return _make_skeleton(
+        directory,
+        timeout,
+        env,
+        verbose,
+        make_fn=_unsafe_make,
+        use_output_manifest=True,
+        workspace=workspace,
+        jobs=jobs,
+    )
 
 
 def _docker_make(
@@ -318,11 +570,12 @@ def _docker_make(
     timeout: Optional[float] = None,
     env: Optional[Dict[str, str]] = None,
     verbose: bool = False,
+    jobs: int = 1,
 ) -> None:
     if os.path.isfile(os.path.join(directory, "configure")):
         # Try running `./configure` if it exists.
         run_docker_command(
-            "chmod +x configure && ./configure && make --keep-going -j1",
+            f"chmod +x configure && ./configure && make --keep-going -j{jobs}",
             user=0,
             cwd="/usr/src",
             directory_mapping={directory: "/usr/src"},
@@ -335,7 +588,7 @@ def _docker_make(
         # Make while ignoring errors.
         # `-B/--always-make` could give strange errors for certain Makefiles, e.g. ones containing "%:"
         run_docker_command(
-            ["make", "--keep-going", "-j1"],
+            ["make", "--keep-going", f"-j{jobs}"],
             user=0,
             cwd="/usr/src",
             directory_mapping={directory: "/usr/src"},
@@ -350,6 +603,8 @@ def docker_make(
     timeout: Optional[float] = None,
     env: Optional[Dict[str, str]] = None,
     verbose: bool = False,
+    workspace: Optional[WorkspaceSnapshot] = None,
+    jobs: int = 1,
 ) -> CompileResult:
     r"""Run ``make`` within Docker and collect compilation outputs.
 
@@ -364,12 +619,22 @@ def docker_make(
     :param timeout: Maximum time allowed for compilation, in seconds. Defaults to ``None`` (unlimited time).
     :param env: The environment variables to use when calling ``make``.
     :param verbose: If ``True``, print out executed commands and outputs.
+    :param workspace: If not ``None``, the snapshot of the repository to restore before compilation.
+    :param jobs: Number of parallel jobs for ``make``.
     :return: An instance of :class:`CompileResult` indicating the result. Fields ``success`` and ``elf_files`` are not
         ``None``.
 
         - If compilation failed, the fields ``error_type`` and ``captured_output`` are also not ``None``.
     """
-    return _make_skeleton(directory, timeout, env, verbose, make_fn=_docker_make)
+    return _make_skeleton(
+        directory,
+        timeout,
+        env,
+        verbose,
+        make_fn=_docker_make,
+        workspace=workspace,
+        jobs=jobs,
+    )
 
 
 def _hash_file_sha256(directory: str, path: str) -> str:
@@ -394,6 +659,9 @@ def compile_and_move(
     gcc_override_flags: Optional[str] = None,
     compile_fn=docker_make,
     hash_fn: Callable[[str, str], str] = _hash_file_sha256,
+    use_snapshot: bool = False,
+    job_pool: Optional[JobTokenPool] = None,
+    num_workers: int = 1,
 ) -> Iterator[RepoDB.MakefileEntry]:
     r"""Compile all Makefiles as provided, and move generated binaries to the binary directory.
 
@@ -411,6 +679,15 @@ def compile_and_move(
         to :attr:`repo_binary_dir` and renamed to the generated hash signature. The function takes as input variables
         ``directory`` and ``file``, where ``directory`` is the path of the directory containing the Makefile, and
         ``file`` is the path of the binary, relative to ``directory``.
+    :param use_snapshot: If ``True``, take a :class:`WorkspaceSnapshot` of the repository before compilation, and
+        restore it between Makefiles instead of cleaning the repository with Git. The repository is still cleaned with
+        Git once after all Makefiles are compiled. :attr:`compile_fn` must accept the ``workspace`` argument, and
+        compilation must create files with the same user, so they can be removed.
+    :param job_pool: If not ``None``, each Makefile is built with parallel jobs, using free tokens from the pool (see
+        :class:`ghcc.utils.JobTokenPool`). :attr:`compile_fn` must accept the ``jobs`` argument.
+    :param num_workers: Maximum number of Makefile directories compiled concurrently. Directories nested under another
+        Makefile directory are compiled in order after it. Only used if :attr:`use_snapshot` is ``True``, because
+        cleaning the repository with Git between Makefiles would interfere with other builds.
     :return: A list of Makefile compilation results.
     """
     env = {}
@@ -418,33 +695,146 @@ def compile_and_move(
         env["MOCK_GCC_LIBRARY_LOG"] = os.path.join(repo_binary_dir, "libraries.txt")
     if gcc_override_flags is not None:
         env["MOCK_GCC_OVERRIDE_FLAGS"] = gcc_override_flags
-    remaining_time = compile_timeout
-    for make_dir in makefile_dirs:
-        if remaining_time is not None and remaining_time <= 0.0:
-            break
-        start_time = time.time()
-        compile_result = compile_fn(make_dir, timeout=remaining_time, env=env)
-        elapsed_time = time.time() - start_time
-        if remaining_time is not None:
-            remaining_time -= elapsed_time
+    workspace = WorkspaceSnapshot(repo_path) if use_snapshot else None
+
+    def compile_makefile(
+        make_dir: str,
+        remaining_time: Optional[float],
+        workspace: Optional[WorkspaceSnapshot],
+    ) -> Optional[RepoDB.MakefileEntry]:
+        compile_kwargs: Dict[str, Any] = {}
+        if workspace is not None:
+            compile_kwargs["workspace"] = workspace
+        with contextlib.ExitStack() as stack:
+            if job_pool is not None:
+                num_tokens = stack.enter_context(job_pool.acquire())
+                compile_kwargs["jobs"] = 1 + num_tokens
+            compile_result = compile_fn(
+                make_dir, timeout=remaining_time, env=env, **compile_kwargs
+            )
         # Only record Makefiles that either successfully compiled or yielded binaries.
         # Successful compilations might not generate binaries, while failed compilations may also yield binaries.
-        if len(compile_result.elf_files) > 0 or compile_result.success:
-            hashes: List[str] = []
-            for path in compile_result.elf_files:
-                signature = hash_fn(make_dir, path)
-                hashes.append(signature)
-                full_path = os.path.join(make_dir, path)
-                shutil.move(full_path, os.path.join(repo_binary_dir, signature))
-            yield {
-                "directory": make_dir,
-                "success": compile_result.success,
-                "binaries": compile_result.elf_files,
-                "sha256": hashes,
-            }
+        # Makefiles that could not be compiled because the workspace was not restored are recorded as failures.
+        if (
+            len(compile_result.elf_files) == 0
+            and not compile_result.success
+            and compile_result.error_type is not CompileErrorType.RestoreFailed
+        ):
+            return None
+        hashes: List[str] = []
+        elf_info: List[Optional[ELFInfo]] = []
+        checked_info = compile_result.elf_info or []
+        for idx, path in enumerate(compile_result.elf_files):
+            signature = hash_fn(make_dir, path)
+            hashes.append(signature)
+            full_path = os.path.join(make_dir, path)
+            # Reuse the ELF header if it was read while collecting the files.
+            info = checked_info[idx] if idx < len(checked_info) else None
+            elf_info.append(info if info is not None else read_elf_header(full_path))
+            shutil.move(full_path, os.path.join(repo_binary_dir, signature))
+        return {
+            "directory": make_dir,
+            "success": compile_result.success,
+            "binaries": compile_result.elf_files,
+            "sha256": hashes,
+            "elf_class": [info.elf_class if info else None for info in elf_info],
+            "elf_type": [info.elf_type if info else None for info in elf_info],
+            "elf_machine": [info.machine if info else None for info in elf_info],
+        }
+
+    if workspace is not None and num_workers > 1:
+        yield from _compile_concurrently(
+            makefile_dirs, compile_makefile, workspace, num_workers, compile_timeout
+        )
+    else:
+        remaining_time = compile_timeout
+        for make_dir in makefile_dirs:
+            if remaining_time is not None and remaining_time <= 0.0:
+                break
+            start_time = time.time()
+            entry = compile_makefile(make_dir, remaining_time, workspace)
+            if remaining_time is not None:
+                remaining_time -= time.time() - start_time
+            if entry is not None:
+                yield entry
+    # Restoring the snapshot keeps untracked files that existed when it was taken (e.g., the CMake build folder), so
+    # the repository is cleaned with Git once all Makefiles are compiled.
     clean(repo_path)
 
 
+def _group_nested_dirs(makefile_dirs: List[str]) -> List[List[str]]:
+    r"""Group Makefile directories, so that each directory is in the same group as the outermost Makefile directory
+    containing it. Directories in each group keep their original order.
+    """
+    paths = [os.path.abspath(make_dir) for make_dir in makefile_dirs]
+    path_set = set(paths)
+    groups: Dict[str, List[str]] = {}
+    for make_dir, path in zip(makefile_dirs, paths):
+        root = path
+        parent = os.path.dirname(path)
+        while parent != os.path.dirname(parent):
+            if parent in path_set:
+                root = parent
+            parent = os.path.dirname(parent)
+        groups.setdefault(root, []).append(make_dir)
+    return list(groups.values())
+
+
+def _compile_concurrently(
+    makefile_dirs: List[str],
+    compile_makefile: Callable[
+        [str, Optional[float], Optional[WorkspaceSnapshot]],
+        Optional[RepoDB.MakefileEntry],
+    ],
+    workspace: WorkspaceSnapshot,
+    num_workers: int,
+    compile_timeout: Optional[float] = None,
+) -> Iterator[RepoDB.MakefileEntry]:
+    r"""Compile independent Makefile directories concurrently, and yield results as soon as they are available. Nested
+    directories are compiled in order by the same worker, as their builds could interfere with each other. Each worker
+    only restores the part of the workspace under its directories, and Makefiles whose part cannot be restored are
+    recorded as failures, instead of cleaning the whole repository with Git. The timeout limits the wall-clock time of
+    all compilations, instead of the sum of their durations.
+    """
+    deadline = None if compile_timeout is None else time.time() + compile_timeout
+    results: "queue.Queue[Optional[RepoDB.MakefileEntry]]" = queue.Queue()
+    stop_event = threading.Event()
+
+    def compile_group(group: List[str]) -> None:
+        try:
+            # The outermost directory of the group contains all other directories.
+            group_workspace = workspace.subtree(
+                os.path.commonpath([os.path.abspath(make_dir) for make_dir in group])
+            )
+            for make_dir in group:
+                remaining_time = None if deadline is None else deadline - time.time()
+                if stop_event.is_set() or (
+                    remaining_time is not None and remaining_time <= 0.0
+                ):
+                    break
+                entry = compile_makefile(make_dir, remaining_time, group_workspace)
+                if entry is not None:
+                    results.put(entry)
+        finally:
+            results.put(None)  # marks the end of the group
+
+    groups = _group_nested_dirs(makefile_dirs)
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(compile_group, group) for group in groups]
+        try:
+            num_running = len(groups)
+            while num_running > 0:
+                entry = results.get()
+                if entry is None:
+                    num_running -= 1
+                else:
+                    yield entry
+        finally:
+            stop_event.set()
+    for future in futures:
+        future.result()  # re-raise exceptions from workers
+
+
 def docker_batch_compile(
     repo_binary_dir: str,
     repo_path: str,
@@ -456,6 +846,8 @@ def docker_batch_compile(
     user_id: Optional[int] = None,
     directory_mapping: Optional[Dict[str, str]] = None,
     exception_log_fn=None,
+    job_pool: Optional[JobTokenPool] = None,
+    num_workers: int = 1,
 ) -> List[RepoDB.MakefileEntry]:
     r"""Run batch compilation in Docker.
 
@@ -473,6 +865,10 @@ def docker_batch_compile(
     :param directory_mapping: Additional directory mappings for Docker. Optional.
     :param exception_log_fn: A function to log exceptions occurred in Docker. The function takes the exception object
         as input and returns nothing.
+    :param job_pool: If not ``None``, the pool folder is mapped into the container, and Makefiles are built with
+        parallel jobs using tokens from the pool.
+    :param num_workers: Maximum number of independent Makefile directories compiled concurrently. See
+        :meth:`compile_and_move` for details.
     :return: A list of Makefile entries.
     """
     start_time = time.time()
@@ -496,6 +892,12 @@ def docker_batch_compile(
             ),
             *(["--use-makefile-info-pkl"] if use_makefile_info_pkl else []),
             *(["--verbose"] if verbose else []),
+            *(
+                ["--job-pool", "/usr/src/jobs", "--max-jobs", str(job_pool.max_jobs)]
+                if job_pool is not None
+                else []
+            ),
+            *(["--num-workers", str(num_workers)] if num_workers > 1 else []),
         ]
         ret = run_docker_command(
             cmd,
@@ -504,6 +906,11 @@ def docker_batch_compile(
             directory_mapping={
                 repo_path: "/usr/src/repo",
                 repo_binary_dir: "/usr/src/bin",
+                **(
+                    {job_pool.pool_folder: "/usr/src/jobs"}
+                    if job_pool is not None
+                    else {}
+                ),
                 **(directory_mapping or {}),
             },
         )
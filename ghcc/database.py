@@ -2,13 +2,17 @@ import abc
 import json
 import os
 import sys
-from typing import Any, Dict, Iterator, List, Optional, Set, Type
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Type
 
+import bson
+import flutes
 import pymongo
 from mypy_extensions import TypedDict
 
 __all__ = [
     "RepoDB",
+    "RepoDBWriter",
     "BinaryDB",
     "MatchFuncDB",
 ]
@@ -168,6 +172,10 @@ class RepoDB(Database):
         success: bool  # whether compilation was successful (return code 0)
         binaries: List[str]  # list of paths to binaries generated by make operation
         sha256: List[str]  # SHA256 hashes for each binary
+        # ELF metadata for each binary (see `ghcc.ELFInfo`), `None` if unavailable. Missing in old entries.
+        elf_class: List[Optional[int]]
+        elf_type: List[Optional[str]]
+        elf_machine: List[Optional[str]]
 
     class Entry(BaseEntry):
         repo_owner: str
@@ -181,6 +189,15 @@ class RepoDB(Database):
         num_makefiles: int  # number of compilable Makefiles (required because MongoDB cannot aggregate list lengths)
         num_binaries: int  # number of generated binaries (required because MongoDB cannot aggregate list lengths)
         makefiles: "List[RepoDB.MakefileEntry]"  # list of Makefiles
+        compile_time: float  # time (seconds) spent on compilation in the latest run
+        # The following fields are statistics of the latest run:
+        timings: Dict[str, float]  # time (seconds) spent in each pipeline stage
+        bytes_read: int  # logical number of bytes read, e.g. archives
+        bytes_written: int  # logical number of bytes written, e.g. repo files, binaries
+        # The following fields identify the latest build, so builds of identical trees can be reused:
+        tree_hash: str  # hash of the Git tree at HEAD
+        build_key: str  # identifies the build environment, i.e. compiler flags and Docker image
+        binary_dir: str  # folder storing the binaries, relative to the binary folder
 
     @property
     def collection_name(self) -> str:
@@ -192,7 +209,12 @@ class RepoDB(Database):
             {
                 "repo_owner": pymongo.ASCENDING,
                 "repo_name": pymongo.ASCENDING,
-            }
+            },
+            {
+                "tree_hash": pymongo.ASCENDING,
+                "build_key": pymongo.ASCENDING,
+                "$unique": False,
+            },
         ]
 
     def get(self, repo_owner: str, repo_name: str) -> Optional[Entry]:
@@ -204,6 +226,65 @@ class RepoDB(Database):
             {"repo_owner": repo_owner, "repo_name": repo_name}
         )
 
+    def get_many(
+        self,
+        repos: List[Tuple[str, str]],
+        projection: Optional[Dict[str, bool]] = None,
+    ) -> Dict[Tuple[str, str], Entry]:
+        r"""Get the DB entries corresponding to multiple repositories, using a single query.
+
+        :param repos: A list of ``(repo_owner, repo_name)`` tuples.
+        :param projection: If not ``None``, only return (or omit) the specified fields, in the same format as
+            :meth:`pymongo.collection.Collection.find`. Fields ``repo_owner`` and ``repo_name`` are always returned.
+        :return: A dictionary mapping ``(repo_owner, repo_name)`` tuples to entries. Repositories without entries are
+            not included.
+        """
+        if projection is not None and any(projection.values()):
+            projection = {**projection, "repo_owner": True, "repo_name": True}
+        keys = set(repos)
+        if len(keys) == 0:
+            return {}
+        # Match exact pairs. Separate `$in` conditions on owners and names would match their Cartesian product.
+        cursor = self.collection.find(
+            {
+                "$or": [
+                    {"repo_owner": repo_owner, "repo_name": repo_name}
+                    for repo_owner, repo_name in keys
+                ]
+            },
+            projection,
+        )
+        return {(entry["repo_owner"], entry["repo_name"]): entry for entry in cursor}
+
+    def find_build(
+        self,
+        tree_hash: str,
+        build_key: str,
+        exclude: Optional[Tuple[str, str]] = None,
+    ) -> Optional[Entry]:
+        r"""Find a compiled repository whose latest build is of the specified tree in the specified build environment.
+        Entries whose Makefile results were not stored (due to Unicode encoding errors) are never returned, since their
+        binaries cannot be located.
+
+        :param tree_hash: Hash of the Git tree at HEAD.
+        :param build_key: Key identifying the build environment.
+        :param exclude: If not ``None``, a ``(repo_owner, repo_name)`` tuple of a repository to exclude from search.
+        :return: The entry of any such repository, or ``None`` if none exists.
+        """
+        query: Dict[str, Any] = {
+            "tree_hash": tree_hash,
+            "build_key": build_key,
+            "compiled": True,
+            "binary_dir": {"$exists": True},
+            "$nor": [{"num_binaries": {"$gt": 0}, "makefiles": {"$size": 0}}],
+        }
+        if exclude is not None:
+            query["$or"] = [
+                {"repo_owner": {"$ne": exclude[0]}},
+                {"repo_name": {"$ne": exclude[1]}},
+            ]
+        return self.collection.find_one(query)
+
     def add_repo(
         self,
         repo_owner: str,
@@ -258,6 +339,10 @@ class RepoDB(Database):
         repo_name: str,
         makefiles: List[MakefileEntry],
         ignore_length_mismatch: bool = False,
+        compile_time: Optional[float] = None,
+        tree_hash: Optional[str] = None,
+        build_key: Optional[str] = None,
+        binary_dir: Optional[str] = None,
     ) -> bool:
         r"""Update Makefile compilation results for a given repository.
 
@@ -267,6 +352,11 @@ class RepoDB(Database):
         :param ignore_length_mismatch: If ``False``, a :exc:`ValueError` is raised if the number of Makefiles previously
             stored in the DB is different from the length of :attr:`makefiles` (unless there were no Makefiles
             previously).
+        :param compile_time: If not ``None``, the time (in seconds) spent on compilation is also recorded.
+        :param tree_hash: If not ``None``, the hash of the compiled Git tree is also recorded, along with
+            :attr:`build_key` and :attr:`binary_dir`. See :meth:`find_build`.
+        :param build_key: Key identifying the build environment.
+        :param binary_dir: Folder storing the binaries, relative to the binary folder.
         :return: A boolean value, indicating whether the write succeeded. Note that it is considered unsuccessful if
             the :attr:`makefiles` list was not stored due to Unicode encoding errors.
         """
@@ -289,6 +379,12 @@ class RepoDB(Database):
             "num_binaries": sum(len(makefile["binaries"]) for makefile in makefiles),
             "makefiles": makefiles,
         }
+        if compile_time is not None:
+            update_entries["compile_time"] = compile_time
+        if tree_hash is not None:
+            update_entries.update(
+                tree_hash=tree_hash, build_key=build_key, binary_dir=binary_dir
+            )
         try:
             result = self.collection.update_one(
                 {"_id": entry["_id"]}, {"$set": update_entries}
@@ -299,6 +395,9 @@ class RepoDB(Database):
             update_entries[
                 "makefiles"
             ] = []  # some path might contain strange characters; just don't store it
+            # Without the Makefiles, the build cannot be reused by other repositories.
+            for key in ["tree_hash", "build_key", "binary_dir"]:
+                update_entries.pop(key, None)
             result = self.collection.update_one(
                 {"_id": entry["_id"]}, {"$set": update_entries}
             )
@@ -321,6 +420,238 @@ class RepoDB(Database):
         return self._aggregate_sum("num_binaries")
 
 
+class RepoDBWriter:
+    r"""A write-behind buffer over :class:`RepoDB`. Writes are queued as upserts and sent in batches using
+    ``bulk_write``, so each write does not incur synchronous round-trips to the DB. Operations are executed in the order
+    they are queued.
+
+    Batches are flushed when the buffer is full, periodically every ``flush_interval`` seconds, or when the writer is
+    closed. Note that queued writes are not visible to :class:`RepoDB` queries until flushed. If a batch fails, the
+    operations that were not applied are put back into the buffer and retried in the next flush, except for the
+    operation rejected by the DB (if any), which is dropped and logged.
+
+    All operations are upserts, so a write is never silently lost because the entry does not exist. Fields that are not
+    written are initialized with the same default values as in :meth:`add_repo`.
+    """
+
+    DEFAULT_FIELDS: Dict[str, Any] = {
+        "repo_branch": None,
+        "repo_commit_id": None,
+        "repo_tag": None,
+        "clone_successful": True,
+        "repo_size": -1,
+        "compiled": False,
+        "num_makefiles": 0,
+        "num_binaries": 0,
+        "makefiles": [],
+    }
+
+    def __init__(
+        self, db: RepoDB, batch_size: int = 500, flush_interval: Optional[float] = 10.0
+    ):
+        r"""
+        :param db: The repository DB to write to.
+        :param batch_size: Maximum number of queued operations before a flush is triggered.
+        :param flush_interval: Maximum time (in seconds) queued operations wait before being flushed. If ``None``,
+            operations are only flushed when the buffer is full, or when :meth:`flush` or :meth:`close` is called.
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[pymongo.UpdateOne] = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+        if flush_interval is not None:
+            self._flush_thread = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._flush_thread.start()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except pymongo.errors.PyMongoError as e:
+                flutes.log_exception(e, "Exception occurred when flushing writes to DB")
+
+    def _enqueue(self, operation: pymongo.UpdateOne) -> None:
+        with self._lock:
+            self._buffer.append(operation)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            try:
+                self.flush()
+            except pymongo.errors.PyMongoError as e:
+                # Operations are kept in the buffer, and will be retried in the next flush.
+                flutes.log_exception(e, "Exception occurred when flushing writes to DB")
+
+    def _upsert(
+        self, repo_owner: str, repo_name: str, update: Dict[str, Any]
+    ) -> pymongo.UpdateOne:
+        set_on_insert = {
+            key: value
+            for key, value in self.DEFAULT_FIELDS.items()
+            if key not in update
+        }
+        return pymongo.UpdateOne(
+            {"repo_owner": repo_owner, "repo_name": repo_name},
+            {"$set": update, "$setOnInsert": set_on_insert},
+            upsert=True,
+        )
+
+    def flush(self) -> None:
+        r"""Send all queued operations to the DB. If the write fails, operations that were not applied are put back
+        into the buffer, and the exception is re-raised.
+        """
+        with self._lock:
+            operations, self._buffer = self._buffer, []
+            if len(operations) == 0:
+                return
+            try:
+                self.db.collection.bulk_write(operations, ordered=True)
+            except pymongo.errors.BulkWriteError as e:
+                # Operations are executed in order, and execution stops at the first error. Operations before it were
+                # applied. The failed operation would fail again, so it is dropped.
+                write_errors = e.details.get("writeErrors", [])
+                if len(write_errors) > 0:
+                    failed_idx = write_errors[0]["index"]
+                    flutes.log(
+                        f"Dropped DB write rejected with error: {write_errors[0].get('errmsg')}",
+                        "error",
+                    )
+                    self._buffer = operations[(failed_idx + 1) :] + self._buffer
+                else:
+                    self._buffer = operations + self._buffer
+                raise
+            except pymongo.errors.PyMongoError:
+                # Upserts with `$set` are idempotent, so it is safe to retry operations that might have been applied.
+                self._buffer = operations + self._buffer
+                raise
+
+    def close(self) -> None:
+        r"""Flush all queued operations and stop the periodic flushing thread. The underlying DB is not closed."""
+        self._closed.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+        self.flush()
+
+    def add_repo(
+        self,
+        repo_owner: str,
+        repo_name: str,
+        repo_branch: str,
+        repo_commit_id: str,
+        repo_tag: str,
+        clone_successful: bool,
+        repo_size: int = -1,
+    ) -> None:
+        r"""Queue an insertion of a DB entry for the specified repository, or an update if the entry exists. See
+        :meth:`RepoDB.add_repo` for the description of arguments.
+        """
+        self._enqueue(
+            pymongo.UpdateOne(
+                {"repo_owner": repo_owner, "repo_name": repo_name},
+                {
+                    "$set": {
+                        "clone_successful": clone_successful,
+                        "repo_size": repo_size,
+                    },
+                    "$setOnInsert": {
+                        "repo_branch": repo_branch,
+                        "repo_commit_id": repo_commit_id,
+                        "repo_tag": repo_tag,
+                        "compiled": False,
+                        "num_makefiles": 0,
+                        "num_binaries": 0,
+                        "makefiles": [],
+                    },
+                },
+                upsert=True,
+            )
+        )
+
+    def update_makefile(
+        self,
+        repo_owner: str,
+        repo_name: str,
+        makefiles: List[RepoDB.MakefileEntry],
+        compile_time: Optional[float] = None,
+        tree_hash: Optional[str] = None,
+        build_key: Optional[str] = None,
+        binary_dir: Optional[str] = None,
+    ) -> bool:
+        r"""Queue an update of Makefile compilation results for a given repository. The entry for the repository
+        should exist, or be queued by :meth:`add_repo` before this call; otherwise it is created with default values.
+        Unlike :meth:`RepoDB.update_makefile`, the number of Makefiles is not checked against the existing entry.
+
+        :param repo_owner: Owner of the repository.
+        :param repo_name: Name of the repository.
+        :param makefiles: List of Makefile compilation results.
+        :param compile_time: If not ``None``, the time (in seconds) spent on compilation is also recorded.
+        :param tree_hash: If not ``None``, the hash of the compiled Git tree is also recorded, along with
+            :attr:`build_key` and :attr:`binary_dir`. See :meth:`RepoDB.find_build`.
+        :param build_key: Key identifying the build environment.
+        :param binary_dir: Folder storing the binaries, relative to the binary folder.
+        :return: A boolean value, indicating whether the :attr:`makefiles` list will be stored. If ``False``, the list
+            could not be encoded due to Unicode encoding errors, and an empty list is stored instead.
+        """
+        update_entries = {
+            "compiled": True,
+            "num_makefiles": len(makefiles),
+            "num_binaries": sum(len(makefile["binaries"]) for makefile in makefiles),
+            "makefiles": makefiles,
+        }
+        if compile_time is not None:
+            update_entries["compile_time"] = compile_time
+        if tree_hash is not None:
+            update_entries.update(
+                tree_hash=tree_hash, build_key=build_key, binary_dir=binary_dir
+            )
+        success = True
+        try:
+            # Check for encoding errors now, as they would otherwise fail the entire batch.
+            bson.encode({"makefiles": makefiles})
+        except UnicodeEncodeError:
+            # Some path might contain strange characters; just don't store it. Without the Makefiles, the build cannot
+            # be reused by other repositories.
+            update_entries["makefiles"] = []
+            for key in ["tree_hash", "build_key", "binary_dir"]:
+                update_entries.pop(key, None)
+            success = False
+        self._enqueue(self._upsert(repo_owner, repo_name, update_entries))
+        return success
+
+    def update_stats(
+        self,
+        repo_owner: str,
+        repo_name: str,
+        timings: Dict[str, float],
+        bytes_read: int,
+        bytes_written: int,
+    ) -> None:
+        r"""Queue an update of pipeline statistics for a given repository. The entry for the repository should exist,
+        or be queued by :meth:`add_repo` before this call; otherwise it is created with default values.
+
+        :param repo_owner: Owner of the repository.
+        :param repo_name: Name of the repository.
+        :param timings: Time (in seconds) spent in each stage of the pipeline.
+        :param bytes_read: Number of bytes read during processing.
+        :param bytes_written: Number of bytes written during processing.
+        """
+        self._enqueue(
+            self._upsert(
+                repo_owner,
+                repo_name,
+                {
+                    "timings": timings,
+                    "bytes_read": bytes_read,
+                    "bytes_written": bytes_written,
+                },
+            )
+        )
+
+
 class BinaryDB(Database):
     class Entry(BaseEntry):
         repo_owner: str
@@ -0,0 +1,292 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+from typing import Dict, Iterable, Iterator, Optional
+
+import flutes
+from flutes.run import run_command
+
+__all__ = [
+    "ObjectCache",
+    "SubmoduleCache",
+]
+
+
+@contextlib.contextmanager
+def _lock(lock_path: str, exclusive: bool, blocking: bool = True) -> Iterator[bool]:
+    r"""Acquire a file lock shared between processes. Yields whether the lock is acquired, which is always ``True`` if
+    ``blocking`` is ``True``."""
+    with open(lock_path, "a") as f:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ObjectCache:
+    r"""A local store of Git objects shared by clones of related repositories, e.g., forks of the same project.
+
+    Each cache entry is a bare repository holding the history of previous clones under the same key (the repository
+    name, since forks usually keep the name of their upstream). Clones borrow objects from the entry using
+    ``--reference-if-able``, so only objects missing from the cache are downloaded. ``--dissociate`` is always used,
+    so the clones (and their archives) never depend on the cache, and entries can be evicted at any time.
+
+    Commits in the entry are advertised to the remote as available history, so entries must contain the full history
+    of their commits. Otherwise, the remote would skip objects of older commits (e.g., when a fork is behind its
+    upstream) that are missing from the cache. Since clones are shallow, the full history is fetched from the remote
+    when updating an entry. To avoid this cost for repositories without forks, an entry is only created when a second
+    repository with the same key is cloned.
+
+    Entries are locked with file locks, so the cache can be shared by multiple processes. Least recently used entries
+    are evicted when the total size exceeds the limit.
+    """
+
+    def __init__(self, cache_folder: str, max_size: Optional[int] = None):
+        r"""
+        :param cache_folder: Path to the folder storing cache entries.
+        :param max_size: Maximum total size (in bytes) of the cache, or ``None`` for unlimited size.
+        """
+        self.cache_folder = os.path.abspath(cache_folder)
+        self.max_size = max_size
+        os.makedirs(self.cache_folder, exist_ok=True)
+        # Records the first repository cloned for each key.
+        self._seen_path = os.path.join(self.cache_folder, "seen.sqlite3")
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, ref_name TEXT)"
+            )
+
+    @staticmethod
+    def get_key(repo_owner: str, repo_name: str) -> str:
+        r"""Return the key of the entry used for a repository. Forks usually share the name of their upstream."""
+        return repo_name.lower()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, f"{key}.git")
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, f"{key}.lock")
+
+    def _size_path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, f"{key}.size")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._seen_path, timeout=60)
+
+    def _is_shared(self, key: str, ref_name: str) -> bool:
+        r"""Record the repository as seen, and return whether a different repository with the same key was seen."""
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)", (key, ref_name))
+            (first_ref_name,) = conn.execute(
+                "SELECT ref_name FROM seen WHERE key = ?", (key,)
+            ).fetchone()
+        return first_ref_name != ref_name
+
+    @contextlib.contextmanager
+    def reference(self, key: str) -> Iterator[Optional[str]]:
+        r"""Lock an entry for use as a reference repository during cloning.
+
+        :param key: The key of the entry.
+        :return: A context manager yielding the path to the bare repository, or ``None`` if the entry does not exist.
+        """
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            # Don't create lock files for keys without entries.
+            yield None
+            return
+        with _lock(self._lock_path(key), exclusive=False):
+            if not os.path.exists(path):  # evicted in the meantime
+                yield None
+                return
+            os.utime(path)  # mark as recently used
+            yield path
+
+    def update(
+        self,
+        key: str,
+        url: str,
+        ref_name: str,
+        timeout: Optional[float] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> bool:
+        r"""Add the history of a cloned repository to the cache entry. The entry is created if another repository with
+        the same key was cloned before, and is not updated if it is in use by other processes.
+
+        :param key: The key of the entry.
+        :param url: The URL of the cloned repository. The full history of its ``HEAD`` is fetched into the entry, which
+            only downloads objects missing from the entry.
+        :param ref_name: Name of the ref to store the fetched commit under, e.g., ``torvalds/linux``. Objects
+            reachable from the previous commit under the same name are kept, but no longer advertised to remotes.
+        :param timeout: Maximum time allowed for fetching, in seconds. Defaults to ``None`` (unlimited time).
+        :param env: Environment variables for Git commands.
+        :return: Whether the entry was updated.
+        """
+        path = self._entry_path(key)
+        if not os.path.exists(path) and not self._is_shared(key, ref_name):
+            return False
+        with _lock(self._lock_path(key), exclusive=True, blocking=False) as locked:
+            if not locked:
+                return False
+            try:
+                if not os.path.exists(path):
+                    run_command(["git", "init", "--bare", "-q", path])
+                    # Keep fetched objects in packs, instead of exploding them into loose objects.
+                    run_command(
+                        ["git", "config", "transfer.unpackLimit", "1"], cwd=path
+                    )
+                run_command(
+                    ["git", "fetch", "-q", url, f"+HEAD:refs/ghcc/{ref_name}"],
+                    env=env,
+                    cwd=path,
+                    timeout=timeout,
+                )
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                flutes.log(
+                    f"Failed to update object cache '{key}'. Captured output: '{e.output}'",
+                    "warning",
+                )
+                return False
+            finally:
+                # Record the size, so eviction does not need to walk all entries. The entry could have been created even
+                # if fetching failed.
+                if os.path.exists(path):
+                    with open(self._size_path(key), "w") as f:
+                        f.write(str(flutes.get_folder_size(path)))
+            os.utime(path)
+        self.evict()
+        return True
+
+    def evict(self) -> None:
+        r"""Remove least recently used entries until the cache size is within limits. Entries in use are skipped."""
+        if self.max_size is None:
+            return
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_folder):
+            if not name.endswith(".git"):
+                continue
+            key = name[: -len(".git")]
+            path = os.path.join(self.cache_folder, name)
+            try:
+                with open(self._size_path(key)) as f:
+                    size = int(f.read())
+                mtime = os.path.getmtime(path)
+            except (OSError, ValueError):
+                continue  # being created or removed
+            entries.append((mtime, key, size))
+            total_size += size
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            with _lock(self._lock_path(key), exclusive=True, blocking=False) as locked:
+                if not locked:
+                    continue
+                shutil.rmtree(self._entry_path(key), ignore_errors=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._size_path(key))
+                total_size -= size
+
+
+class SubmoduleCache:
+    r"""A cache of bare mirrors of submodule repositories, shared by all clones.
+
+    Popular submodules (e.g., ``googletest``) are used by many repositories. With the cache, each submodule repository
+    is downloaded once into a mirror, and submodules are cloned from the local mirror afterwards. Mirrors are refreshed
+    lazily, i.e., only when the commit required by a superproject is missing from the mirror.
+
+    Mirrors are locked with file locks, so the cache can be shared by multiple processes.
+    """
+
+    def __init__(self, cache_folder: str):
+        r"""
+        :param cache_folder: Path to the folder storing the mirrors.
+        """
+        self.cache_folder = os.path.abspath(cache_folder)
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def get_mirror_path(self, url: str) -> str:
+        r"""Return the path of the mirror for a repository URL. The mirror might not exist."""
+        normalized_url = url.rstrip("/")
+        if normalized_url.endswith(".git"):
+            normalized_url = normalized_url[: -len(".git")]
+        # Include the repository name to make the folder easier to identify.
+        name = re.sub(r"[^\w.-]", "_", normalized_url.rsplit("/", 1)[-1])
+        digest = hashlib.sha1(normalized_url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_folder, f"{name}-{digest}.git")
+
+    def ensure(
+        self,
+        url: str,
+        commit: str,
+        timeout: Optional[float] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Optional[str]:
+        r"""Make sure that the mirror for a repository exists and contains the specified commit, creating or refreshing
+        the mirror if necessary.
+
+        :param url: The URL of the submodule repository.
+        :param commit: The commit that should be present in the mirror.
+        :param timeout: Maximum time allowed for downloading, in seconds. Defaults to ``None`` (unlimited time).
+        :param env: Environment variables for Git commands.
+        :return: Path to the mirror, or ``None`` if the commit could not be obtained.
+        """
+        path = self.get_mirror_path(url)
+        with _lock(path + ".lock", exclusive=True):
+            try:
+                if not os.path.exists(path):
+                    # Clone into a temporary folder, so that incomplete mirrors are never used.
+                    temp_path = path + ".tmp"
+                    shutil.rmtree(temp_path, ignore_errors=True)
+                    run_command(
+                        ["git", "clone", "--mirror", "-q", url, temp_path],
+                        env=env,
+                        timeout=timeout,
+                    )
+                    os.rename(temp_path, path)
+                elif not self._has_commit(path, commit):
+                    run_command(
+                        ["git", "fetch", "-q", "--prune", "origin"],
+                        env=env,
+                        cwd=path,
+                        timeout=timeout,
+                    )
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                flutes.log(
+                    f"Failed to update submodule mirror for '{url}'. Captured output: '{e.output}'",
+                    "warning",
+                )
+                return None
+            if not self._has_commit(path, commit):
+                return None
+            os.utime(path)
+        return path
+
+    @staticmethod
+    def _has_commit(path: str, commit: str) -> bool:
+        result = run_command(
+            ["git", "cat-file", "-e", f"{commit}^{{commit}}"],
+            cwd=path,
+            ignore_errors=True,
+        )
+        return result.return_code == 0
+
+    @contextlib.contextmanager
+    def reading(self, mirror_paths: Iterable[str]) -> Iterator[None]:
+        r"""Lock mirrors while submodules are being cloned from them, so they are not modified in the meantime."""
+        with contextlib.ExitStack() as stack:
+            for path in sorted(mirror_paths):
+                stack.enter_context(_lock(path + ".lock", exclusive=False))
+            yield
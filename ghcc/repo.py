@@ -1,13 +1,32 @@
+import copy
 import os
+import re
 import shutil
 import subprocess
+import threading
 import time
 from enum import Enum, auto
-from typing import NamedTuple, Optional
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
 from flutes.run import run_command
 
-__all__ = ["CloneErrorType", "CloneResult", "clean", "clone"]
+from .git_cache import ObjectCache, SubmoduleCache
+from .utils.async_command import run_command_async
+
+__all__ = [
+    "CloneErrorType",
+    "CloneResult",
+    "WorkspaceSnapshot",
+    "add_worktree",
+    "clean",
+    "clone",
+    "clone_async",
+    "get_head_commit",
+    "get_tree_hash",
+    "is_clean",
+    "remove_worktree",
+    "skip_missing_files",
+]
 
 
 class CloneErrorType(Enum):
@@ -16,6 +35,7 @@ class CloneErrorType(Enum):
     PrivateOrNonexistent = auto()
     Unknown = auto()
     SubmodulesFailed = auto()
+    NotCRepository = auto()
 
 
 class CloneResult(NamedTuple):
@@ -50,6 +70,524 @@ def clean(repo_folder: str) -> None:
         )
 
 
+class WorkspaceSnapshot:
+    r"""A snapshot of the files in the working tree of a Git repository, used to restore the tree between builds
+    instead of :meth:`clean`.
+
+    The snapshot records the status of each file, but not its contents. Restoring removes files and directories that
+    are not in the snapshot, and only asks Git to check out tracked files that were modified or deleted. This takes a
+    single walk over the tree, while :meth:`clean` walks the tree for each of ``git reset`` and ``git clean``, and
+    again for each submodule. Untracked files present when the snapshot is taken (e.g., files generated by CMake) are
+    kept, but cannot be restored if they are modified.
+
+    Builds in separate directories can restore their own parts of the tree concurrently, using views returned by
+    :meth:`subtree`.
+    """
+
+    def __init__(self, repo_folder: str):
+        r"""
+        :param repo_folder: Path to the Git repository. The working tree should be pristine.
+        """
+        self.repo_folder = os.path.abspath(repo_folder)
+        self._files: Dict[str, Tuple[int, int, int]] = {}  # path -> (mode, size, mtime)
+        self._directories: Set[str] = set()
+        self._repo_roots: Set[str] = set()  # the repository and its submodules
+        self._root = self.repo_folder  # the part of the tree restored by this view
+        # Git cannot update the index of a repository concurrently.
+        self._checkout_lock = threading.Lock()
+        stack = [self.repo_folder]
+        while len(stack) > 0:
+            directory = stack.pop()
+            entries = self._scan(directory, record_roots=True)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self._directories.add(entry.path)
+                    stack.append(entry.path)
+                else:
+                    self._files[entry.path] = self._stat(entry.path)
+
+    def subtree(self, directory: str) -> "WorkspaceSnapshot":
+        r"""Return a view of the snapshot that only restores files under a directory. Views share state with the
+        snapshot, and views of disjoint directories can be restored concurrently from different threads.
+
+        :param directory: Path to a directory in the repository.
+        """
+        view = copy.copy(self)
+        view._root = os.path.abspath(directory)
+        return view
+
+    @property
+    def is_subtree(self) -> bool:
+        r"""Whether this is a view returned by :meth:`subtree` for a directory other than the repository root."""
+        return self._root != self.repo_folder
+
+    def _scan(self, directory: str, record_roots: bool = False) -> List[os.DirEntry]:
+        entries = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name == ".git":
+                    if record_roots:
+                        self._repo_roots.add(directory)
+                else:
+                    entries.append(entry)
+        return entries
+
+    @staticmethod
+    def _stat(path: str) -> Tuple[int, int, int]:
+        stat = os.lstat(path)
+        return stat.st_mode, stat.st_size, stat.st_mtime_ns
+
+    def _checkout(self, paths: List[str]) -> None:
+        # Check out files from the innermost repository (or submodule) containing them.
+        roots = sorted(self._repo_roots, key=len, reverse=True)
+        files_by_root: Dict[str, List[str]] = {}
+        for path in paths:
+            root = next(root for root in roots if path.startswith(root + os.sep))
+            files_by_root.setdefault(root, []).append(os.path.relpath(path, root))
+        with self._checkout_lock:
+            for root, files in files_by_root.items():
+                for idx in range(0, len(files), 256):
+                    run_command(
+                        ["git", "checkout", "-q", "--", *files[idx : (idx + 256)]],
+                        cwd=root,
+                    )
+
+    def restore(self) -> bool:
+        r"""Restore the working tree (or the part of it under the view's directory) to the state when the snapshot was
+        taken.
+
+        :return: Whether the tree was restored. If not, the tree could be partially restored, and should be cleaned
+            using :meth:`clean`.
+        """
+        changed = []
+        found: Set[str] = set()
+        try:
+            stack = [self._root]
+            while len(stack) > 0:
+                directory = stack.pop()
+                for entry in self._scan(directory):
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path in self._directories:
+                            stack.append(entry.path)
+                        else:
+                            shutil.rmtree(entry.path)
+                    elif entry.path in self._files:
+                        found.add(entry.path)
+                        if self._stat(entry.path) != self._files[entry.path]:
+                            changed.append(entry.path)
+                    else:
+                        os.remove(entry.path)
+            prefix = self._root + os.sep
+            changed.extend(
+                path
+                for path in self._files
+                if path not in found and path.startswith(prefix)
+            )
+            if len(changed) > 0:
+                self._checkout(changed)
+                for path in changed:
+                    self._files[path] = self._stat(path)
+        except (OSError, StopIteration, subprocess.CalledProcessError):
+            return False
+        return True
+
+
+# Names of files (in lowercase) that indicate how a repository can be built.
+BUILD_FILE_NAMES = {
+    "makefile",
+    "gnumakefile",
+    "makefile.am",
+    "makefile.in",
+    "cmakelists.txt",
+    "configure",
+    "configure.ac",
+    "configure.in",
+}
+
+
+def _is_c_repository(files: List[str]) -> bool:
+    r"""Check whether a repository could produce C binaries, judging from the list of files in the repository.
+
+    :param files: Paths of all files in the repository, relative to the repository root.
+    """
+    has_build_file = False
+    has_c_file = False
+    for file in files:
+        name = os.path.basename(file)
+        if name.lower() in BUILD_FILE_NAMES:
+            has_build_file = True
+        elif name.endswith(".c"):
+            has_c_file = True
+        elif name == ".gitmodules":
+            # Source files might be in submodules, which are not listed.
+            has_c_file = True
+        if has_build_file and has_c_file:
+            return True
+    return False
+
+
+def get_head_commit(repo_folder: str) -> Optional[str]:
+    r"""Return the hash of the commit checked out in a Git repository.
+
+    :param repo_folder: Path to the Git repository.
+    :return: The commit hash, or ``None`` if the folder is not a valid Git repository.
+    """
+    try:
+        result = run_command(
+            ["git", "rev-parse", "HEAD"], cwd=repo_folder, return_output=True
+        )
+    except subprocess.CalledProcessError:
+        return None
+    assert result.captured_output is not None
+    return result.captured_output.decode("utf-8").strip()
+
+
+def get_tree_hash(repo_folder: str) -> Optional[str]:
+    r"""Return the hash of the tree of the commit checked out in a Git repository. Repositories with identical contents
+    (e.g., forks that are even with their upstream) have identical tree hashes, even if their histories differ.
+
+    :param repo_folder: Path to the Git repository.
+    :return: The tree hash, or ``None`` if the folder is not a valid Git repository.
+    """
+    try:
+        result = run_command(
+            ["git", "rev-parse", "HEAD^{tree}"], cwd=repo_folder, return_output=True
+        )
+    except subprocess.CalledProcessError:
+        return None
+    assert result.captured_output is not None
+    return result.captured_output.decode("utf-8").strip()
+
+
+def is_clean(repo_folder: str) -> bool:
+    r"""Check whether the working tree of a Git repository (and its submodules) matches the checked out commit, i.e.,
+    there are no modified, untracked, or ignored files.
+
+    :param repo_folder: Path to the Git repository.
+    """
+    try:
+        result = run_command(
+            ["git", "status", "--porcelain", "--ignored", "--untracked-files=all"],
+            cwd=repo_folder,
+            return_output=True,
+        )
+    except subprocess.CalledProcessError:
+        return False
+    assert result.captured_output is not None
+    return len(result.captured_output.strip()) == 0
+
+
+def skip_missing_files(repo_folder: str) -> None:
+    r"""Mark tracked files missing from the working tree of a Git repository (and its submodules) as ``skip-worktree``,
+    so that :meth:`clean` does not restore them. This is required for trees that are only partially extracted.
+
+    :param repo_folder: Path to the Git repository.
+    """
+    command = "git ls-files -z --deleted | git update-index -z --skip-worktree --stdin"
+    run_command(["sh", "-c", command], cwd=repo_folder, ignore_errors=True)
+    if os.path.exists(os.path.join(repo_folder, ".gitmodules")):
+        run_command(
+            ["git", "submodule", "foreach", "--quiet", "--recursive", command],
+            cwd=repo_folder,
+            ignore_errors=True,
+        )
+
+
+def _resolve_url(base_url: str, url: str) -> str:
+    r"""Resolve a submodule URL relative to the URL of its superproject, in the same way as Git does."""
+    if not url.startswith("./") and not url.startswith("../"):
+        return url
+    resolved = base_url.rstrip("/")
+    for component in url.split("/"):
+        if component == "..":
+            resolved = resolved.rsplit("/", 1)[0]
+        elif component not in ["", "."]:
+            resolved += "/" + component
+    return resolved
+
+
+def _is_network_url(url: str) -> bool:
+    if url.startswith("file:"):
+        return False
+    # Either a URL with a scheme (`https://`), or SCP-like syntax (`git@github.com:owner/repo`).
+    return "://" in url or re.match(r"^[\w.-]+@[\w.-]+:", url) is not None
+
+
+def _list_submodules(repo_path: str, remote_url: str) -> List[Tuple[str, str, str]]:
+    r"""List submodules of a repository (non-recursively).
+
+    :param repo_path: Path to the Git repository.
+    :param remote_url: URL of the repository, used to resolve relative submodule URLs.
+    :return: A list of tuples of (path, resolved URL, commit) for each submodule.
+    """
+    if not os.path.exists(os.path.join(repo_path, ".gitmodules")):
+        return []
+    result = run_command(
+        [
+            "git",
+            "config",
+            "-f",
+            ".gitmodules",
+            "-z",
+            "--get-regexp",
+            r"^submodule\..*\.(path|url)$",
+        ],
+        cwd=repo_path,
+        return_output=True,
+        ignore_errors=True,
+    )
+    if result.return_code != 0 or result.captured_output is None:
+        return []
+    modules: Dict[str, Dict[str, str]] = {}
+    for entry in result.captured_output.decode("utf-8").split("\0"):
+        if "\n" not in entry:
+            continue
+        key, value = entry.split("\n", 1)
+        name, attr = key[len("submodule.") :].rsplit(".", 1)
+        modules.setdefault(name, {})[attr] = value
+    paths = {
+        module["path"]: module["url"]
+        for module in modules.values()
+        if "path" in module and "url" in module
+    }
+    if len(paths) == 0:
+        return []
+    # Only paths recorded as gitlinks in the tree are actual submodules.
+    result = run_command(
+        ["git", "ls-tree", "-z", "HEAD", "--", *paths.keys()],
+        cwd=repo_path,
+        return_output=True,
+    )
+    assert result.captured_output is not None
+    submodules = []
+    for entry in result.captured_output.decode("utf-8").split("\0"):
+        if entry == "":
+            continue
+        info, path = entry.split("\t", 1)
+        _, obj_type, commit = info.split()
+        if obj_type == "commit" and path in paths:
+            submodules.append((path, _resolve_url(remote_url, paths[path]), commit))
+    return submodules
+
+
+def _update_submodules(
+    repo_path: str,
+    remote_url: str,
+    submodule_cache: SubmoduleCache,
+    env: Dict[str, str],
+    remaining_time: Callable[[], Optional[float]],
+) -> None:
+    r"""Recursively initialize submodules of a repository, cloning submodules from local mirrors where possible. This
+    is equivalent to ``git submodule update --init --recursive``.
+    """
+    submodules = _list_submodules(repo_path, remote_url)
+    if len(submodules) == 0:
+        return
+    mirrors: Dict[str, str] = {}
+    # Cloning from the local mirrors requires allowing the `file` protocol for submodules, which Git disables by
+    # default. Only do so if none of the submodules point to local paths, so that malicious repositories cannot
+    # include arbitrary local repositories.
+    if all(_is_network_url(url) for _, url, _ in submodules):
+        for _, url, commit in submodules:
+            mirror_path = submodule_cache.ensure(
+                url, commit, timeout=remaining_time(), env=env
+            )
+            if mirror_path is not None:
+                mirrors[url] = mirror_path
+    config_args = []
+    if len(mirrors) > 0:
+        config_args += ["-c", "protocol.file.allow=always"]
+        for url, mirror_path in mirrors.items():
+            config_args += ["-c", f"url.{mirror_path}.insteadOf={url}"]
+    with submodule_cache.reading(mirrors.values()):
+        run_command(
+            ["git", *config_args, "submodule", "update", "--init"],
+            env=env,
+            cwd=repo_path,
+            timeout=remaining_time(),
+        )
+    for path, url, _ in submodules:
+        _update_submodules(
+            os.path.join(repo_path, path), url, submodule_cache, env, remaining_time
+        )
+
+
+def _resolve_commit(repo_path: str, revision: str) -> Optional[str]:
+    r"""Return the hash of the commit that a revision refers to, or ``None`` if the commit does not exist locally."""
+    result = run_command(
+        ["git", "rev-parse", "--verify", "-q", f"{revision}^{{commit}}"],
+        cwd=repo_path,
+        return_output=True,
+        ignore_errors=True,
+    )
+    if result.return_code != 0 or result.captured_output is None:
+        return None
+    return result.captured_output.decode("utf-8").strip()
+
+
+def _fetch_revision(
+    repo_path: str,
+    env: Dict[str, str],
+    remaining_time: Callable[[], Optional[float]],
+    commit: Optional[str] = None,
+    tag: Optional[str] = None,
+    branch: Optional[str] = None,
+    flags: Optional[List[str]] = None,
+) -> str:
+    r"""Fetch a single revision from the ``origin`` remote with a history depth of 1. The commit takes precedence over
+    the tag, which takes precedence over the branch. If none are specified, the default branch is fetched.
+
+    :return: The hash of the fetched commit.
+    """
+    if commit is not None:
+        refspec = commit
+    elif tag is not None:
+        refspec = f"+refs/tags/{tag}:refs/tags/{tag}"
+    elif branch is not None:
+        refspec = f"+refs/heads/{branch}:refs/remotes/origin/{branch}"
+    else:
+        refspec = "HEAD"
+    flags = flags or []
+    try:
+        run_command(
+            ["git", "fetch", "-q", "--depth=1", *flags, "origin", refspec],
+            env=env,
+            cwd=repo_path,
+            timeout=remaining_time(),
+        )
+        revision = "FETCH_HEAD"
+    except subprocess.CalledProcessError:
+        if commit is None:
+            raise
+        # Some servers refuse to serve commits that are not pointed to by any ref. Fetch the full history of all
+        # branches, and hope that the commit is reachable from one of them.
+        run_command(
+            ["git", "fetch", "-q", *flags, "origin"],
+            env=env,
+            cwd=repo_path,
+            timeout=remaining_time(),
+        )
+        revision = commit
+    # Raises `CalledProcessError` if the commit does not exist.
+    result = run_command(
+        ["git", "rev-parse", "--verify", f"{revision}^{{commit}}"],
+        cwd=repo_path,
+        return_output=True,
+    )
+    assert result.captured_output is not None
+    return result.captured_output.decode("utf-8").strip()
+
+
+def add_worktree(
+    repo_path: str,
+    worktree_path: str,
+    *,
+    commit: Optional[str] = None,
+    tag: Optional[str] = None,
+    branch: Optional[str] = None,
+    timeout: Optional[float] = None,
+    recursive: bool = False,
+    submodule_cache: Optional[SubmoduleCache] = None,
+) -> bool:
+    r"""Check out another revision of a cloned repository in a separate working tree (using ``git worktree``), so that
+    multiple revisions can be built from a single clone. The revision is fetched from the ``origin`` remote with a
+    history depth of 1, unless the commit already exists locally.
+
+    The working tree refers to the Git directory of the repository by absolute path, so the repository must not be
+    moved or deleted while the working tree is in use.
+
+    :param repo_path: Path to the cloned repository.
+    :param worktree_path: Path to the new working tree, which must not exist.
+    :param commit: Hash of the commit to check out. Takes precedence over ``tag`` and ``branch``.
+    :param tag: Name of the tag to check out. Takes precedence over ``branch``.
+    :param branch: Name of the branch to check out. If none of the revision arguments are specified, the default branch
+        of the remote is checked out.
+    :param timeout: Maximum time allowed for fetching and checking out, in seconds. Defaults to ``None`` (unlimited
+        time).
+    :param recursive: If ``True``, also check out submodules, as in :meth:`clone`.
+    :param submodule_cache: If not ``None``, submodules are cloned from local mirrors. See :meth:`clone` for details.
+    :return: ``False`` if submodules failed to check out, ``True`` otherwise. Other errors are raised as
+        :exc:`subprocess.CalledProcessError` or :exc:`subprocess.TimeoutExpired`.
+    """
+    start_time = time.time()
+    env = {"GIT_TERMINAL_PROMPT": "0"}
+
+    def remaining_time() -> Optional[float]:
+        return (timeout - (time.time() - start_time)) if timeout is not None else None
+
+    revision = _resolve_commit(repo_path, commit) if commit is not None else None
+    if revision is None:
+        revision = _fetch_revision(
+            repo_path, env, remaining_time, commit=commit, tag=tag, branch=branch
+        )
+    run_command(
+        [
+            "git",
+            "worktree",
+            "add",
+            "-q",
+            "--detach",
+            os.path.abspath(worktree_path),
+            revision,
+        ],
+        env=env,
+        cwd=repo_path,
+        timeout=remaining_time(),
+    )
+    if not recursive:
+        return True
+    try:
+        if submodule_cache is not None:
+            result = run_command(
+                ["git", "config", "remote.origin.url"],
+                cwd=repo_path,
+                return_output=True,
+            )
+            assert result.captured_output is not None
+            url = result.captured_output.decode("utf-8").strip()
+            _update_submodules(worktree_path, url, submodule_cache, env, remaining_time)
+        else:
+            run_command(
+                ["git", "submodule", "update", "--init", "--recursive"],
+                env=env,
+                cwd=worktree_path,
+                timeout=remaining_time(),
+            )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+    return True
+
+
+def remove_worktree(repo_path: str, worktree_path: str) -> None:
+    r"""Remove a working tree created by :meth:`add_worktree`. The working tree might have been deleted already.
+
+    :param repo_path: Path to the cloned repository.
+    :param worktree_path: Path to the working tree.
+    """
+    shutil.rmtree(worktree_path, ignore_errors=True)
+    run_command(["git", "worktree", "prune"], cwd=repo_path, ignore_errors=True)
+
+
+def _clone_error_result(
+    repo_owner: str, repo_name: str, e: subprocess.CalledProcessError
+) -> CloneResult:
+    no_ssh_expected_msg = b"fatal: could not read Username for 'https://github.com': terminal prompts disabled"
+    ssh_expected_msg = b"remote: Repository not found."
+    if e.output is not None and (
+        no_ssh_expected_msg in e.output or ssh_expected_msg in e.output
+    ):
+        return CloneResult(
+            repo_owner, repo_name, error_type=CloneErrorType.PrivateOrNonexistent
+        )
+    else:
+        return CloneResult(
+            repo_owner,
+            repo_name,
+            error_type=CloneErrorType.Unknown,
+            captured_output=e.output,
+        )
+
+
 def clone(
     repo_owner: str,
     repo_name: str,
@@ -57,9 +595,15 @@ def clone(
     folder_name: Optional[str] = None,
     *,
     default_branch: Optional[str] = None,
+    commit: Optional[str] = None,
+    tag: Optional[str] = None,
     timeout: Optional[float] = None,
     recursive: bool = False,
     skip_if_exists: bool = True,
+    probe: bool = False,
+    url: Optional[str] = None,
+    object_cache: Optional[ObjectCache] = None,
+    submodule_cache: Optional[SubmoduleCache] = None,
 ) -> CloneResult:
     r"""Clone a repository on GitHub, for instance, ``torvalds/linux``.
 
@@ -67,30 +611,39 @@ def clone(
     :param repo_name: Name of the repository, e.g., ``linux``.
     :param clone_folder: Path to the folder where the repository will be stored.
     :param folder_name: Name of the folder of the cloned repository. If ``None``, ``repo_owner/repo_name`` is used.
-    :param default_branch: Name of the default branch of the repository. Cloning behavior differs slightly depending on
-        whether the argument is ``None``. If ``None``, then the following happens:
-
-        1. Attempts a shallow clone on only the ``master`` branch.
-        2. If error occurs, attempts a shallow clone for all branches.
-        3. If error still occurs, raise the error.
-
-        If not ``None``, then the following happens:
-
-        1. Attempts a shallow clone on only the default branch.
-        2. If error occurs, raise the error.
+    :param default_branch: Name of the branch to clone. If ``None``, the default branch of the remote (i.e., the
+        branch that ``HEAD`` points to) is cloned.
+    :param commit: If not ``None``, the hash of the commit to check out. Only the specified commit is fetched, unless
+        the server refuses to serve it, in which case the full history of all branches is fetched. Takes precedence
+        over ``default_branch`` and ``tag``.
+    :param tag: If not ``None``, the name of the tag to check out. Only the tagged commit is fetched. Takes precedence
+        over ``default_branch``.
     :param timeout: Maximum time allowed for cloning, in seconds. Defaults to ``None`` (unlimited time).
     :param recursive: If ``True``, passes the ``--recursive`` flag to Git, which recursively clones submodules.
     :param skip_if_exists: Whether to skip cloning if the destination folder already exists. If ``False``, the folder
         will be deleted.
+    :param probe: If ``True``, only the tree of the repository is fetched first (a blobless clone). File contents are
+        fetched only if the repository contains both a build file (Makefile, ``CMakeLists.txt``, or configure script)
+        and C source files. Otherwise, the clone is deleted and the result has error type
+        :attr:`CloneErrorType.NotCRepository`.
+    :param url: The URL of the remote to clone from. If ``None``, the GitHub URL for the repository is used. This can
+        also be a local ``file://`` URL.
+    :param object_cache: If not ``None``, objects already in the cache (e.g., from other forks of the same project)
+        are not downloaded again, and objects of the cloned repository are added to the cache.
+    :param submodule_cache: If not ``None`` and ``recursive`` is ``True``, submodules are cloned from local mirrors in
+        the cache, which are downloaded only when a submodule is first seen or when a required commit is missing.
 
     :return: An instance of :class:`CloneResult` indicating the result. Fields ``repo_owner``, ``repo_name``, and
         ``success`` are not ``None``.
 
         - If cloning succeeded, the field ``time`` is also not ``None``.
         - If cloning failed, the fields ``error_type`` and ``captured_output`` are also not ``None``.
+        - If the repository is rejected in probe mode, ``success`` is ``True`` (since the repository exists), but the
+          field ``error_type`` is also not ``None``, and the folder is deleted.
     """
     start_time = time.time()
-    url = f"https://github.com/{repo_owner}/{repo_name}.git"
+    if url is None:
+        url = f"https://github.com/{repo_owner}/{repo_name}.git"
     if folder_name is None:
         folder_name = f"{repo_owner}/{repo_name}"
     clone_folder = os.path.join(clone_folder, folder_name)
@@ -108,58 +661,201 @@ def clone(
     # and see if it's waiting for IO.
     # See: https://askubuntu.com/questions/19442/what-is-the-waiting-channel-of-a-process
     env = {"GIT_TERMINAL_PROMPT": "0"}
+    # In probe mode, only fetch commits and trees. Blobs are fetched on checkout.
+    filter_flags = ["--filter=blob:none"] if probe else []
+
+    def remaining_time() -> Optional[float]:
+        return (timeout - (time.time() - start_time)) if timeout is not None else None
 
-    def try_clone():
+    def try_clone(reference_path: Optional[str] = None):
         # If a true git error was thrown, re-raise it and let the outer code deal with it.
-        try:
-            try_branch = default_branch or "master"
-            # Try cloning only 'master' branch, but it's possible there's no branch named 'master'.
+        if commit is not None or tag is not None:
+            try:
+                fetch_revision(reference_path)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                # Unlike `git clone`, the folder is not removed on failure.
+                shutil.rmtree(clone_folder, ignore_errors=True)
+                raise
+            return
+        clone_flags = [*filter_flags]
+        if probe:
+            clone_flags.append("--no-checkout")
+        if default_branch is not None:
+            clone_flags += [f"--branch={default_branch}", "--single-branch"]
+        if reference_path is not None:
+            # Copy borrowed objects into the clone, so it does not depend on the cache.
+            clone_flags += ["--reference-if-able", reference_path, "--dissociate"]
+        run_command(
+            ["git", "clone", "--depth=1", *clone_flags, url, clone_folder],
+            env=env,
+            timeout=timeout,
+        )
+
+    def fetch_revision(reference_path: Optional[str] = None):
+        # `git clone` can only check out branches or tags, so fetch the exact revision into an empty repository.
+        os.makedirs(clone_folder)
+        run_command(["git", "init", "-q"], cwd=clone_folder)
+        run_command(["git", "remote", "add", "origin", url], cwd=clone_folder)
+        alternates_path = os.path.join(
+            clone_folder, ".git", "objects", "info", "alternates"
+        )
+        if reference_path is not None:
+            # Equivalent to `git clone --reference`.
+            with open(alternates_path, "w") as f:
+                f.write(os.path.join(reference_path, "objects") + "\n")
+        revision = _fetch_revision(
+            clone_folder,
+            env,
+            remaining_time,
+            commit=commit,
+            tag=tag,
+            flags=filter_flags,
+        )
+        run_command(
+            ["git", "update-ref", "--no-deref", "HEAD", revision], cwd=clone_folder
+        )
+        if reference_path is not None:
+            # Equivalent to `git clone --dissociate`.
             run_command(
-                [
-                    "git",
-                    "clone",
-                    "--depth=1",
-                    f"--branch={try_branch}",
-                    "--single-branch",
-                    url,
-                    clone_folder,
-                ],
+                ["git", "repack", "-a", "-d", "-q"],
+                cwd=clone_folder,
+                timeout=remaining_time(),
+            )
+            os.remove(alternates_path)
+        if not probe:
+            run_command(
+                ["git", "checkout", "-q"],
                 env=env,
-                timeout=timeout,
+                cwd=clone_folder,
+                timeout=remaining_time(),
             )
-            return
-        except subprocess.CalledProcessError as err:
-            expected_msg = b"fatal: Remote branch master not found in upstream origin"
-            if default_branch is not None or not (
-                err.output is not None and expected_msg in err.output
-            ):
-                # If `default_branch` is specified, always re-raise the exception.
-                raise err
-        # 'master' branch doesn't exist; do a shallow clone of all branches.
+
+    def try_checkout() -> bool:
+        # List files from the fetched trees, and check out (which fetches blobs) only if the repository looks useful.
+        result = run_command(
+            ["git", "ls-tree", "-r", "-z", "--name-only", "HEAD"],
+            cwd=clone_folder,
+            timeout=remaining_time(),
+            return_output=True,
+        )
+        assert result.captured_output is not None
+        files = result.captured_output.decode("utf-8", errors="replace").split("\0")
+        if not _is_c_repository(files):
+            return False
         run_command(
-            ["git", "clone", "--depth=1", url, clone_folder], env=env, timeout=timeout
+            ["git", "checkout"], env=env, cwd=clone_folder, timeout=remaining_time()
         )
+        return True
 
     try:
-        try_clone()
+        if object_cache is not None:
+            cache_key = object_cache.get_key(repo_owner, repo_name)
+            with object_cache.reference(cache_key) as reference_path:
+                try_clone(reference_path)
+        else:
+            try_clone()
+        if probe and not try_checkout():
+            shutil.rmtree(clone_folder)
+            return CloneResult(
+                repo_owner,
+                repo_name,
+                success=True,
+                time=time.time() - start_time,
+                error_type=CloneErrorType.NotCRepository,
+            )
         end_time = time.time()
         elapsed_time = end_time - start_time
     except subprocess.CalledProcessError as e:
-        no_ssh_expected_msg = b"fatal: could not read Username for 'https://github.com': terminal prompts disabled"
-        ssh_expected_msg = b"remote: Repository not found."
-        if e.output is not None and (
-            no_ssh_expected_msg in e.output or ssh_expected_msg in e.output
-        ):
-            return CloneResult(
-                repo_owner, repo_name, error_type=CloneErrorType.PrivateOrNonexistent
-            )
-        else:
+        return _clone_error_result(repo_owner, repo_name, e)
+    except subprocess.TimeoutExpired as e:
+        return CloneResult(
+            repo_owner,
+            repo_name,
+            error_type=CloneErrorType.Timeout,
+            captured_output=e.output,
+        )
+    if object_cache is not None:
+        object_cache.update(
+            cache_key,
+            url,
+            f"{repo_owner}/{repo_name}",
+            timeout=remaining_time(),
+            env=env,
+        )
+
+    if recursive:
+        try:
+            # If this fails, still treat it as a success, but include a special error type.
+            if submodule_cache is not None:
+                _update_submodules(
+                    clone_folder,
+                    url,
+                    submodule_cache,
+                    env,
+                    remaining_time,
+                )
+            else:
+                run_command(
+                    ["git", "submodule", "update", "--init", "--recursive"],
+                    env=env,
+                    cwd=clone_folder,
+                    timeout=remaining_time(),
+                )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
             return CloneResult(
                 repo_owner,
                 repo_name,
-                error_type=CloneErrorType.Unknown,
+                success=True,
+                time=elapsed_time,
+                error_type=CloneErrorType.SubmodulesFailed,
                 captured_output=e.output,
             )
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+
+    return CloneResult(repo_owner, repo_name, success=True, time=elapsed_time)
+
+
+async def clone_async(
+    repo_owner: str,
+    repo_name: str,
+    clone_folder: str,
+    folder_name: Optional[str] = None,
+    *,
+    default_branch: Optional[str] = None,
+    timeout: Optional[float] = None,
+    recursive: bool = False,
+    url: Optional[str] = None,
+) -> CloneResult:
+    r"""An asynchronous counterpart of :meth:`clone`, which waits for Git on the running event loop instead of blocking
+    a thread. Only plain clones of a branch are supported, i.e., the ones that take a single ``git clone`` (plus
+    ``git submodule update`` if ``recursive`` is ``True``). Use :meth:`clone` for specific commits or tags, probe
+    clones, and caches.
+
+    The destination folder is always deleted if it exists. See :meth:`clone` for the description of arguments and the
+    return value.
+    """
+    start_time = time.time()
+    if url is None:
+        url = f"https://github.com/{repo_owner}/{repo_name}.git"
+    if folder_name is None:
+        folder_name = f"{repo_owner}/{repo_name}"
+    clone_folder = os.path.join(clone_folder, folder_name)
+    if os.path.exists(clone_folder):
+        shutil.rmtree(clone_folder)
+
+    env = {"GIT_TERMINAL_PROMPT": "0"}  # see :meth:`clone`
+    clone_flags = []
+    if default_branch is not None:
+        clone_flags += [f"--branch={default_branch}", "--single-branch"]
+    try:
+        await run_command_async(
+            ["git", "clone", "--depth=1", *clone_flags, url, clone_folder],
+            env=env,
+            timeout=timeout,
+        )
+    except subprocess.CalledProcessError as e:
+        return _clone_error_result(repo_owner, repo_name, e)
     except subprocess.TimeoutExpired as e:
         return CloneResult(
             repo_owner,
@@ -167,16 +863,15 @@ def clone(
             error_type=CloneErrorType.Timeout,
             captured_output=e.output,
         )
+    elapsed_time = time.time() - start_time
 
     if recursive:
-        submodule_timeout = (timeout - elapsed_time) if timeout is not None else None
         try:
-            # If this fails, still treat it as a success, but include a special error type.
-            run_command(
+            await run_command_async(
                 ["git", "submodule", "update", "--init", "--recursive"],
                 env=env,
                 cwd=clone_folder,
-                timeout=submodule_timeout,
+                timeout=(timeout - elapsed_time) if timeout is not None else None,
             )
         except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
             return CloneResult(
@@ -187,7 +882,6 @@ def clone(
                 error_type=CloneErrorType.SubmodulesFailed,
                 captured_output=e.output,
             )
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+        elapsed_time = time.time() - start_time
 
     return CloneResult(repo_owner, repo_name, success=True, time=elapsed_time)
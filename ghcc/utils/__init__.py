@@ -1 +1,7 @@
+from .async_command import *
+from .deletion import *
 from .docker import *
+from .job_pool import *
+from .pipeline import *
+from .json_stream import *
+from .metrics import *
@@ -0,0 +1,74 @@
+import asyncio
+import subprocess
+import tempfile
+from typing import Dict, List, Optional
+
+from flutes.run import CommandResult, error_wrapper
+
+__all__ = [
+    "run_command_async",
+]
+
+MAX_OUTPUT_LENGTH = 8192
+
+
+async def run_command_async(
+    args: List[str],
+    *,
+    env: Optional[Dict[str, str]] = None,
+    cwd: Optional[str] = None,
+    timeout: Optional[float] = None,
+    return_output: bool = False,
+    ignore_errors: bool = False,
+) -> CommandResult:
+    r"""An asynchronous counterpart of :meth:`flutes.run_command`, which waits for the command on the running event
+    loop instead of blocking a thread. Arguments, return values, and exceptions are the same as
+    :meth:`flutes.run_command`, except that shell commands are not supported.
+
+    :param args: The command to run, as a list of `str`.
+    :param env: Environment variables to set before running the command. Defaults to None.
+    :param cwd: The working directory of the command to run. If None, uses the default (probably user home).
+    :param timeout: Maximum running time for the command. If running time exceeds the specified limit, the command is
+        killed and ``subprocess.TimeoutExpired`` is thrown.
+    :param return_output: If ``True``, the captured output is returned. Otherwise, the return code is returned.
+    :param ignore_errors: If ``True``, exceptions will not be raised. A special return code of -32768 indicates a
+        ``subprocess.TimeoutExpired`` error.
+    :return: An instance of :class:`flutes.CommandResult`.
+    """
+    # Output is redirected into a temporary file, same as `flutes.run_command`, so the pipe never fills up.
+    with tempfile.TemporaryFile() as f:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=f, stderr=subprocess.STDOUT, env=env, cwd=cwd
+        )
+        error: Optional[subprocess.SubprocessError] = None
+        try:
+            return_code = await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            assert timeout is not None
+            error = subprocess.TimeoutExpired(args, timeout)
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        else:
+            if return_code != 0:
+                error = subprocess.CalledProcessError(return_code, args)
+        if error is None and not return_output:
+            return CommandResult(args, return_code, None)
+        f.seek(0)
+        output = f.read()
+    if error is None:
+        return CommandResult(args, return_code, output)
+    if len(output) > MAX_OUTPUT_LENGTH:  # truncate if longer than 8192 characters
+        output = b"*** (previous output truncated) ***\n" + output[-MAX_OUTPUT_LENGTH:]
+    if ignore_errors:
+        return_code = (
+            error.returncode
+            if isinstance(error, subprocess.CalledProcessError)
+            else -32768
+        )
+        return CommandResult(args, return_code, output)
+    error.output = output
+    raise error_wrapper(error) from None
@@ -0,0 +1,231 @@
+import functools
+import os
+import stat
+import subprocess
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from flutes.log import log
+
+from .docker import run_docker_command
+
+__all__ = [
+    "parallel_rmtree",
+    "docker_rmtree",
+    "DeletionQueue",
+]
+
+
+def _retry_with_permission(fn: Callable[[], Any], directory: str) -> None:
+    # Files cannot be removed from (or listed in) directories without write (or read) permission. Such directories are
+    # sometimes created by build scripts. Grant the permissions and try again; this only works for our own files.
+    try:
+        fn()
+    except PermissionError:
+        os.chmod(directory, stat.S_IRWXU)
+        fn()
+
+
+def parallel_rmtree(path: str, num_threads: int = 8) -> List[str]:
+    r"""Delete a directory tree using multiple threads. Directories are listed and their files are removed in
+    parallel, and the emptied directories are then removed bottom-up. This is much faster than :meth:`shutil.rmtree`
+    for large trees, as deletion is bound by the latency of file system calls.
+
+    Symlinks are removed but not followed. Files that cannot be removed (e.g., files created by other users inside
+    Docker containers) are skipped, see :meth:`docker_rmtree`.
+
+    :param path: Path to the directory tree.
+    :param num_threads: Number of threads used for deletion.
+    :return: A list of paths that could not be removed. The list is empty if the tree was deleted completely.
+    """
+    if not os.path.lexists(path):
+        return []
+    if os.path.islink(path) or not os.path.isdir(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return [path]
+        return []
+
+    failed: List[str] = []  # `list.append` is thread-safe
+
+    def clear_directory(directory: str) -> List[str]:
+        # Remove files in the directory, and return its subdirectories.
+        entries: List[os.DirEntry] = []
+
+        def scan() -> None:
+            with os.scandir(directory) as it:
+                entries.extend(it)
+
+        try:
+            _retry_with_permission(scan, directory)
+        except FileNotFoundError:
+            return []
+        except OSError:
+            failed.append(directory)
+            return []
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    _retry_with_permission(
+                        functools.partial(os.remove, entry.path), directory
+                    )
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed.append(entry.path)
+        return subdirs
+
+    directories = [path]  # parents always come before their subdirectories
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = {executor.submit(clear_directory, path)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    directories.append(subdir)
+                    pending.add(executor.submit(clear_directory, subdir))
+    for directory in reversed(directories):
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            failed.append(directory)
+    return failed
+
+
+def docker_rmtree(path: str) -> None:
+    r"""Delete a directory tree as root inside a Docker container. This is required for files created by other users
+    inside containers, which cannot be removed otherwise.
+
+    :param path: Path to the directory tree.
+    """
+    parent, name = os.path.split(os.path.abspath(path))
+    run_docker_command(
+        ["rm", "-rf", f"/usr/src/{name}"],
+        user=0,
+        directory_mapping={parent: "/usr/src"},
+    )
+
+
+def _delete_tree(path: str, num_threads: int) -> None:
+    if len(parallel_rmtree(path, num_threads)) > 0:
+        try:
+            docker_rmtree(path)
+        except subprocess.CalledProcessError as e:
+            log(f"Failed to delete '{path}'. Captured output: '{e.output}'", "error")
+
+
+class DeletionQueue:
+    r"""Deletes directory trees in the background, so that workers are not blocked by deleting large repositories.
+
+    Trees are queued for deletion by renaming them into a trash folder, which is instantaneous as long as the trash
+    folder is on the same file system. Since the queue lives on the file system, trees can be queued from any process
+    (e.g., pool workers that received the queue as an argument). Trees in the trash folder are deleted in parallel by
+    background threads in the process that called :meth:`start`, and trees left over from previous runs are deleted
+    as well. If the backlog in the trash folder exceeds the limit, :meth:`delete` falls back to deleting the tree
+    synchronously, so deletion never falls behind indefinitely.
+    """
+
+    def __init__(
+        self,
+        trash_folder: str,
+        num_threads: int = 8,
+        max_backlog: Optional[int] = 64,
+        poll_interval: float = 1.0,
+    ):
+        r"""
+        :param trash_folder: Path to the trash folder. It should be on the same file system as the deleted trees.
+        :param num_threads: Number of threads used for deletion, both in the background and for synchronous deletion.
+        :param max_backlog: Maximum number of trees waiting in the trash folder, or ``None`` for no limit.
+        :param poll_interval: Time (in seconds) between checks for new trees in the trash folder.
+        """
+        self.trash_folder = os.path.abspath(trash_folder)
+        self.num_threads = num_threads
+        self.max_backlog = max_backlog
+        self.poll_interval = poll_interval
+        os.makedirs(self.trash_folder, exist_ok=True)
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Only the configuration is sent to other processes, which can queue trees but don't delete them.
+        state = self.__dict__.copy()
+        del state["_closed"], state["_thread"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._closed = threading.Event()
+        self._thread = None
+
+    def backlog(self) -> int:
+        r"""Return the number of trees waiting in the trash folder."""
+        return len(os.listdir(self.trash_folder))
+
+    def _move_to_trash(self, path: str) -> bool:
+        name = f"{os.path.basename(os.path.normpath(path))}.{uuid.uuid4().hex}"
+        try:
+            os.rename(path, os.path.join(self.trash_folder, name))
+        except FileNotFoundError:
+            pass  # the tree no longer exists
+        except OSError:
+            return False  # e.g., the trash folder is on a different file system
+        return True
+
+    def delete(self, path: str) -> None:
+        r"""Queue a directory tree for deletion. The tree is removed from its original location when this method
+        returns, either by moving it to the trash folder, or by deleting it synchronously if the backlog is full.
+
+        :param path: Path to the directory tree.
+        """
+        if self.max_backlog is not None and self.backlog() >= self.max_backlog:
+            _delete_tree(path, self.num_threads)
+        elif not self._move_to_trash(path):
+            _delete_tree(path, self.num_threads)
+
+    def clear(self, folder: str) -> None:
+        r"""Queue all contents of a folder for deletion, regardless of the backlog limit. The trash folder is skipped if
+        it is inside the folder.
+
+        :param folder: Path to the folder.
+        """
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.abspath(path) == self.trash_folder:
+                continue
+            if not self._move_to_trash(path):
+                _delete_tree(path, self.num_threads)
+
+    def start(self) -> None:
+        r"""Start deleting trees in the trash folder in the background."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._delete_periodically, daemon=True)
+        self._thread.start()
+
+    def _delete_trash(self) -> None:
+        for name in os.listdir(self.trash_folder):
+            _delete_tree(os.path.join(self.trash_folder, name), self.num_threads)
+
+    def _delete_periodically(self) -> None:
+        while True:
+            self._delete_trash()
+            if self._closed.wait(self.poll_interval):
+                break
+
+    def close(self) -> None:
+        r"""Stop the background thread, after deleting all trees in the trash folder."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._delete_trash()
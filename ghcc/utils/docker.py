@@ -8,6 +8,7 @@ from flutes.log import log
 from flutes.run import CommandResult, error_wrapper, run_command
 
 __all__ = [
+    "get_docker_image_id",
     "run_docker_command",
     "verify_docker_image",
 ]
@@ -74,6 +75,16 @@ def run_docker_command(
     return ret
 
 
+def get_docker_image_id() -> str:
+    r"""Return the ID of the ``gcc-custom`` Docker image, which changes whenever the image is rebuilt."""
+    output = run_command(
+        ["docker", "image", "inspect", "gcc-custom", "--format", "{{.Id}}"],
+        return_output=True,
+    ).captured_output
+    assert output is not None
+    return output.decode("utf-8").strip()
+
+
 def verify_docker_image(
     verbose: bool = False, print_checked_paths: bool = False
 ) -> bool:
@@ -0,0 +1,80 @@
+import contextlib
+import fcntl
+import os
+import random
+from typing import IO, Iterator, List, Optional
+
+__all__ = [
+    "JobTokenPool",
+]
+
+
+class JobTokenPool:
+    r"""A pool of tokens for parallel ``make`` jobs, shared by builds in all processes and Docker containers on the
+    host. This plays the role of the GNU Make jobserver, but across builds instead of within a build.
+
+    Each build runs one job without a token. Before running ``make``, a build takes as many extra tokens as are free
+    (up to ``max_jobs - 1``), and runs ``make -j<1 + tokens>``. Tokens are returned when the build finishes, so idle
+    cores go to whichever builds start next. With ``N`` concurrent builds, at most ``N + num_tokens`` jobs run at the
+    same time.
+
+    Tokens are files in the pool folder, and a token is taken by locking its file with ``flock``. Locks are released by
+    the OS when a process dies, so tokens never leak when builds are killed on timeout. The pool folder can be mapped
+    into Docker containers, as locks on bind-mounted files are shared with the host.
+    """
+
+    def __init__(
+        self, pool_folder: str, num_tokens: Optional[int] = None, max_jobs: int = 1
+    ):
+        r"""
+        :param pool_folder: Path to the folder storing token files.
+        :param num_tokens: Number of tokens in the pool. If not ``None``, the pool folder is (re)created with the
+            specified number of tokens; this should only be done by the process that owns the pool. Otherwise, the pool
+            folder must already exist.
+        :param max_jobs: Maximum number of parallel jobs for each build, including the job without a token.
+        """
+        self.pool_folder = os.path.abspath(pool_folder)
+        self.max_jobs = max_jobs
+        if num_tokens is not None:
+            os.makedirs(self.pool_folder, exist_ok=True)
+            for name in os.listdir(self.pool_folder):
+                os.remove(os.path.join(self.pool_folder, name))
+            for idx in range(num_tokens):
+                open(os.path.join(self.pool_folder, f"token-{idx}.lock"), "w").close()
+
+    def _token_paths(self) -> List[str]:
+        return [
+            os.path.join(self.pool_folder, name)
+            for name in os.listdir(self.pool_folder)
+            if name.endswith(".lock")
+        ]
+
+    @contextlib.contextmanager
+    def acquire(self, count: Optional[int] = None) -> Iterator[int]:
+        r"""Take free tokens from the pool without blocking, and return them when the context exits.
+
+        :param count: Maximum number of tokens to take. Defaults to ``max_jobs - 1``.
+        :return: A context manager yielding the number of tokens taken, which may be less than ``count``.
+        """
+        if count is None:
+            count = self.max_jobs - 1
+        files: List[IO] = []
+        try:
+            if count > 0:
+                paths = self._token_paths()
+                random.shuffle(paths)  # reduce contention between builds
+                for path in paths:
+                    f = open(path, "r")
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        f.close()
+                        continue
+                    files.append(f)
+                    if len(files) >= count:
+                        break
+            yield len(files)
+        finally:
+            for f in files:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
@@ -0,0 +1,111 @@
+import json
+from typing import Any, Iterator, List, Optional, TextIO
+
+__all__ = [
+    "iter_json_array",
+]
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    r"""A buffered view over a text stream, supporting incremental decoding of JSON values."""
+
+    def __init__(self, f: TextIO, buffer_size: int):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read_more(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.buffer_size)
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+        # Drop the consumed part of the buffer, so memory does not grow with file size.
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        r"""Skip whitespace and return the next character, or an empty string on EOF."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read_more():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(
+                f"Malformed JSON: expected one of {list(chars)}, but found {char!r}"
+            )
+        self.pos += 1
+        return char
+
+    def decode(self) -> Any:
+        r"""Decode the next JSON value, reading more data if the value is incomplete."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._read_more():
+                    continue
+                raise
+            # A number might continue in the next chunk, e.g. "1" followed by ".5e-3", in which case the decoded value is
+            # only a prefix.
+            if (
+                isinstance(value, (int, float))
+                and (end == len(self.buffer) or self.buffer[end] in ".eE+-")
+                and self._read_more()
+            ):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(
+    f: TextIO, path: Optional[List[str]] = None, buffer_size: int = 65536
+) -> Iterator[Any]:
+    r"""Incrementally parse a JSON array from a file, yielding its elements one at a time. Only one element is kept in
+    memory at any time, so this works for files that are much larger than the available memory.
+
+    Values preceding the array are parsed and discarded; contents following the array are not read.
+
+    :param f: The file to read from.
+    :param path: The list of object keys leading to the array, e.g. ``["repos"]`` for ``{"repos": [...]}``. If
+        ``None``, the top-level value must be an array.
+    :param buffer_size: Number of characters to read at a time.
+    :return: An iterator over elements of the array.
+    """
+    reader = _Reader(f, buffer_size)
+    for key in path or []:
+        reader.expect("{")
+        found = False
+        if reader.peek() != "}":
+            while True:
+                cur_key = reader.decode()
+                reader.expect(":")
+                if cur_key == key:
+                    found = True
+                    break
+                reader.decode()  # skip the value
+                if reader.expect(",}") == "}":
+                    break
+        if not found:
+            raise ValueError(f"Key {key!r} not found in JSON object")
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+    while True:
+        yield reader.decode()
+        if reader.expect(",]") == "]":
+            break
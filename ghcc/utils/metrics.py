@@ -0,0 +1,260 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "MetricsServer",
+]
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+    900.0,
+    1800.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+        + "}"
+    )
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name: str
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(
+                f"Metric '{self.name}' expects labels {list(self.label_names)}, "
+                f"but got {list(labels.keys())}"
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        r"""Return a list of samples, each as a tuple of (name suffix, formatted labels, value)."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        with self._lock:
+            samples = self._samples()
+        for suffix, labels, value in samples:
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    r"""A monotonically increasing value, e.g. the number of processed items. Rates (such as items per second) are
+    derived from counters by the monitoring system."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        return [
+            ("", _format_labels(self.label_names, key), value)
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    r"""A value that can go up and down, e.g. the length of a queue."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        return [
+            ("", _format_labels(self.label_names, key), value)
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    r"""Distribution of observed values (e.g. latencies), counted in cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        if "le" in self.label_names:
+            raise ValueError("Label name 'le' is reserved for histograms")
+        self.buckets = tuple(sorted(buckets))
+        # Non-cumulative counts, with an extra bucket for +Inf.
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._counts:
+                self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            self._counts[key][index] += 1
+            self._sums[key] += value
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.label_names + ("le",), key + (_format_value(bound),)
+                )
+                samples.append(("_bucket", labels, cumulative))
+            labels = _format_labels(self.label_names, key)
+            samples.append(("_sum", labels, self._sums[key]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    r"""A collection of metrics that can be rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collect_hooks: List[Callable[[], None]] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if any(existing.name == metric.name for existing in self._metrics):
+            raise ValueError(f"Metric '{metric.name}' already exists")
+        self._metrics.append(metric)
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> Counter:
+        return self._register(Counter(name, documentation, labels))  # type: ignore[return-value]
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))  # type: ignore[return-value]
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))  # type: ignore[return-value]
+
+    def add_collect_hook(self, fn: Callable[[], None]) -> None:
+        r"""Register a function to be called before metrics are rendered. This can be used to update gauges whose
+        values are cheap to read, but not worth tracking continuously (e.g. queue lengths).
+        """
+        self._collect_hooks.append(fn)
+
+    def render(self) -> str:
+        for fn in self._collect_hooks:
+            fn()
+        return "".join(metric.render() for metric in self._metrics)
+
+
+class MetricsServer:
+    r"""An HTTP server running in a background thread that serves metrics from a registry at ``/metrics``."""
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1"):
+        r"""
+        :param registry: The registry containing metrics to serve.
+        :param port: The port to listen on. Use 0 to pick an arbitrary free port, which is stored in :attr:`port`.
+        :param host: The address to bind to. Defaults to ``127.0.0.1``, i.e., metrics are only accessible locally.
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass  # don't pollute the logs with scrape requests
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port: int = self._server.server_address[1]
+        self._thread: Optional[threading.Thread] = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._thread = None
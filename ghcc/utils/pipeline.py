@@ -0,0 +1,289 @@
+import asyncio
+import inspect
+import multiprocessing as mp
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+from flutes.exception import log_exception
+
+__all__ = [
+    "Stage",
+    "StagedExecutor",
+    "AsyncStagedExecutor",
+]
+
+
+class Stage(NamedTuple):
+    name: str
+    fn: Callable[[Any], Any]  # the function to run on each item
+    num_workers: int = 1  # number of worker processes dedicated to this stage
+
+
+class _Stop:
+    r"""Marker sent through the queues to signal the end of input."""
+
+
+def _stage_worker(
+    stage: Stage,
+    in_queue: "mp.Queue[Any]",
+    next_queue: "Optional[mp.Queue[Any]]",
+    out_queue: "mp.Queue[Any]",
+    is_final: Callable[[Any], bool],
+    num_busy: "mp.Value[int]",
+) -> None:
+    while True:
+        item = in_queue.get()
+        if isinstance(item, _Stop):
+            break
+        with num_busy.get_lock():
+            num_busy.value += 1
+        try:
+            result = stage.fn(item)
+        except Exception as e:
+            # Stage functions are expected to handle their own exceptions. Don't let the worker die because of it.
+            log_exception(e, f"Uncaught exception in stage '{stage.name}'")
+            result = None
+        finally:
+            with num_busy.get_lock():
+                num_busy.value -= 1
+        if next_queue is None or is_final(result):
+            out_queue.put(result)
+        else:
+            next_queue.put(result)
+
+
+class StagedExecutor:
+    r"""Run items through a sequence of stages, where each stage has its own pool of worker processes. Stages are
+    connected by bounded queues, so a slow stage applies back-pressure to the stages before it, while stages that wait
+    on different resources (network, CPU, disk) overlap.
+
+    Each stage function takes an item and returns either the input for the next stage, or a final result. Final results
+    (as determined by ``is_final``) and outputs of the last stage are yielded by :meth:`run` in completion order.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        is_final: Callable[[Any], bool],
+        queue_size: int = 16,
+    ):
+        r"""
+        :param stages: The list of stages, in order of execution.
+        :param is_final: A function that determines whether the output of a stage ends processing for the item. This
+            is not called on outputs of the last stage.
+        :param queue_size: Maximum number of items waiting in the queue before each stage.
+        """
+        if len(stages) == 0:
+            raise ValueError("At least one stage must be specified")
+        if any(stage.num_workers <= 0 for stage in stages):
+            raise ValueError("Each stage must have at least one worker")
+        self.stages = stages
+        self.is_final = is_final
+        self.queue_size = queue_size
+        self._queues: List["mp.Queue[Any]"] = []
+        self._num_busy: List["mp.Value[int]"] = []
+
+    def queue_sizes(self) -> List[int]:
+        r"""Return the (approximate) number of items waiting before each stage."""
+        return [queue.qsize() for queue in self._queues]
+
+    def busy_workers(self) -> List[int]:
+        r"""Return the number of workers currently running the stage function, for each stage."""
+        return [num_busy.value for num_busy in self._num_busy]
+
+    def run(self, iterable: Iterable[Any]) -> Iterator[Any]:
+        r"""Feed the items through all stages and yield the results in completion order."""
+        self._queues = [mp.Queue(maxsize=self.queue_size) for _ in self.stages]
+        self._num_busy = [mp.Value("i", 0) for _ in self.stages]
+        out_queue: "mp.Queue[Any]" = mp.Queue()
+        workers: List[List[mp.Process]] = []
+        for idx, stage in enumerate(self.stages):
+            next_queue = self._queues[idx + 1] if idx + 1 < len(self.stages) else None
+            processes = [
+                mp.Process(
+                    target=_stage_worker,
+                    args=(
+                        stage,
+                        self._queues[idx],
+                        next_queue,
+                        out_queue,
+                        self.is_final,
+                        self._num_busy[idx],
+                    ),
+                )
+                for _ in range(stage.num_workers)
+            ]
+            for process in processes:
+                process.start()
+            workers.append(processes)
+
+        def feed() -> None:
+            try:
+                for item in iterable:
+                    self._queues[0].put(item)
+            except Exception as e:
+                log_exception(
+                    e, "Exception occurred when reading input items, stopping early"
+                )
+            # Shut down the stages in order. A stage is stopped only after all workers of the previous stage exit, so
+            # no items are left behind in the queues.
+            for stage_queue, processes in zip(self._queues, workers):
+                for _ in processes:
+                    stage_queue.put(_Stop())
+                for process in processes:
+                    process.join()
+            out_queue.put(_Stop())
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                result = out_queue.get()
+                if isinstance(result, _Stop):
+                    break
+                yield result
+            feeder.join()
+        finally:
+            for processes in workers:
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+
+
+class AsyncStagedExecutor:
+    r"""An event loop based counterpart of :class:`StagedExecutor` that runs all stages within a single process.
+
+    Each item is driven through the stages by a coroutine on one event loop. Concurrency of each stage is capped by its
+    own semaphore (``num_workers`` of the stage), so a large number of concurrent clones does not increase the number
+    of concurrent compilations.
+
+    Stage functions can be coroutine functions, which are awaited on the event loop. Such stages should wait on child
+    processes with :meth:`ghcc.utils.run_command_async`, and offload other blocking work to the default executor of the
+    loop (e.g., with ``loop.run_in_executor(None, fn)``). A concurrency slot of these stages only costs a coroutine, so
+    they can have hundreds of workers. Other stage functions are dispatched to a thread pool with one thread per
+    worker, where blocking waits on child processes release the GIL.
+
+    The interface is the same as :class:`StagedExecutor`.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        is_final: Callable[[Any], bool],
+        queue_size: int = 16,
+    ):
+        r"""
+        :param stages: The list of stages, in order of execution.
+        :param is_final: A function that determines whether the output of a stage ends processing for the item. This
+            is not called on outputs of the last stage.
+        :param queue_size: Maximum number of items waiting before the first stage, in addition to the items being
+            processed.
+        """
+        if len(stages) == 0:
+            raise ValueError("At least one stage must be specified")
+        if any(stage.num_workers <= 0 for stage in stages):
+            raise ValueError("Each stage must have at least one worker")
+        self.stages = stages
+        self.is_final = is_final
+        self.queue_size = queue_size
+        self._waiting = [0] * len(stages)
+        self._num_busy = [0] * len(stages)
+
+    def queue_sizes(self) -> List[int]:
+        r"""Return the number of items waiting before each stage."""
+        return list(self._waiting)
+
+    def busy_workers(self) -> List[int]:
+        r"""Return the number of items currently being processed by each stage."""
+        return list(self._num_busy)
+
+    async def _run(self, iterable: Iterable[Any], results: "queue.Queue[Any]") -> None:
+        loop = asyncio.get_running_loop()
+        semaphores = [asyncio.Semaphore(stage.num_workers) for stage in self.stages]
+        # Limit the number of items in flight, so the input is consumed lazily.
+        admission = asyncio.Semaphore(
+            sum(stage.num_workers for stage in self.stages) + self.queue_size
+        )
+        is_async = [inspect.iscoroutinefunction(stage.fn) for stage in self.stages]
+        # One thread for each worker of synchronous stages, plus threads for blocking work offloaded by asynchronous
+        # stages, and for reading the input.
+        num_threads = sum(
+            stage.num_workers
+            for stage, stage_is_async in zip(self.stages, is_async)
+            if not stage_is_async
+        )
+        if any(is_async):
+            num_threads += os.cpu_count() or 1
+        num_threads += 1
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            loop.set_default_executor(executor)
+
+            async def process(item: Any) -> None:
+                try:
+                    for idx, stage in enumerate(self.stages):
+                        self._waiting[idx] += 1
+                        async with semaphores[idx]:
+                            self._waiting[idx] -= 1
+                            self._num_busy[idx] += 1
+                            try:
+                                if is_async[idx]:
+                                    item = await stage.fn(item)
+                                else:
+                                    item = await loop.run_in_executor(
+                                        executor, stage.fn, item
+                                    )
+                            except Exception as e:
+                                log_exception(
+                                    e, f"Uncaught exception in stage '{stage.name}'"
+                                )
+                                item = None
+                            finally:
+                                self._num_busy[idx] -= 1
+                        if idx + 1 == len(self.stages) or self.is_final(item):
+                            break
+                    results.put(item)
+                finally:
+                    admission.release()
+
+            tasks = set()
+            iterator = iter(iterable)
+            while True:
+                await admission.acquire()
+                try:
+                    # Reading the input may block (e.g. on DB queries), so it's also done in the thread pool.
+                    item = await loop.run_in_executor(executor, next, iterator, _Stop())
+                except Exception as e:
+                    log_exception(
+                        e, "Exception occurred when reading input items, stopping early"
+                    )
+                    item = _Stop()
+                if isinstance(item, _Stop):
+                    admission.release()
+                    break
+                task = asyncio.ensure_future(process(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+
+    def run(self, iterable: Iterable[Any]) -> Iterator[Any]:
+        r"""Feed the items through all stages and yield the results in completion order."""
+        results: "queue.Queue[Any]" = queue.Queue()
+
+        def run_loop() -> None:
+            try:
+                asyncio.run(self._run(iterable, results))
+            finally:
+                results.put(_Stop())
+
+        thread = threading.Thread(target=run_loop, daemon=True)
+        thread.start()
+        while True:
+            result = results.get()
+            if isinstance(result, _Stop):
+                break
+            yield result
+        thread.join()
@@ -6,13 +6,33 @@ r"""Run the cloning--compilation pipeline. What happens is:
 4. Compilation products are cleaned and the repository is archived to save space.
 """
 
+import asyncio
+import contextlib
 import functools
+import hashlib
+import itertools
 import json
 import os
 from os.path import exists
 import shutil
+import statistics
 import subprocess
-from typing import Callable, Iterator, List, NamedTuple, Optional, Set
+import threading
+import time
+from enum import Enum, auto
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import argtyped
 import flutes
@@ -36,7 +56,10 @@ class Arguments(argtyped.Arguments):
     compile_timeout: Optional[int] = 900  # wait up to 15 minutes
     force_recompile: Switch = False
     docker_batch_compile: Switch = True
-    compression_type: Choices["gzip", "xz"] = "gzip"
+    compression_type: Choices["gzip", "xz", "zstd"] = "gzip"
+    compression_level: Optional[int] = None  # defaults to the compressor's default
+    compression_threads: int = 1  # for xz and zstd; 0 to use all cores
+    indexed_archives: Switch = False  # compress in chunks for partial extraction
     max_archive_size: Optional[int] = (
         100 * 1024 * 1024
     )  # only archive repos no larger than 100MB.
@@ -48,11 +71,43 @@ class Arguments(argtyped.Arguments):
         int
     ] = None  # maximum number of repositories to process (ignoring non-existent)
     recursive_clone: Switch = True  # if True, use `--recursive` when `git clone`
+    probe_clone: Switch = False  # if True, only fetch file contents for C repos
+    object_cache_folder: Optional[str] = None  # Git objects shared by forks, see README
+    object_cache_size: Optional[int] = None  # max object cache size in bytes
+    submodule_cache_folder: Optional[str] = None  # mirrors of submodule repos
     write_db: Switch = True  # only modify the DB when True
     record_metainfo: Switch = False  # if True, record a bunch of other stuff
     gcc_override_flags: Optional[
         str
     ] = None  # GCC flags to use during compilation, e.g. "-O2 -march=x86-64"
+    metrics_port: Optional[int] = None  # if specified, serve metrics on localhost
+    runner: Choices["pool", "staged", "async"] = "pool"  # see README for details
+    n_clone_procs: Optional[
+        int
+    ] = None  # concurrent clones for staged/async runners; defaults to `n_procs`
+    n_archive_procs: Optional[
+        int
+    ] = None  # concurrent archiving for staged/async runners; defaults to `n_procs // 4`
+    stage_queue_size: int = 16  # max number of repos waiting before each stage
+    schedule: Choices["list", "longest-first"] = "list"  # order of processing
+    group_revisions: Switch = True  # build all revisions of a repo from one clone
+    dedup_trees: Switch = True  # reuse binaries of identical trees built before
+    deletion_threads: int = 8  # 0 to delete repositories inline with `shutil.rmtree`
+    deletion_backlog: Optional[int] = 64  # max repos awaiting background deletion
+    make_jobs: int = 1  # max parallel `make` jobs per Makefile, see README
+    job_tokens: Optional[int] = None  # shared extra jobs; defaults to cores - n_procs
+    makefile_workers: int = 1  # independent Makefile dirs built concurrently per repo
+    plan_preview_size: int = 10000  # repos planned before the run starts, for the summary
+
+
+T = TypeVar("T")
+
+
+class RepoState(Enum):
+    Skip = auto()  # fully processed, or failed to clone before
+    Extract = auto()  # extract from the archive, then compile
+    Clone = auto()  # clone from GitHub, then compile
+    Recompile = auto()  # compile the existing folder under the clone folder
 
 
 class RepoInfo(NamedTuple):
@@ -63,6 +118,7 @@ class RepoInfo(NamedTuple):
     repo_commit_id: str
     repo_tag: str
     db_result: Optional[RepoDB.Entry]
+    state: Optional[RepoState] = None  # planned work, filled in by `plan_repos`
 
 
 class PipelineMetaInfo(TypedDict):
@@ -72,6 +128,41 @@ class PipelineMetaInfo(TypedDict):
     makefiles_using_automake: int  # how many Makefiles uses `automake`
 
 
+class RepoStats:
+    r"""Per-stage timings and I/O statistics of a repository, accumulated as it passes through the pipeline.
+
+    I/O is accounted logically, i.e., by the size of data each operation consumes and produces: extraction reads the
+    archive and writes the repository, cloning writes the repository, compilation writes the binaries, and archiving
+    reads the repository and writes the archive.
+    """
+
+    STAGES = [
+        "clone",
+        "extract",
+        "find_makefiles",
+        "cmake",
+        "compile",
+        "archive",
+        "cleanup",
+    ]
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}  # stage name -> time (seconds)
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        r"""Add the time spent within the ``with`` block to the specified stage. Time is recorded even if an exception
+        occurs."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed_time = time.time() - start_time
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed_time
+
+
 class PipelineResult(NamedTuple):
     repo_info: RepoInfo
     clone_success: Optional[bool] = None
@@ -79,6 +170,28 @@ class PipelineResult(NamedTuple):
     makefiles: Optional[List[RepoDB.MakefileEntry]] = None
     libraries: Optional[List[str]] = None
     meta_info: Optional[PipelineMetaInfo] = None
+    compile_time: Optional[float] = None  # time (seconds) spent on compilation
+    stats: Optional[RepoStats] = None
+    failure: Optional[str] = None  # type of failure, e.g. "clone_timeout"
+    tree_hash: Optional[str] = None  # hash of the compiled Git tree, if recorded
+
+
+class RepoWorkspace(NamedTuple):
+    r"""A cloned (or extracted) repository that is passed between stages of the pipeline."""
+    repo_info: RepoInfo
+    repo_path: str  # path to the repository under the clone folder
+    repo_size: int
+    clone_success: Optional[bool] = None
+    makefiles: Optional[List[RepoDB.MakefileEntry]] = None
+    libraries: Optional[List[str]] = None
+    meta_info: Optional[PipelineMetaInfo] = None
+    compile_time: Optional[float] = None
+    stats: Optional[RepoStats] = None
+    failure: Optional[str] = None
+    source_archive: Optional[str] = None  # archive the repository was extracted from
+    source_commit: Optional[str] = None  # commit checked out in the extracted archive
+    tree_hash: Optional[str] = None  # hash of the Git tree at HEAD, if recorded
+    build_index: Optional[ghcc.BuildIndex] = None  # build files found in the repository
 
 
 def contains_in_file(file_path: str, text: str) -> bool:
@@ -105,117 +218,264 @@ def exception_handler(e, repo_info: RepoInfo, _return: bool = False):
         return PipelineResult(repo_info, clone_success=False)
 
 
+def stage_exception_handler(e, workspace: RepoWorkspace):
+    return exception_handler(e, workspace.repo_info)
+
+
+def group_exception_handler(e, repo_infos: List[RepoInfo]):
+    exception_handler(e, repo_infos[0])
+    return [None] * len(repo_infos)
+
+
+def failure_type(stage: str, e: subprocess.SubprocessError) -> str:
+    r"""Return the failure type for an error raised by a command in the specified stage."""
+    if isinstance(e, subprocess.TimeoutExpired):
+        return f"{stage}_timeout"
+    return f"{stage}_failed"
+
+
+CLONE_FAILURE_TYPES = {
+    CloneErrorType.FolderExists: "clone_folder_exists",
+    CloneErrorType.Timeout: "clone_timeout",
+    CloneErrorType.PrivateOrNonexistent: "clone_private_or_nonexistent",
+    CloneErrorType.Unknown: "clone_failed",
+    CloneErrorType.NotCRepository: "not_c_repository",
+}
+
+
+def remove_repo(
+    repo_path: str, deletion_queue: Optional[ghcc.utils.DeletionQueue] = None
+) -> None:
+    r"""Remove a repository from the clone folder, in the background if a deletion queue is provided."""
+    if deletion_queue is not None:
+        deletion_queue.delete(repo_path)
+    else:
+        shutil.rmtree(repo_path)
+
+
+def plan_repo(
+    repo_info: RepoInfo,
+    clone_folder: str,
+    archive_folder: str,
+    force_reclone: bool = False,
+    force_recompile: bool = False,
+    compression_type: str = "gzip",
+) -> RepoState:
+    r"""Determine the work required for a repository, based on its DB entry and the files on disk.
+
+    See :meth:`clone_and_compile` for the description of arguments.
+    """
+    repo_entry = repo_info.db_result
+    # Skip repos that are fully processed.
+    if (
+        repo_entry is not None
+        and (repo_entry["clone_successful"] and not force_reclone)
+        and (repo_entry["compiled"] and not force_recompile)
+    ):
+        return RepoState.Skip
+    if not force_reclone and (
+        ghcc.find_archive(
+            archive_folder, repo_info.repo_owner, repo_info.repo_name, compression_type
+        )
+        is not None
+    ):
+        return RepoState.Extract
+    if repo_entry is None or force_reclone:  # not processed
+        return RepoState.Clone
+    if not repo_entry["clone_successful"]:
+        # Failed to clone before, don't bother retrying.
+        return RepoState.Skip
+    # Not compiled yet, or forced to recompile.
+    repo_folder_name = f"{repo_info.repo_owner}_____{repo_info.repo_name}"
+    if os.path.exists(os.path.join(clone_folder, repo_folder_name)):
+        return RepoState.Recompile
+    return RepoState.Clone
+
+
+def plan_repos(
+    repos: Iterator[RepoInfo],
+    clone_folder: str,
+    archive_folder: str,
+    force_reclone: bool = False,
+    force_recompile: bool = False,
+    compression_type: str = "gzip",
+    skip_fn: Optional[Callable[[RepoInfo], None]] = None,
+    plan_fn: Optional[Callable[[RepoState], None]] = None,
+) -> Iterator[RepoInfo]:
+    r"""Plan the work for repositories in the main process, so that repositories requiring no work are never
+    dispatched to workers. Repositories are planned lazily as the returned iterator is consumed, so work can be
+    dispatched before the entire list is planned.
+
+    See :meth:`clone_and_compile` for the description of arguments.
+
+    :param repos: An iterator over repositories to plan for.
+    :param skip_fn: If not ``None``, the function is called on each skipped repository.
+    :param plan_fn: If not ``None``, the function is called with the planned state of each repository, e.g., to count
+        repositories in each state.
+    :return: An iterator over repositories that require work, with the ``state`` field filled in.
+    """
+    for repo_info in repos:
+        state = plan_repo(
+            repo_info,
+            clone_folder,
+            archive_folder,
+            force_reclone=force_reclone,
+            force_recompile=force_recompile,
+            compression_type=compression_type,
+        )
+        if plan_fn is not None:
+            plan_fn(state)
+        if state is RepoState.Skip:
+            if skip_fn is not None:
+                skip_fn(repo_info)
+        else:
+            yield repo_info._replace(state=state)
+
+
+def estimate_costs(repos: List[RepoInfo]) -> List[float]:
+    r"""Estimate the time required to process each repository, based on records from previous runs in the DB.
+
+    Repositories with a recorded compilation time use the recorded value. For other repositories, the cost is
+    extrapolated from the number of Makefiles, or the repository size, using the average rate among repositories with
+    recorded times. Repositories without any information (e.g., unseen repositories) are assigned the median of known
+    costs.
+
+    :param repos: The list of repositories.
+    :return: A list of estimated costs (in seconds), one for each repository.
+    """
+    known_costs: List[float] = []
+    makefile_time, makefile_count = 0.0, 0
+    size_time, size_count = 0.0, 0
+    for repo_info in repos:
+        entry = repo_info.db_result
+        if entry is None or entry.get("compile_time", None) is None:
+            continue
+        compile_time = entry["compile_time"]
+        known_costs.append(compile_time)
+        if entry.get("num_makefiles", 0) > 0:
+            makefile_time += compile_time
+            makefile_count += entry["num_makefiles"]
+        if entry.get("repo_size", -1) > 0:
+            size_time += compile_time
+            size_count += entry["repo_size"]
+    default_cost = statistics.median(known_costs) if len(known_costs) > 0 else 0.0
+
+    costs = []
+    for repo_info in repos:
+        entry = repo_info.db_result
+        if entry is None:
+            cost = default_cost
+        elif entry.get("compile_time", None) is not None:
+            cost = entry["compile_time"]
+        elif entry.get("num_makefiles", 0) > 0 and makefile_count > 0:
+            cost = entry["num_makefiles"] * makefile_time / makefile_count
+        elif entry.get("repo_size", -1) > 0 and size_count > 0:
+            cost = entry["repo_size"] * size_time / size_count
+        else:
+            cost = default_cost
+        costs.append(cost)
+    return costs
+
+
 @flutes.exception_wrapper(exception_handler)
-def clone_and_compile(
+def prepare_repo(
     repo_info: RepoInfo,
     clone_folder: str,
-    binary_folder: str,
     archive_folder: str,
     recursive_clone: bool = True,
+    probe_clone: bool = False,
+    object_cache: Optional[ghcc.ObjectCache] = None,
+    submodule_cache: Optional[ghcc.SubmoduleCache] = None,
     clone_timeout: Optional[float] = None,
-    compile_timeout: Optional[float] = None,
     force_reclone: bool = False,
     force_recompile: bool = False,
-    docker_batch_compile: bool = True,
-    max_archive_size: Optional[int] = None,
     compression_type: str = "gzip",
-    record_libraries: bool = False,
-    record_metainfo: bool = False,
-    gcc_override_flags: Optional[str] = None,
-) -> PipelineResult:
-    r"""Perform the entire pipeline.
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
+    clone_result: Optional[ghcc.CloneResult] = None,
+    stats: Optional[RepoStats] = None,
+) -> Union[RepoWorkspace, PipelineResult]:
+    r"""Stage 1 of the pipeline: obtain the repository, either by extracting its archive or cloning from GitHub.
 
-    :param repo_info: Information about the repository.
-    :param clone_folder: Path to the folder where the repository will be stored. The actual destination folder will be
-        ``clone_folder/repo_owner_____repo_name``, e.g., ``clone_folder/torvalds_____linux``.
-        This strange notation is used in order to have a flat directory hierarchy, so we're not left with a bunch of
-        empty folders for repository owners.
-    :param binary_folder: Path to the folder where compiled binaries will be stored. The actual destination folder will
-        be ``binary_folder/repo_owner/repo_name``, e.g., ``binary_folder/torvalds/linux``.
-    :param archive_folder: Path to the folder where archived repositories will be stored. The actual archive file will
-        be ``archive_folder/repo_owner/repo_name.tar.xz``, e.g., ``archive_folder/torvalds/linux.tar.xz``.
+    See :meth:`clone_and_compile` for the description of arguments.
 
-    :param recursive_clone: If ``True``, uses ``--recursive`` when cloning.
-    :param clone_timeout: Timeout for cloning, or `None` (default) for unlimited time.
-    :param compile_timeout: Timeout for compilation, or `None` (default) for unlimited time.
-    :param force_reclone: If ``True``, always clone a fresh copy for compilation. If ``False``, only clone when there
-        are no matching archives.
-    :param force_recompile: If ``True``, the repository is compiled regardless of the value in DB.
-    :param docker_batch_compile: If ``True``, compile all Makefiles within a repository in a single Docker container.
-    :param max_archive_size: If specified, only archive repositories whose size is not larger than the given
-        value (in bytes).
-    :param compression_type: The file type of the archive to produce. Valid values are ``"gzip"`` (faster) and
-        ``"xz"`` (smaller).
-    :param record_libraries: If ``True``, record the libraries used in compilation.
-    :param record_metainfo: If ``True``, record meta-info values.
-    :param gcc_override_flags: If not ``None``, these flags will be appended to each invocation of GCC.
+    :param clone_result: If not ``None``, the repository was already cloned with the result, e.g., by
+        :meth:`prepare_repo_async`.
+    :param stats: Statistics of the repository collected before calling this function, if any.
 
-    :return: An entry to insert into the DB, or `None` if no operations are required.
+    :return: A :class:`RepoWorkspace` if the repository should be compiled, or a :class:`PipelineResult` if the
+        pipeline ends here for the repository.
     """
     repo_full_name = f"{repo_info.repo_owner}/{repo_info.repo_name}"
     repo_folder_name = f"{repo_info.repo_owner}_____{repo_info.repo_name}"
     repo_path = os.path.join(clone_folder, repo_folder_name)
-    if compression_type == "xz":
-        archive_extension = ".tar.xz"
-        tar_type_flag = "J"
-    elif compression_type == "gzip":
-        archive_extension = ".tar.gz"
-        tar_type_flag = "z"
-    else:
-        raise ValueError(f"Invalid compression type '{compression_type}'")
-    archive_path = os.path.abspath(
-        os.path.join(archive_folder, f"{repo_full_name}{archive_extension}")
-    )
 
     repo_entry = repo_info.db_result
     clone_success = None
+    archive_path: Optional[str] = None
+    source_commit: Optional[str] = None
 
-    # Skip repos that are fully processed
-    if (
-        repo_entry is not None
-        and (repo_entry["clone_successful"] and not force_reclone)
-        and (repo_entry["compiled"] and not force_recompile)
-    ):
+    state = repo_info.state
+    if state is None:
+        state = plan_repo(
+            repo_info,
+            clone_folder,
+            archive_folder,
+            force_reclone=force_reclone,
+            force_recompile=force_recompile,
+            compression_type=compression_type,
+        )
+    if state is RepoState.Skip:
         return PipelineResult(repo_info)
 
-    # Stage 1: Cloning from GitHub.
-    if not force_reclone and os.path.exists(archive_path):
-        # Extract the archive instead of cloning.
+    stats = stats or RepoStats()
+    if state is RepoState.Extract:
+        # Extract the archive instead of cloning. The archive could be of a different compression type.
+        archive_path = ghcc.find_archive(
+            archive_folder, repo_info.repo_owner, repo_info.repo_name, compression_type
+        )
+        assert archive_path is not None
         try:
-            flutes.run_command(
-                ["tar", f"x{tar_type_flag}f", archive_path],
-                timeout=clone_timeout,
-                cwd=clone_folder,
-            )
+            with stats.timer("extract"):
+                ghcc.extract_archive(archive_path, clone_folder, timeout=clone_timeout)
             flutes.log(f"{repo_full_name} extracted from archive", "success")
         except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
             flutes.log(
                 f"Unknown error when extracting {repo_full_name}. Captured output: '{e.output}'",
                 "error",
             )
-            shutil.rmtree(repo_path)
-            return PipelineResult(repo_info)  # return dummy info
-        repo_size = flutes.get_folder_size(repo_path)
-    elif (
-        repo_entry is None
-        or force_reclone  # not processed
-        or (
-            repo_entry["clone_successful"]
-            and (not repo_entry["compiled"] or force_recompile)  # not compiled
-            and not os.path.exists(repo_path)
-        )
-    ):
-        clone_result = ghcc.clone(
-            repo_info.repo_owner,
-            repo_info.repo_name,
-            clone_folder=clone_folder,
-            folder_name=repo_folder_name,
-            timeout=clone_timeout,
-            skip_if_exists=False,
-            recursive=recursive_clone,
-        )
+            with stats.timer("cleanup"):
+                remove_repo(repo_path, deletion_queue)
+            # return dummy info
+            return PipelineResult(
+                repo_info, stats=stats, failure=failure_type("extract", e)
+            )
+        with stats.timer("find_makefiles"):
+            build_index = ghcc.index_build_files(repo_path)
+        repo_size = build_index.total_size
+        stats.bytes_read += os.path.getsize(archive_path)
+        stats.bytes_written += repo_size
+        source_commit = ghcc.get_head_commit(repo_path)
+    elif state is RepoState.Clone:
+        if clone_result is None:
+            with stats.timer("clone"):
+                clone_result = ghcc.clone(
+                    repo_info.repo_owner,
+                    repo_info.repo_name,
+                    clone_folder=clone_folder,
+                    folder_name=repo_folder_name,
+                    timeout=clone_timeout,
+                    skip_if_exists=False,
+                    default_branch=repo_info.repo_branch,
+                    commit=repo_info.repo_commit_id,
+                    tag=repo_info.repo_tag,
+                    recursive=recursive_clone,
+                    probe=probe_clone,
+                    object_cache=object_cache,
+                    submodule_cache=submodule_cache,
+                )
         clone_success = clone_result.success
         if not clone_result.success:
+            failure = CLONE_FAILURE_TYPES[clone_result.error_type]
             if clone_result.error_type is CloneErrorType.FolderExists:
                 flutes.log(f"{repo_full_name} skipped because folder exists", "warning")
             elif clone_result.error_type is CloneErrorType.PrivateOrNonexistent:
@@ -233,242 +493,993 @@ def clone_and_compile(
                 flutes.log(msg, "error")
 
                 if clone_result.error_type is CloneErrorType.Unknown:
-                    return PipelineResult(repo_info)  # return dummy info
+                    # return dummy info
+                    return PipelineResult(repo_info, stats=stats, failure=failure)
 
-            return PipelineResult(repo_info, clone_success=clone_success)
+            return PipelineResult(
+                repo_info, clone_success=clone_success, stats=stats, failure=failure
+            )
 
+        elif clone_result.error_type is CloneErrorType.NotCRepository:
+            flutes.log(
+                f"No Makefiles or C files found in {repo_full_name}, repository skipped",
+                "warning",
+            )
+            return PipelineResult(
+                repo_info,
+                clone_success=clone_success,
+                makefiles=[],
+                stats=stats,
+                failure=CLONE_FAILURE_TYPES[clone_result.error_type],
+            )
         elif clone_result.error_type is CloneErrorType.SubmodulesFailed:
             msg = f"Submodules in {repo_full_name} ignored due to error"
             if clone_result.captured_output is not None:
                 msg += f". Captured output: '{clone_result.captured_output!r}'"
             flutes.log(msg, "warning")
 
-        repo_size = flutes.get_folder_size(repo_path)
+        with stats.timer("find_makefiles"):
+            build_index = ghcc.index_build_files(repo_path)
+        repo_size = build_index.total_size
+        stats.bytes_written += repo_size
         flutes.log(
             f"{repo_full_name} successfully cloned ({clone_result.time:.2f}s, "
             f"{flutes.readable_size(repo_size)})",
             "success",
         )
-    else:
-        if not repo_entry["clone_successful"]:
-            return PipelineResult(repo_info)  # return dummy info
-        repo_size = flutes.get_folder_size(repo_path)
+    else:  # RepoState.Recompile
+        with stats.timer("find_makefiles"):
+            build_index = ghcc.index_build_files(repo_path)
+        repo_size = build_index.total_size
 
-    makefiles = None
-    libraries = None
-    meta_info: Optional[PipelineMetaInfo] = None
-    if not repo_entry or not repo_entry["compiled"] or force_recompile:
-        # # SPECIAL CHECK: Do not attempt to compile OS kernels!
-        # kernel_name = None
-        # if contains_in_file(os.path.join(repo_path, "README"), "Linux kernel release"):
-        #     kernel_name = "Linux"
-        # elif contains_in_file(os.path.join(repo_path, "README"), "FreeBSD source directory"):
-        #     kernel_name = "FreeBSD"
-        # if kernel_name is not None:
-        #     shutil.rmtree(repo_path)
-        #     ghcc.log(f"Found {kernel_name} kernel in {repo_full_name}, will not attempt to compile. "
-        #              f"Repository deleted", "warning")
-        #     return PipelineResult(repo_info, clone_success=clone_success, makefiles=[])
-
-        # Stage 1.5: Check if the project uses CMake, and if so, create a build directory
-        if ghcc.find_cmakefile(repo_path):
-            flutes.log(f"CMakeLists found in {repo_full_name}", "success")
+    if repo_entry and repo_entry["compiled"] and not force_recompile:
+        return PipelineResult(
+            repo_info, clone_success=clone_success, repo_size=repo_size, stats=stats
+        )
+    return RepoWorkspace(
+        repo_info,
+        repo_path,
+        repo_size=repo_size,
+        clone_success=clone_success,
+        stats=stats,
+        source_archive=archive_path,
+        source_commit=source_commit,
+        build_index=build_index,
+    )
+
+
+async def prepare_repo_async(
+    repo_info: RepoInfo, **kwargs
+) -> Union[RepoWorkspace, PipelineResult, None]:
+    r"""Stage 1 of the pipeline for the async runner. Plain clones (see :meth:`ghcc.clone_async`) wait for Git on the
+    event loop, so the number of concurrent clones is not bounded by threads. The rest of the stage, and clones that
+    require other features, run in the default executor of the loop.
+
+    See :meth:`prepare_repo` for the description of arguments.
+    """
+    loop = asyncio.get_running_loop()
+    clone_result = None
+    stats = RepoStats()
+    if (
+        repo_info.state is RepoState.Clone
+        and repo_info.repo_commit_id is None
+        and repo_info.repo_tag is None
+        and not kwargs.get("probe_clone", False)
+        and kwargs.get("object_cache", None) is None
+        and (
+            kwargs.get("submodule_cache", None) is None
+            or not kwargs.get("recursive_clone", True)
+        )
+    ):
+        with stats.timer("clone"):
             try:
-                buildroot = os.path.join(repo_path, "ghcc_build")
-                os.makedirs(buildroot, exist_ok=True)
+                clone_result = await ghcc.clone_async(
+                    repo_info.repo_owner,
+                    repo_info.repo_name,
+                    clone_folder=kwargs["clone_folder"],
+                    folder_name=f"{repo_info.repo_owner}_____{repo_info.repo_name}",
+                    timeout=kwargs.get("clone_timeout", None),
+                    default_branch=repo_info.repo_branch,
+                    recursive=kwargs.get("recursive_clone", True),
+                )
+            except Exception as e:
+                exception_handler(e, repo_info)
+                return None
+    return await loop.run_in_executor(
+        None,
+        functools.partial(
+            prepare_repo, repo_info, clone_result=clone_result, stats=stats, **kwargs
+        ),
+    )
+
+
+def get_binary_subdir(repo_info: RepoInfo) -> str:
+    r"""Return the folder where binaries of a repository are stored, relative to the binary folder. The folder is in the
+    form of ``repo_owner/repo_name/tag/branch/commit_id``, where parts that are not specified are omitted.
+    """
+    subdir = os.path.join(repo_info.repo_owner, repo_info.repo_name)
+    for part in [repo_info.repo_tag, repo_info.repo_branch, repo_info.repo_commit_id]:
+        if part is not None:
+            subdir = os.path.join(subdir, part)
+    return subdir
+
+
+def get_build_key(gcc_override_flags: Optional[str] = None) -> str:
+    r"""Return a key identifying the build environment, i.e., the Docker image and the GCC flags. Builds of identical
+    trees are only reused if they have the same key.
+    """
+    config = {
+        "image_id": ghcc.utils.get_docker_image_id(),
+        "gcc_override_flags": gcc_override_flags,
+    }
+    return hashlib.sha256(json.dumps(config).encode("utf-8")).hexdigest()
+
+
+# DB connections cannot be shared between processes, so each worker process creates its own on first use. The async
+# runner calls stages from multiple threads in the same process, so creation is guarded by a lock.
+_repo_db: Optional[ghcc.RepoDB] = None
+_repo_db_lock = threading.Lock()
+
+
+def find_identical_build(
+    repo_info: RepoInfo, tree_hash: str, build_key: str
+) -> Optional[RepoDB.Entry]:
+    r"""Find another repository whose latest build is of an identical tree in the same build environment, e.g., a fork
+    that is even with its upstream.
+
+    :return: The DB entry of the repository, or ``None`` if none exists.
+    """
+    global _repo_db
+    with _repo_db_lock:
+        if _repo_db is None:
+            _repo_db = ghcc.RepoDB()
+    return _repo_db.find_build(
+        tree_hash, build_key, exclude=(repo_info.repo_owner, repo_info.repo_name)
+    )
+
+
+def link_binaries(
+    source_dir: str, target_dir: str, makefiles: List[RepoDB.MakefileEntry]
+) -> bool:
+    r"""Reuse binaries of a previous build by creating hard links to them, or symbolic links if hard links are not
+    supported. Nothing is linked if any of the binaries is missing.
+
+    :param source_dir: Path to the folder storing binaries of the previous build.
+    :param target_dir: Path to the folder to create links in.
+    :param makefiles: Makefile entries of the previous build.
+    :return: Whether all binaries are linked.
+    """
+    hashes = [sha256 for makefile in makefiles for sha256 in makefile["sha256"]]
+    if not all(os.path.exists(os.path.join(source_dir, sha256)) for sha256 in hashes):
+        return False
+    for sha256 in hashes:
+        source_path = os.path.join(source_dir, sha256)
+        target_path = os.path.join(target_dir, sha256)
+        if os.path.exists(target_path):
+            continue
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            os.symlink(os.path.abspath(source_path), target_path)
+    return True
+
+
+@flutes.exception_wrapper(stage_exception_handler)
+def compile_repo(
+    workspace: RepoWorkspace,
+    binary_folder: str,
+    clone_timeout: Optional[float] = None,
+    compile_timeout: Optional[float] = None,
+    docker_batch_compile: bool = True,
+    record_libraries: bool = False,
+    record_metainfo: bool = False,
+    gcc_override_flags: Optional[str] = None,
+    directory_mapping: Optional[Dict[str, str]] = None,
+    build_key: Optional[str] = None,
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
+    job_pool: Optional[ghcc.utils.JobTokenPool] = None,
+    makefile_workers: int = 1,
+) -> Union[RepoWorkspace, PipelineResult]:
+    r"""Stages 2 & 3 of the pipeline: find and compile Makefiles in the repository.
+
+    See :meth:`clone_and_compile` for the description of arguments. ``clone_timeout`` is also used as the timeout for
+    running CMake.
+
+    :param directory_mapping: Additional directory mappings for Docker, used when ``docker_batch_compile`` is ``True``.
+    :param build_key: If not ``None``, the key identifying the build environment, see :meth:`get_build_key`. The tree
+        hash of the repository is recorded, and if another repository with an identical tree was built in the same
+        environment, its results and binaries are reused instead of compiling again.
+
+    :return: The workspace with compilation results filled in, or a :class:`PipelineResult` if the pipeline ends here
+        for the repository.
+    """
+    start_time = time.time()
+    repo_info = workspace.repo_info
+    repo_path = workspace.repo_path
+    clone_success = workspace.clone_success
+    stats = workspace.stats or RepoStats()
+    repo_full_name = f"{repo_info.repo_owner}/{repo_info.repo_name}"
+
+    # # SPECIAL CHECK: Do not attempt to compile OS kernels!
+    # kernel_name = None
+    # if contains_in_file(os.path.join(repo_path, "README"), "Linux kernel release"):
+    #     kernel_name = "Linux"
+    # elif contains_in_file(os.path.join(repo_path, "README"), "FreeBSD source directory"):
+    #     kernel_name = "FreeBSD"
+    # if kernel_name is not None:
+    #     shutil.rmtree(repo_path)
+    #     ghcc.log(f"Found {kernel_name} kernel in {repo_full_name}, will not attempt to compile. "
+    #              f"Repository deleted", "warning")
+    #     return PipelineResult(repo_info, clone_success=clone_success, makefiles=[])
+
+    # Files are indexed when the repository is obtained, so the tree is only walked once.
+    build_index = workspace.build_index
+    if build_index is None:
+        with stats.timer("find_makefiles"):
+            build_index = ghcc.index_build_files(repo_path)
+
+    # Stage 1.5: Check if the project uses CMake, and if so, create a build directory
+    if repo_path in build_index.cmake_dirs:
+        flutes.log(f"CMakeLists found in {repo_full_name}", "success")
+        try:
+            buildroot = os.path.join(repo_path, "ghcc_build")
+            os.makedirs(buildroot, exist_ok=True)
+            with stats.timer("cmake"):
                 flutes.run_command(
                     ["cmake", "../"], timeout=clone_timeout, cwd=buildroot
                 )
-                # Stage 2: Finding Makefiles.
-                makefile_dirs = ghcc.find_makefiles(buildroot)
-            except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
-                flutes.log(
-                    f"Error while trying to build with cmake:\n\n{e.output}", "error"
-                )
-                shutil.rmtree(repo_path)
-                # return dummy info
-                return PipelineResult(repo_info)
-        else:
             # Stage 2: Finding Makefiles.
-            makefile_dirs = ghcc.find_makefiles(repo_path)
-        if len(makefile_dirs) == 0:
-            # Repo has no Makefiles, delete.
-            shutil.rmtree(repo_path)
-            flutes.log(
-                f"No Makefiles found in {repo_full_name}, repository deleted", "warning"
+            with stats.timer("find_makefiles"):
+                build_index = ghcc.index_build_files(buildroot)
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+            flutes.log(f"Error while trying to build with cmake:\n\n{e.output}", "error")
+            with stats.timer("cleanup"):
+                remove_repo(repo_path, deletion_queue)
+            # return dummy info
+            return PipelineResult(
+                repo_info, stats=stats, failure=failure_type("cmake", e)
             )
-            return PipelineResult(repo_info, clone_success=clone_success, makefiles=[])
-        else:
-            pass
-
-        # Stage 3: Compile each Makefile.
-        # generate the binary path based on the provided repo name, tag used, commit_id, and repo_branch
-        # dir is in form $BIN_DIR/$FULL_REPO_NAME/TAG/COMMIT_ID/BRANCH/
-        repo_binary_dir = os.path.join(binary_folder, repo_full_name)
-        if repo_info.repo_tag is not None:
-            repo_binary_dir = os.path.join(repo_binary_dir, repo_info.repo_tag)
-        if repo_info.repo_branch is not None:
-            repo_binary_dir = os.path.join(repo_binary_dir, repo_info.repo_branch)
-        if repo_info.repo_commit_id is not None:
-            repo_binary_dir = os.path.join(repo_binary_dir, repo_info.repo_commit_id)
-
-        if not os.path.exists(repo_binary_dir):
-            os.makedirs(repo_binary_dir)
-        flutes.log(f"Starting compilation for {repo_full_name}...")
+    # Stage 2: Finding Makefiles.
+    makefile_dirs = build_index.makefile_dirs
+    if len(makefile_dirs) == 0:
+        # Repo has no Makefiles, delete.
+        with stats.timer("cleanup"):
+            remove_repo(repo_path, deletion_queue)
+        flutes.log(
+            f"No Makefiles found in {repo_full_name}, repository deleted", "warning"
+        )
+        return PipelineResult(
+            repo_info,
+            clone_success=clone_success,
+            makefiles=[],
+            compile_time=time.time() - start_time,
+            stats=stats,
+            failure="no_makefiles",
+        )
 
-        if docker_batch_compile:
-            makefiles = ghcc.docker_batch_compile(
-                repo_binary_dir,
-                repo_path,
-                compile_timeout,
-                record_libraries,
-                gcc_override_flags,
-                user_id=(repo_info.idx % 10000) + 30000,  # user IDs 30000 ~ 39999
-                exception_log_fn=functools.partial(
-                    exception_handler, repo_info=repo_info
-                ),
+    # Stage 3: Compile each Makefile.
+    # generate the binary path based on the provided repo name, tag used, commit_id, and repo_branch
+    repo_binary_dir = os.path.join(binary_folder, get_binary_subdir(repo_info))
+    if not os.path.exists(repo_binary_dir):
+        os.makedirs(repo_binary_dir)
+
+    # Before compiling, check whether an identical tree was built in the same environment.
+    tree_hash = None
+    reused_entry = None
+    if build_key is not None:
+        tree_hash = ghcc.get_tree_hash(repo_path)
+        if tree_hash is not None:
+            reused_entry = find_identical_build(repo_info, tree_hash, build_key)
+        if reused_entry is not None and not link_binaries(
+            os.path.join(binary_folder, reused_entry["binary_dir"]),
+            repo_binary_dir,
+            reused_entry["makefiles"],
+        ):
+            reused_entry = None
+
+    if reused_entry is not None:
+        makefiles = reused_entry["makefiles"]
+        reused_library_path = os.path.join(
+            binary_folder, reused_entry["binary_dir"], "libraries.txt"
+        )
+        if record_libraries and os.path.exists(reused_library_path):
+            shutil.copyfile(
+                reused_library_path, os.path.join(repo_binary_dir, "libraries.txt")
             )
-        else:
-            makefiles = list(
-                ghcc.compile_and_move(
+        flutes.log(
+            f"{repo_full_name} is identical to {reused_entry['repo_owner']}/{reused_entry['repo_name']}, "
+            f"reusing its compilation results",
+            "success",
+        )
+    else:
+        flutes.log(f"Starting compilation for {repo_full_name}...")
+        with stats.timer("compile"):
+            if docker_batch_compile:
+                makefiles = ghcc.docker_batch_compile(
                     repo_binary_dir,
                     repo_path,
-                    makefile_dirs,
                     compile_timeout,
                     record_libraries,
                     gcc_override_flags,
+                    user_id=(repo_info.idx % 10000) + 30000,  # user IDs 30000 ~ 39999
+                    directory_mapping=directory_mapping,
+                    exception_log_fn=functools.partial(
+                        exception_handler, repo_info=repo_info
+                    ),
+                    job_pool=job_pool,
+                    num_workers=makefile_workers,
                 )
-            )
-        num_succeeded = sum(makefile["success"] for makefile in makefiles)
-        if record_libraries:
-            library_log_path = os.path.join(repo_binary_dir, "libraries.txt")
-            if os.path.exists(library_log_path):
-                with open(library_log_path) as f:
-                    libraries = list(set(f.read().split()))
             else:
-                libraries = []
-        num_binaries = sum(len(makefile["binaries"]) for makefile in makefiles)
+                makefiles = list(
+                    ghcc.compile_and_move(
+                        repo_binary_dir,
+                        repo_path,
+                        makefile_dirs,
+                        compile_timeout,
+                        record_libraries,
+                        gcc_override_flags,
+                        job_pool=job_pool,
+                        num_workers=makefile_workers,
+                    )
+                )
+        for makefile in makefiles:
+            for sha256 in makefile["sha256"]:
+                binary_path = os.path.join(repo_binary_dir, sha256)
+                if os.path.exists(binary_path):
+                    stats.bytes_written += os.path.getsize(binary_path)
+    failure = None
+    if (
+        compile_timeout is not None
+        and stats.timings.get("compile", 0.0) >= compile_timeout
+    ):
+        failure = "compile_timeout"
+    num_succeeded = sum(makefile["success"] for makefile in makefiles)
+    libraries = None
+    if record_libraries:
+        library_log_path = os.path.join(repo_binary_dir, "libraries.txt")
+        if os.path.exists(library_log_path):
+            with open(library_log_path) as f:
+                libraries = list(set(f.read().split()))
+        else:
+            libraries = []
+    num_binaries = sum(len(makefile["binaries"]) for makefile in makefiles)
 
-        msg = (
-            f"{num_succeeded} ({len(makefiles)}) out of {len(makefile_dirs)} Makefile(s) "
-            f"in {repo_full_name} compiled (partially), yielding {num_binaries} binaries"
+    msg = (
+        f"{num_succeeded} ({len(makefiles)}) out of {len(makefile_dirs)} Makefile(s) "
+        f"in {repo_full_name} compiled (partially), yielding {num_binaries} binaries"
+    )
+    flutes.log(msg, "success" if num_succeeded == len(makefile_dirs) else "warning")
+
+    meta_info: Optional[PipelineMetaInfo] = None
+    if record_metainfo:
+        autoconf_dirs = set(build_index.autoconf_dirs)
+        meta_info = PipelineMetaInfo(
+            {
+                "num_makefiles": len(makefile_dirs),
+                "has_gitmodules": os.path.exists(
+                    os.path.join(repo_path, ".gitmodules")
+                ),
+                "makefiles_using_automake": sum(
+                    directory in autoconf_dirs for directory in makefile_dirs
+                ),
+            }
         )
-        flutes.log(msg, "success" if num_succeeded == len(makefile_dirs) else "warning")
 
-        if record_metainfo:
-            meta_info = PipelineMetaInfo(
-                {
-                    "num_makefiles": len(makefile_dirs),
-                    "has_gitmodules": os.path.exists(
-                        os.path.join(repo_path, ".gitmodules")
-                    ),
-                    "makefiles_using_automake": sum(
-                        ghcc.contains_files(directory, ["configure.ac", "configure.in"])
-                        for directory in makefile_dirs
-                    ),
-                }
-            )
+    return workspace._replace(
+        makefiles=makefiles,
+        libraries=libraries,
+        meta_info=meta_info,
+        compile_time=time.time() - start_time,
+        stats=stats,
+        failure=failure,
+        tree_hash=tree_hash,
+    )
 
-        # Stage 4: Clean and zip repo.
-        if max_archive_size is not None and repo_size > max_archive_size:
-            shutil.rmtree(repo_path)
-            flutes.log(
-                f"Removed {repo_full_name} because repository size ({flutes.readable_size(repo_size)}) "
-                f"exceeds limits",
-                "info",
-            )
-        else:
-            # Repository is already cleaned in the compile stage.
-            os.makedirs(os.path.split(archive_path)[0], exist_ok=True)
-            compress_success = False
-            try:
-                flutes.run_command(
-                    ["tar", f"c{tar_type_flag}f", archive_path, repo_folder_name],
+
+@flutes.exception_wrapper(stage_exception_handler)
+def archive_repo(
+    workspace: RepoWorkspace,
+    clone_folder: str,
+    archive_folder: str,
+    clone_timeout: Optional[float] = None,
+    max_archive_size: Optional[int] = None,
+    compression_type: str = "gzip",
+    compression_level: Optional[int] = None,
+    compression_threads: int = 1,
+    indexed_archive: bool = False,
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
+) -> PipelineResult:
+    r"""Stage 4 of the pipeline: archive the compiled repository and remove it from the clone folder.
+
+    See :meth:`clone_and_compile` for the description of arguments. ``clone_timeout`` is also used as the timeout for
+    compression.
+    """
+    repo_info = workspace.repo_info
+    repo_path = workspace.repo_path
+    repo_size = workspace.repo_size
+    stats = workspace.stats or RepoStats()
+    repo_full_name = f"{repo_info.repo_owner}/{repo_info.repo_name}"
+    archive_path = ghcc.get_archive_path(
+        archive_folder, repo_info.repo_owner, repo_info.repo_name, compression_type
+    )
+
+    # Stage 4: Clean and zip repo.
+    failure = None
+    if (
+        workspace.source_archive == archive_path
+        and (not indexed_archive or os.path.exists(ghcc.get_index_path(archive_path)))
+        and workspace.source_commit is not None
+        and ghcc.get_head_commit(repo_path) == workspace.source_commit
+        and ghcc.is_clean(repo_path)
+    ):
+        # The repository was extracted from an archive of the same type, and is unchanged after cleaning. Keep the
+        # existing archive instead of compressing the same contents again.
+        with stats.timer("cleanup"):
+            remove_repo(repo_path, deletion_queue)
+        flutes.log(
+            f"Archive for {repo_full_name} is up-to-date, folder removed", "info"
+        )
+    elif max_archive_size is not None and repo_size > max_archive_size:
+        with stats.timer("cleanup"):
+            remove_repo(repo_path, deletion_queue)
+        flutes.log(
+            f"Removed {repo_full_name} because repository size ({flutes.readable_size(repo_size)}) "
+            f"exceeds limits",
+            "info",
+        )
+    else:
+        # Repository is already cleaned in the compile stage.
+        os.makedirs(os.path.split(archive_path)[0], exist_ok=True)
+        compress_success = False
+        try:
+            with stats.timer("archive"):
+                ghcc.create_archive(
+                    archive_path,
+                    repo_path,
+                    compression_type=compression_type,
+                    level=compression_level,
+                    threads=compression_threads,
+                    indexed=indexed_archive,
                     timeout=clone_timeout,
-                    cwd=clone_folder,
-                )
-                compress_success = True
-            except subprocess.TimeoutExpired:
-                flutes.log(
-                    f"Compression timeout for {repo_full_name}, giving up", "error"
                 )
-            except subprocess.CalledProcessError as e:
-                flutes.log(
-                    f"Unknown error when compressing {repo_full_name}. Captured output: '{e.output}'",
-                    "error",
+            compress_success = True
+            stats.bytes_read += repo_size
+            stats.bytes_written += os.path.getsize(archive_path)
+        except subprocess.TimeoutExpired as e:
+            flutes.log(f"Compression timeout for {repo_full_name}, giving up", "error")
+            failure = failure_type("archive", e)
+        except subprocess.CalledProcessError as e:
+            flutes.log(
+                f"Unknown error when compressing {repo_full_name}. Captured output: '{e.output}'",
+                "error",
+            )
+            failure = failure_type("archive", e)
+        with stats.timer("cleanup"):
+            remove_repo(repo_path, deletion_queue)
+        if compress_success:
+            # Remove archives in other formats, so that stale archives are never extracted.
+            for other_type in ghcc.ARCHIVE_TYPES:
+                other_path = ghcc.get_archive_path(
+                    archive_folder,
+                    repo_info.repo_owner,
+                    repo_info.repo_name,
+                    other_type,
                 )
-            shutil.rmtree(repo_path)
-            if compress_success:
-                flutes.log(f"Compressed {repo_full_name}, folder removed", "info")
-            elif os.path.exists(archive_path):
-                os.remove(archive_path)
+                if other_path != archive_path:
+                    ghcc.remove_archive(other_path)
+            flutes.log(f"Compressed {repo_full_name}, folder removed", "info")
+        else:
+            ghcc.remove_archive(archive_path)
+
+    return workspace_result(workspace._replace(stats=stats), failure)
+
+
+def workspace_result(
+    workspace: RepoWorkspace, failure: Optional[str] = None
+) -> PipelineResult:
+    r"""Convert a workspace at the end of the pipeline into a :class:`PipelineResult`.
 
+    :param workspace: The workspace.
+    :param failure: Type of failure in the final stage. Failures recorded in the workspace take precedence.
+    """
     return PipelineResult(
+        workspace.repo_info,
+        clone_success=workspace.clone_success,
+        repo_size=workspace.repo_size,
+        makefiles=workspace.makefiles,
+        libraries=workspace.libraries,
+        meta_info=workspace.meta_info,
+        compile_time=workspace.compile_time,
+        stats=workspace.stats,
+        failure=workspace.failure or failure,
+        tree_hash=workspace.tree_hash,
+    )
+
+
+def is_final_result(result: Union[RepoWorkspace, PipelineResult, None]) -> bool:
+    r"""Whether a stage output ends the pipeline for the repository, i.e., it should not be passed to the next
+    stage. ``None`` is returned by stages in which exceptions occurred."""
+    return not isinstance(result, RepoWorkspace)
+
+
+@flutes.exception_wrapper(exception_handler)
+def clone_and_compile(
+    repo_info: RepoInfo,
+    clone_folder: str,
+    binary_folder: str,
+    archive_folder: str,
+    recursive_clone: bool = True,
+    probe_clone: bool = False,
+    object_cache: Optional[ghcc.ObjectCache] = None,
+    submodule_cache: Optional[ghcc.SubmoduleCache] = None,
+    clone_timeout: Optional[float] = None,
+    compile_timeout: Optional[float] = None,
+    force_reclone: bool = False,
+    force_recompile: bool = False,
+    docker_batch_compile: bool = True,
+    max_archive_size: Optional[int] = None,
+    compression_type: str = "gzip",
+    compression_level: Optional[int] = None,
+    compression_threads: int = 1,
+    indexed_archive: bool = False,
+    record_libraries: bool = False,
+    record_metainfo: bool = False,
+    gcc_override_flags: Optional[str] = None,
+    build_key: Optional[str] = None,
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
+    job_pool: Optional[ghcc.utils.JobTokenPool] = None,
+    makefile_workers: int = 1,
+) -> Optional[PipelineResult]:
+    r"""Perform the entire pipeline.
+
+    :param repo_info: Information about the repository.
+    :param clone_folder: Path to the folder where the repository will be stored. The actual destination folder will be
+        ``clone_folder/repo_owner_____repo_name``, e.g., ``clone_folder/torvalds_____linux``.
+        This strange notation is used in order to have a flat directory hierarchy, so we're not left with a bunch of
+        empty folders for repository owners.
+    :param binary_folder: Path to the folder where compiled binaries will be stored. The actual destination folder will
+        be ``binary_folder/repo_owner/repo_name``, e.g., ``binary_folder/torvalds/linux``.
+    :param archive_folder: Path to the folder where archived repositories will be stored. The actual archive file will
+        be ``archive_folder/repo_owner/repo_name.tar.xz``, e.g., ``archive_folder/torvalds/linux.tar.xz``.
+
+    :param recursive_clone: If ``True``, uses ``--recursive`` when cloning.
+    :param probe_clone: If ``True``, fetch only the tree of the repository first, and skip repositories without build
+        files or C source files before downloading their contents.
+    :param object_cache: If not ``None``, the local Git object store used to avoid downloading objects shared with
+        previously cloned repositories (e.g., forks of the same project).
+    :param submodule_cache: If not ``None``, the local mirrors from which submodules are cloned.
+    :param clone_timeout: Timeout for cloning, or `None` (default) for unlimited time.
+    :param compile_timeout: Timeout for compilation, or `None` (default) for unlimited time.
+    :param force_reclone: If ``True``, always clone a fresh copy for compilation. If ``False``, only clone when there
+        are no matching archives.
+    :param force_recompile: If ``True``, the repository is compiled regardless of the value in DB.
+    :param docker_batch_compile: If ``True``, compile all Makefiles within a repository in a single Docker container.
+    :param max_archive_size: If specified, only archive repositories whose size is not larger than the given
+        value (in bytes).
+    :param compression_type: The file type of the archive to produce. Valid values are ``"gzip"``, ``"xz"`` (smaller
+        but slower), and ``"zstd"`` (fast and multithreaded). Existing archives of any type can be extracted.
+    :param compression_level: The compression level, or ``None`` for the default level of the compressor.
+    :param compression_threads: Number of threads used for compression (``xz`` and ``zstd`` only), or 0 to use all
+        available cores.
+    :param indexed_archive: If ``True``, create indexed archives that allow extracting parts of the repository without
+        decompressing the whole archive, see :meth:`ghcc.create_archive`.
+    :param record_libraries: If ``True``, record the libraries used in compilation.
+    :param record_metainfo: If ``True``, record meta-info values.
+    :param gcc_override_flags: If not ``None``, these flags will be appended to each invocation of GCC.
+    :param build_key: If not ``None``, reuse binaries of identical repository trees built in the same build environment,
+        see :meth:`compile_repo`.
+    :param deletion_queue: If not ``None``, repositories are deleted in the background using the queue.
+    :param job_pool: If not ``None``, Makefiles are built with parallel jobs using tokens from the shared pool.
+    :param makefile_workers: Maximum number of independent Makefile directories built concurrently in a repository.
+
+    :return: An entry to insert into the DB, or `None` if no operations are required.
+    """
+    result = prepare_repo(
         repo_info,
-        clone_success=clone_success,
-        repo_size=repo_size,
-        makefiles=makefiles,
-        libraries=libraries,
-        meta_info=meta_info,
+        clone_folder,
+        archive_folder,
+        recursive_clone=recursive_clone,
+        probe_clone=probe_clone,
+        object_cache=object_cache,
+        submodule_cache=submodule_cache,
+        clone_timeout=clone_timeout,
+        force_reclone=force_reclone,
+        force_recompile=force_recompile,
+        compression_type=compression_type,
+        deletion_queue=deletion_queue,
+    )
+    if is_final_result(result):
+        return result
+    result = compile_repo(
+        result,
+        binary_folder,
+        clone_timeout=clone_timeout,
+        compile_timeout=compile_timeout,
+        docker_batch_compile=docker_batch_compile,
+        record_libraries=record_libraries,
+        record_metainfo=record_metainfo,
+        gcc_override_flags=gcc_override_flags,
+        build_key=build_key,
+        deletion_queue=deletion_queue,
+        job_pool=job_pool,
+        makefile_workers=makefile_workers,
+    )
+    if is_final_result(result):
+        return result
+    return archive_repo(
+        result,
+        clone_folder,
+        archive_folder,
+        clone_timeout=clone_timeout,
+        max_archive_size=max_archive_size,
+        compression_type=compression_type,
+        compression_level=compression_level,
+        compression_threads=compression_threads,
+        indexed_archive=indexed_archive,
+        deletion_queue=deletion_queue,
     )
 
 
-def iter_repos(
-    db: ghcc.RepoDB, repo_list_path: str, max_count: Optional[int] = None
-) -> Iterator[RepoInfo]:
-    db_entries = {
-        (entry["repo_owner"], entry["repo_name"]): entry
-        for entry in db.collection.find()  # getting stuff in batch is much faster
-    }
-    flutes.log(f"{len(db_entries)} entries loaded from DB")
-    index = 0
+def group_revisions(repos: Iterable[RepoInfo]) -> Iterator[List[RepoInfo]]:
+    r"""Group revisions (tags, branches, or commits) of the same repository together, so that they can be built from a
+    single clone. Groups are formed from consecutive entries of the same repository, so the input is consumed lazily;
+    repository lists usually hold all revisions of a repository together. Revisions within a group keep their order.
+    """
+    group: List[RepoInfo] = []
+    for repo_info in repos:
+        if len(group) > 0 and (repo_info.repo_owner, repo_info.repo_name) != (
+            group[0].repo_owner,
+            group[0].repo_name,
+        ):
+            yield group
+            group = []
+        group.append(repo_info)
+    if len(group) > 0:
+        yield group
+
+
+@flutes.exception_wrapper(exception_handler)
+def compile_revision(
+    repo_info: RepoInfo,
+    base: RepoWorkspace,
+    clone_folder: str,
+    binary_folder: str,
+    recursive_clone: bool = True,
+    submodule_cache: Optional[ghcc.SubmoduleCache] = None,
+    clone_timeout: Optional[float] = None,
+    compile_timeout: Optional[float] = None,
+    docker_batch_compile: bool = True,
+    record_libraries: bool = False,
+    record_metainfo: bool = False,
+    gcc_override_flags: Optional[str] = None,
+    build_key: Optional[str] = None,
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
+    job_pool: Optional[ghcc.utils.JobTokenPool] = None,
+    makefile_workers: int = 1,
+) -> Optional[PipelineResult]:
+    r"""Compile another revision of a prepared repository in a separate Git worktree, instead of cloning the repository
+    again. The worktree is removed afterwards without archiving.
+
+    See :meth:`clone_and_compile` for the description of arguments.
+
+    :param repo_info: Information about the revision to compile.
+    :param base: The prepared repository, as returned by :meth:`prepare_repo`.
+    """
+    repo_full_name = f"{repo_info.repo_owner}/{repo_info.repo_name}"
+    revision = (
+        repo_info.repo_commit_id
+        or repo_info.repo_tag
+        or repo_info.repo_branch
+        or "default branch"
+    )
+    worktree_path = os.path.join(
+        clone_folder,
+        f"{repo_info.repo_owner}_____{repo_info.repo_name}@{repo_info.idx}",
+    )
+    stats = RepoStats()
+    try:
+        try:
+            with stats.timer("clone"):
+                submodules_success = ghcc.add_worktree(
+                    base.repo_path,
+                    worktree_path,
+                    commit=repo_info.repo_commit_id,
+                    tag=repo_info.repo_tag,
+                    branch=repo_info.repo_branch,
+                    timeout=clone_timeout,
+                    recursive=recursive_clone,
+                    submodule_cache=submodule_cache,
+                )
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+            flutes.log(
+                f"Failed to check out {revision} of {repo_full_name}. Captured output: '{e.output}'",
+                "error",
+            )
+            return PipelineResult(
+                repo_info, stats=stats, failure=failure_type("clone", e)
+            )
+        if not submodules_success:
+            flutes.log(
+                f"Submodules in {repo_full_name} ({revision}) ignored due to error",
+                "warning",
+            )
+        with stats.timer("find_makefiles"):
+            build_index = ghcc.index_build_files(worktree_path)
+        repo_size = build_index.total_size
+        stats.bytes_written += repo_size
+        flutes.log(f"{repo_full_name} checked out at {revision}", "success")
+
+        workspace = RepoWorkspace(
+            repo_info,
+            worktree_path,
+            repo_size=repo_size,
+            clone_success=base.clone_success,
+            stats=stats,
+            build_index=build_index,
+        )
+        # The worktree refers to the Git directory of the base repository by its absolute path, which must also be
+        # valid within Docker containers.
+        git_dir = os.path.realpath(os.path.join(base.repo_path, ".git"))
+        result = compile_repo(
+            workspace,
+            binary_folder,
+            clone_timeout=clone_timeout,
+            compile_timeout=compile_timeout,
+            docker_batch_compile=docker_batch_compile,
+            record_libraries=record_libraries,
+            record_metainfo=record_metainfo,
+            gcc_override_flags=gcc_override_flags,
+            directory_mapping={git_dir: git_dir},
+            build_key=build_key,
+            deletion_queue=deletion_queue,
+            job_pool=job_pool,
+            makefile_workers=makefile_workers,
+        )
+        if is_final_result(result):
+            return result
+        return workspace_result(result)
+    finally:
+        with stats.timer("cleanup"):
+            ghcc.remove_worktree(base.repo_path, worktree_path)
+
+
+@flutes.exception_wrapper(group_exception_handler)
+def clone_and_compile_revisions(
+    repo_infos: List[RepoInfo],
+    clone_folder: str,
+    binary_folder: str,
+    archive_folder: str,
+    recursive_clone: bool = True,
+    probe_clone: bool = False,
+    object_cache: Optional[ghcc.ObjectCache] = None,
+    submodule_cache: Optional[ghcc.SubmoduleCache] = None,
+    clone_timeout: Optional[float] = None,
+    compile_timeout: Optional[float] = None,
+    force_reclone: bool = False,
+    force_recompile: bool = False,
+    docker_batch_compile: bool = True,
+    max_archive_size: Optional[int] = None,
+    compression_type: str = "gzip",
+    compression_level: Optional[int] = None,
+    compression_threads: int = 1,
+    indexed_archive: bool = False,
+    record_libraries: bool = False,
+    record_metainfo: bool = False,
+    gcc_override_flags: Optional[str] = None,
+    build_key: Optional[str] = None,
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
+    job_pool: Optional[ghcc.utils.JobTokenPool] = None,
+    makefile_workers: int = 1,
+) -> List[Optional[PipelineResult]]:
+    r"""Perform the entire pipeline for multiple revisions of the same repository. The repository is cloned (or
+    extracted) only once, and the other revisions are checked out as Git worktrees and compiled one after another.
+    Binaries of each revision are stored in separate folders, see :meth:`compile_repo`. Only the first revision is
+    archived, since there is one archive per repository.
+
+    See :meth:`clone_and_compile` for the description of other arguments.
+
+    :param repo_infos: Information about each revision of the repository, as grouped by :meth:`group_revisions`.
+    :return: A list of entries to insert into the DB, one for each revision.
+    """
+    results: List[Optional[PipelineResult]] = []
+    pending = list(repo_infos)
+    while True:
+        base_info = pending.pop(0)
+        base = prepare_repo(
+            base_info,
+            clone_folder,
+            archive_folder,
+            recursive_clone=recursive_clone,
+            probe_clone=probe_clone,
+            object_cache=object_cache,
+            submodule_cache=submodule_cache,
+            clone_timeout=clone_timeout,
+            force_reclone=force_reclone,
+            force_recompile=force_recompile,
+            compression_type=compression_type,
+            deletion_queue=deletion_queue,
+        )
+        if not is_final_result(base):
+            break
+        results.append(base)
+        if base is not None and base.failure in [
+            None,
+            CLONE_FAILURE_TYPES[CloneErrorType.PrivateOrNonexistent],
+            CLONE_FAILURE_TYPES[CloneErrorType.Timeout],
+        ]:
+            # The repository requires no work, or cannot be cloned at all. The same holds for other revisions. Clones of
+            # other revisions would fetch the same objects, so they are also not retried after a timeout, which would
+            # otherwise block the worker for the clone timeout once per revision.
+            results.extend(
+                base._replace(repo_info=info, stats=None) for info in pending
+            )
+            return results
+        if len(pending) == 0:
+            return results
+        # Otherwise, the failure could be specific to the revision (e.g., a commit that no longer exists), so try
+        # preparing the repository with the next revision.
+
+    for repo_info in pending:
+        results.append(
+            compile_revision(
+                repo_info,
+                base,
+                clone_folder,
+                binary_folder,
+                recursive_clone=recursive_clone,
+                submodule_cache=submodule_cache,
+                clone_timeout=clone_timeout,
+                compile_timeout=compile_timeout,
+                docker_batch_compile=docker_batch_compile,
+                record_libraries=record_libraries,
+                record_metainfo=record_metainfo,
+                gcc_override_flags=gcc_override_flags,
+                build_key=build_key,
+                deletion_queue=deletion_queue,
+                job_pool=job_pool,
+                makefile_workers=makefile_workers,
+            )
+        )
+    # The base repository is compiled last, because it is removed if compilation fails.
+    result = compile_repo(
+        base,
+        binary_folder,
+        clone_timeout=clone_timeout,
+        compile_timeout=compile_timeout,
+        docker_batch_compile=docker_batch_compile,
+        record_libraries=record_libraries,
+        record_metainfo=record_metainfo,
+        gcc_override_flags=gcc_override_flags,
+        build_key=build_key,
+        deletion_queue=deletion_queue,
+        job_pool=job_pool,
+        makefile_workers=makefile_workers,
+    )
+    if not is_final_result(result):
+        result = archive_repo(
+            result,
+            clone_folder,
+            archive_folder,
+            clone_timeout=clone_timeout,
+            max_archive_size=max_archive_size,
+            compression_type=compression_type,
+            compression_level=compression_level,
+            compression_threads=compression_threads,
+            indexed_archive=indexed_archive,
+            deletion_queue=deletion_queue,
+        )
+    results.append(result)
+    return results
+
+
+class RepoListEntry(NamedTuple):
+    repo_owner: str
+    repo_name: str
+    repo_branch: Optional[str] = None
+    repo_commit_id: Optional[str] = None
+    repo_tag: Optional[str] = None
+
+
+def _parse_repo_url(url: str) -> Tuple[str, str]:
+    url = url.strip().rstrip("/")
+    if url.endswith(".git"):
+        url = url[: -len(".git")]
+    repo_owner, repo_name = url.split("/")[-2:]
+    return repo_owner, repo_name
+
+
+def iter_repo_list(repo_list_path: str) -> Iterator[RepoListEntry]:
+    r"""Iterate over repositories in the repository list file.
+
+    :param repo_list_path: Path to the list file. Supported formats are:
+
+        - ``.txt``: One repository URL per line.
+        - ``.json``: A JSON object where the key ``"repos"`` maps to a list of objects with the key ``"url"``, and
+          optionally ``"branch"``, ``"commit"``, and ``"tag"``.
+        - ``.jsonl``: One JSON object per line, in the same format as the objects in the ``.json`` list.
+
+        All formats are parsed incrementally, so the list is never loaded into memory as a whole.
+    """
+
+    def make_entry(repo: Dict[str, str]) -> RepoListEntry:
+        repo_owner, repo_name = _parse_repo_url(repo["url"])
+        return RepoListEntry(
+            repo_owner,
+            repo_name,
+            repo.get("branch", None),
+            repo.get("commit", None),
+            repo.get("tag", None),
+        )
+
     with open(repo_list_path, "r") as repo_file:
-        # config file can be a .json file, or .txt file
+        # config file can be a .json, .jsonl, or .txt file
         if repo_list_path.endswith(".json"):
-            j_data = json.load(repo_file)
-            for repo in j_data["repos"]:
-                url = repo["url"]
-                if url.endswith(".git"):
-                    url = url[: -len(".git")]
-                repo_owner, repo_name = url.split("/")[-2:]
-                # db_result = db.get(repo_owner, repo_name)
-                db_result = db_entries.get((repo_owner, repo_name), None)
-                # when reading from a .txt file, we only have a URL, no branch, commit_id, or tag info
-                yield RepoInfo(
-                    index,
-                    repo_owner,
-                    repo_name,
-                    repo.get("branch", None),
-                    repo.get("commit", None),
-                    repo.get("tag", None),
-                    db_result,
-                )
-                index += 1
-                if max_count is not None and index >= max_count:
-                    break
+            for repo in ghcc.utils.iter_json_array(repo_file, ["repos"]):
+                yield make_entry(repo)
+        elif repo_list_path.endswith(".jsonl"):
+            for line in repo_file:
+                if not line.strip():
+                    continue
+                yield make_entry(json.loads(line))
         elif repo_list_path.endswith(".txt"):
             for line in repo_file:
-                if not line:
+                if not line.strip():
                     continue
-                url = line.strip().rstrip("/")
-                if url.endswith(".git"):
-                    url = url[: -len(".git")]
-                repo_owner, repo_name = url.split("/")[-2:]
-                # db_result = db.get(repo_owner, repo_name)
-                db_result = db_entries.get((repo_owner, repo_name), None)
                 # when reading from a .txt file, we only have a URL, no branch, commit_id, or tag info
-                yield RepoInfo(
-                    index, repo_owner, repo_name, None, None, None, db_result
-                )
-                index += 1
-                if max_count is not None and index >= max_count:
-                    break
+                yield RepoListEntry(*_parse_repo_url(line))
         else:
             raise RuntimeError("Unsupported URL list file format")
 
 
+def iter_repos(
+    db: ghcc.RepoDB,
+    repo_list_path: str,
+    max_count: Optional[int] = None,
+    include_makefiles: bool = True,
+    chunk_size: int = 1000,
+) -> Iterator[RepoInfo]:
+    r"""Iterate over repositories in the repository list file, along with their DB entries.
+
+    The list is read in chunks, and DB entries for each chunk are fetched with a single query. This keeps memory usage
+    constant regardless of the size of the list and the DB.
+
+    :param db: The repository DB.
+    :param repo_list_path: Path to the repository list file. See :meth:`iter_repo_list` for supported formats.
+    :param max_count: If not ``None``, stop after yielding this many repositories.
+    :param include_makefiles: If ``False``, the ``makefiles`` field is omitted from the fetched DB entries, which could
+        be large.
+    :param chunk_size: Number of repositories to fetch DB entries for in each query.
+    """
+    projection = None if include_makefiles else {"makefiles": False}
+    index = 0
+    db_count = 0
+    repo_list = iter_repo_list(repo_list_path)
+    if max_count is not None:
+        repo_list = flutes.take(max_count, repo_list)
+    for chunk in flutes.chunk(chunk_size, repo_list):
+        db_entries = db.get_many(
+            [(repo.repo_owner, repo.repo_name) for repo in chunk], projection
+        )
+        db_count += len(db_entries)
+        for repo in chunk:
+            db_result = db_entries.get((repo.repo_owner, repo.repo_name), None)
+            yield RepoInfo(
+                index,
+                repo.repo_owner,
+                repo.repo_name,
+                repo.repo_branch,
+                repo.repo_commit_id,
+                repo.repo_tag,
+                db_result,
+            )
+            index += 1
+    flutes.log(f"{index} repositories listed, {db_count} of which found in DB")
+
+
 class MetaInfo:
     def __init__(self):
+        # Skipped repositories are added while planning, which happens in the threads feeding workers.
+        self._lock = threading.Lock()
         self.num_repos = 0
         self.num_makefiles = 0
         self.num_binaries = 0
@@ -482,6 +1493,10 @@ class MetaInfo:
         self.makefiles_using_automake = 0
 
     def add_repo(self, result: PipelineResult) -> None:
+        with self._lock:
+            self._add_repo(result)
+
+    def _add_repo(self, result: PipelineResult) -> None:
         self.num_repos += 1
         if result.meta_info is not None:
             self.num_gitmodules += result.meta_info["has_gitmodules"]
@@ -504,10 +1519,10 @@ class MetaInfo:
         elif result.repo_info.db_result is not None:
             db_result = result.repo_info.db_result
             self.success_makefiles += sum(
-                makefile["success"] for makefile in db_result["makefiles"]
+                makefile["success"] for makefile in db_result.get("makefiles", [])
             )
             self.num_binaries += sum(
-                len(makefile["binaries"]) for makefile in db_result["makefiles"]
+                len(makefile["binaries"]) for makefile in db_result.get("makefiles", [])
             )
 
         # if result.repo_info.db_result is not None:
@@ -537,6 +1552,160 @@ class MetaInfo:
         return msg
 
 
+class StageReport:
+    r"""Aggregated per-stage timings and I/O statistics over all processed repositories."""
+
+    def __init__(self):
+        self.num_repos = 0
+        self.stage_count: Dict[str, int] = {stage: 0 for stage in RepoStats.STAGES}
+        self.stage_time: Dict[str, float] = {stage: 0.0 for stage in RepoStats.STAGES}
+        self.stage_max_time: Dict[str, float] = {
+            stage: 0.0 for stage in RepoStats.STAGES
+        }
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add_repo(self, result: PipelineResult) -> None:
+        if result.stats is None:
+            return
+        self.num_repos += 1
+        for stage, stage_time in result.stats.timings.items():
+            self.stage_count[stage] = self.stage_count.get(stage, 0) + 1
+            self.stage_time[stage] = self.stage_time.get(stage, 0.0) + stage_time
+            self.stage_max_time[stage] = max(
+                self.stage_max_time.get(stage, 0.0), stage_time
+            )
+        self.bytes_read += result.stats.bytes_read
+        self.bytes_written += result.stats.bytes_written
+
+    def __repr__(self) -> str:
+        msg = (
+            f"Stage timings over {self.num_repos} repos "
+            f"(read {flutes.readable_size(self.bytes_read)}, "
+            f"written {flutes.readable_size(self.bytes_written)}):"
+        )
+        for stage, count in self.stage_count.items():
+            if count == 0:
+                continue
+            total_time = self.stage_time[stage]
+            msg += (
+                f"\n  {stage:<15s} count: {count:>8d}, total: {total_time:>10.1f}s, "
+                f"mean: {total_time / count:>7.2f}s, max: {self.stage_max_time[stage]:>7.1f}s"
+            )
+        return msg
+
+
+class PoolProgress:
+    r"""Track items sent through a process pool, providing the same statistics as :class:`ghcc.utils.StagedExecutor`,
+    so they can be exported with :meth:`PipelineMetrics.add_executor`. The pool runs the whole pipeline as a single
+    stage. Idle pool workers immediately pick up waiting items, so the number of busy workers is inferred from the
+    number of items in flight."""
+
+    def __init__(self, name: str, num_workers: int):
+        self.stages = [ghcc.utils.Stage(name, lambda item: item, num_workers)]
+        self._lock = threading.Lock()
+        self._num_submitted = 0
+        self._num_completed = 0
+
+    def submit(self, iterable: Iterable[T]) -> Iterator[T]:
+        r"""Wrap the input of the pool, counting items as the pool takes them."""
+        for item in iterable:
+            with self._lock:
+                self._num_submitted += 1
+            yield item
+
+    def complete(self, iterable: Iterable[T]) -> Iterator[T]:
+        r"""Wrap the output of the pool, counting items as results are returned."""
+        for item in iterable:
+            with self._lock:
+                self._num_completed += 1
+            yield item
+
+    def _in_flight(self) -> int:
+        with self._lock:
+            return self._num_submitted - self._num_completed
+
+    def queue_sizes(self) -> List[int]:
+        return [max(0, self._in_flight() - self.stages[0].num_workers)]
+
+    def busy_workers(self) -> List[int]:
+        return [min(self._in_flight(), self.stages[0].num_workers)]
+
+
+class PipelineMetrics:
+    r"""Metrics of the pipeline, to be served in the Prometheus format by :class:`ghcc.utils.MetricsServer`."""
+
+    def __init__(self):
+        self.registry = ghcc.utils.MetricsRegistry()
+        self.planned = self.registry.counter(
+            "ghcc_repos_planned_total", "Repositories by planned work.", ["state"]
+        )
+        self.processed = self.registry.counter(
+            "ghcc_repos_processed_total",
+            'Processed repositories by outcome ("success" or failure type).',
+            ["outcome"],
+        )
+        self.timeouts = self.registry.counter(
+            "ghcc_timeouts_total", "Timeouts by pipeline stage.", ["stage"]
+        )
+        self.stage_duration = self.registry.histogram(
+            "ghcc_stage_duration_seconds", "Time spent per repository.", ["stage"]
+        )
+        self.binaries = self.registry.counter(
+            "ghcc_binaries_total", "Number of binaries produced."
+        )
+        self.bytes_read = self.registry.counter(
+            "ghcc_bytes_read_total", "Logical number of bytes read."
+        )
+        self.bytes_written = self.registry.counter(
+            "ghcc_bytes_written_total", "Logical number of bytes written."
+        )
+        self.queue_depth = self.registry.gauge(
+            "ghcc_stage_queue_depth", "Repositories waiting before stage.", ["stage"]
+        )
+        self.workers = self.registry.gauge(
+            "ghcc_stage_workers", "Workers by stage and state.", ["stage", "state"]
+        )
+
+    def add_plan(self, state: RepoState) -> None:
+        self.planned.inc(state=state.name.lower())
+
+    def add_executor(self, executor) -> None:
+        r"""Collect queue depths and worker states from a staged executor (or a :class:`PoolProgress`) when metrics
+        are rendered."""
+
+        def collect() -> None:
+            queue_sizes = executor.queue_sizes()
+            busy_workers = executor.busy_workers()
+            for idx, stage in enumerate(executor.stages):
+                self.queue_depth.set(queue_sizes[idx], stage=stage.name)
+                self.workers.set(busy_workers[idx], stage=stage.name, state="busy")
+                self.workers.set(
+                    stage.num_workers - busy_workers[idx],
+                    stage=stage.name,
+                    state="idle",
+                )
+
+        self.registry.add_collect_hook(collect)
+
+    def add_result(self, result: Optional[PipelineResult]) -> None:
+        if result is None:
+            self.processed.inc(outcome="exception")
+            return
+        self.processed.inc(outcome=result.failure or "success")
+        if result.failure is not None and result.failure.endswith("_timeout"):
+            self.timeouts.inc(stage=result.failure[: -len("_timeout")])
+        if result.makefiles is not None:
+            self.binaries.inc(
+                sum(len(makefile["binaries"]) for makefile in result.makefiles)
+            )
+        if result.stats is not None:
+            for stage, stage_time in result.stats.timings.items():
+                self.stage_duration.observe(stage_time, stage=stage)
+            self.bytes_read.inc(result.stats.bytes_read)
+            self.bytes_written.inc(result.stats.bytes_written)
+
+
 def main() -> None:
     if not ghcc.utils.verify_docker_image(verbose=True):
         exit(1)
@@ -549,20 +1718,32 @@ def main() -> None:
     flutes.set_logging_level(args.logging_level, console=True, file=False)
     flutes.log("Running with arguments:\n" + args.to_string(), force_console=True)
 
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None
+    if args.deletion_threads > 0:
+        # The trash folder is placed under the clone folder, so repositories can be moved into it without copying.
+        deletion_queue = ghcc.utils.DeletionQueue(
+            os.path.join(args.clone_folder, ".trash"),
+            num_threads=args.deletion_threads,
+            max_backlog=args.deletion_backlog,
+        )
     if os.path.exists(args.clone_folder):
         flutes.log(
             f"Removing contents of clone folder '{args.clone_folder}'...",
             "warning",
             force_console=True,
         )
-        ghcc.utils.run_docker_command(
-            ["rm", "-rf", "/usr/src/*"],
-            user=0,
-            directory_mapping={args.clone_folder: "/usr/src"},
-        )
+        if deletion_queue is not None:
+            deletion_queue.clear(args.clone_folder)
+        else:
+            ghcc.utils.run_docker_command(
+                ["rm", "-rf", "/usr/src/*"],
+                user=0,
+                directory_mapping={args.clone_folder: "/usr/src"},
+            )
 
     flutes.log("Crawling starts...", "warning", force_console=True)
     db = ghcc.RepoDB()
+    db_writer = ghcc.RepoDBWriter(db)
     libraries: Set[str] = set()
     if args.record_libraries is not None and os.path.exists(args.record_libraries):
         with open(args.record_libraries, "r") as f:
@@ -573,31 +1754,265 @@ def main() -> None:
             with open(args.record_libraries, "w") as f:
                 f.write("\n".join(libraries))
 
-    with flutes.safe_pool(args.n_procs, closing=[db, flush_libraries]) as pool:
-        iterator = iter_repos(db, args.repo_list_file, args.max_repos)
-        pipeline_fn: Callable[[RepoInfo], Optional[PipelineResult]] = functools.partial(
-            clone_and_compile,
+    object_cache: Optional[ghcc.ObjectCache] = None
+    if args.object_cache_folder is not None:
+        object_cache = ghcc.ObjectCache(
+            args.object_cache_folder, max_size=args.object_cache_size
+        )
+    submodule_cache: Optional[ghcc.SubmoduleCache] = None
+    if args.submodule_cache_folder is not None:
+        submodule_cache = ghcc.SubmoduleCache(args.submodule_cache_folder)
+    job_pool: Optional[ghcc.utils.JobTokenPool] = None
+    if args.make_jobs > 1:
+        num_tokens = args.job_tokens
+        if num_tokens is None:
+            # Each concurrent build runs one job without a token.
+            num_tokens = max(0, (os.cpu_count() or 1) - max(1, args.n_procs))
+        # The pool folder is shared with Docker containers, so it is placed alongside the repositories.
+        job_pool = ghcc.utils.JobTokenPool(
+            os.path.join(args.clone_folder, ".jobs"),
+            num_tokens=num_tokens,
+            max_jobs=args.make_jobs,
+        )
+    build_key: Optional[str] = None
+    if args.dedup_trees and not args.force_recompile:
+        # Recompilation is forced, e.g., when the pipeline changes, so previous builds should not be reused.
+        build_key = get_build_key(args.gcc_override_flags)
+
+    if args.runner == "staged" and args.n_procs == 0:
+        flutes.log(
+            "Staged runner requires `n_procs` > 0, falling back to sequential execution",
+            "warning",
+            force_console=True,
+        )
+        args.runner = "pool"
+    if args.runner != "pool" and args.group_revisions:
+        flutes.log(
+            f"Revision grouping is only supported by the pool runner, revisions are processed independently "
+            f"with the {args.runner} runner. Specify `--no-group-revisions` to silence this warning",
+            "warning",
+            force_console=True,
+        )
+    # The staged runner manages its own worker processes.
+    pool_procs = args.n_procs if args.runner == "pool" else 0
+    metrics = PipelineMetrics()
+    closing = [db_writer, db, flush_libraries]
+    if deletion_queue is not None:
+        deletion_queue.start()
+        closing.append(deletion_queue)
+    if args.metrics_port is not None:
+        metrics_server = ghcc.utils.MetricsServer(metrics.registry, args.metrics_port)
+        flutes.log(
+            f"Serving metrics at http://localhost:{metrics_server.port}/metrics",
+            force_console=True,
+        )
+        closing.append(metrics_server)
+    with flutes.safe_pool(pool_procs, closing=closing) as pool:
+        meta_info = MetaInfo()
+        plan_counts = {state: 0 for state in RepoState}
+
+        def count_plan(state: RepoState) -> None:
+            plan_counts[state] += 1
+            metrics.add_plan(state)
+
+        def plan_summary() -> str:
+            return f"{sum(plan_counts.values())} repositories: " + ", ".join(
+                f"{count} {state.name.lower()}" for state, count in plan_counts.items()
+            )
+
+        def plan_all(planned: Iterator[RepoInfo]) -> Iterator[RepoInfo]:
+            # Plan the first batch of repositories when dispatching begins, so a summary is printed before the run.
+            preview: List[RepoInfo] = []
+            exhausted = True
+            for repo_info in planned:
+                preview.append(repo_info)
+                if sum(plan_counts.values()) >= args.plan_preview_size:
+                    exhausted = False
+                    break
+            if exhausted:
+                flutes.log(
+                    f"Planned work for all {plan_summary()}", force_console=True
+                )
+                yield from preview
+                return
+            flutes.log(
+                f"Planned work for the first {plan_summary()} "
+                f"(the rest are planned during the run)",
+                force_console=True,
+            )
+            yield from preview
+            yield from planned
+            flutes.log(
+                f"Finished planning, total planned work for {plan_summary()}",
+                force_console=True,
+            )
+
+        # Repositories are planned as workers consume them, so work starts before the whole list is planned. A summary
+        # of the first batch is printed before the run starts, and the totals are printed once all repositories are
+        # planned.
+        planned_repos = plan_repos(
+            iter_repos(
+                db,
+                args.repo_list_file,
+                args.max_repos,
+                include_makefiles=args.record_metainfo,
+            ),
             clone_folder=args.clone_folder,
-            binary_folder=args.binary_folder,
             archive_folder=args.archive_folder,
-            recursive_clone=args.recursive_clone,
-            clone_timeout=args.clone_timeout,
-            compile_timeout=args.compile_timeout,
             force_reclone=args.force_reclone,
             force_recompile=args.force_recompile,
-            docker_batch_compile=args.docker_batch_compile,
-            max_archive_size=args.max_archive_size,
             compression_type=args.compression_type,
-            record_libraries=(args.record_libraries is not None),
-            record_metainfo=args.record_metainfo,
-            gcc_override_flags=args.gcc_override_flags,
+            # Skipped repos are still counted in meta-info, as they would be if processed by workers.
+            skip_fn=(
+                (lambda repo_info: meta_info.add_repo(PipelineResult(repo_info)))
+                if args.record_metainfo
+                else None
+            ),
+            plan_fn=count_plan,
         )
+        repos: Iterable[RepoInfo] = plan_all(planned_repos)
+        if args.schedule == "longest-first":
+            # Start long-running repositories first, so they don't end up prolonging the tail of the run. This requires
+            # planning all repositories before dispatching any work.
+            repo_list = list(repos)
+            costs = estimate_costs(repo_list)
+            order = sorted(
+                range(len(repo_list)), key=lambda idx: costs[idx], reverse=True
+            )
+            repos = [repo_list[idx] for idx in order]
+            flutes.log(
+                f"Repositories scheduled longest-first, estimated total compilation time: "
+                f"{sum(costs) / 3600:.2f} hours",
+                force_console=True,
+            )
+        if args.runner in ["staged", "async"]:
+            n_compile_procs = max(1, args.n_procs)
+            n_clone_procs = args.n_clone_procs or n_compile_procs
+            n_archive_procs = args.n_archive_procs or max(1, n_compile_procs // 4)
+            executor_class = (
+                ghcc.utils.StagedExecutor
+                if args.runner == "staged"
+                else ghcc.utils.AsyncStagedExecutor
+            )
+            executor = executor_class(
+                [
+                    ghcc.utils.Stage(
+                        "clone",
+                        functools.partial(
+                            (
+                                prepare_repo
+                                if args.runner == "staged"
+                                else prepare_repo_async
+                            ),
+                            clone_folder=args.clone_folder,
+                            archive_folder=args.archive_folder,
+                            recursive_clone=args.recursive_clone,
+                            probe_clone=args.probe_clone,
+                            object_cache=object_cache,
+                            submodule_cache=submodule_cache,
+                            clone_timeout=args.clone_timeout,
+                            force_reclone=args.force_reclone,
+                            force_recompile=args.force_recompile,
+                            compression_type=args.compression_type,
+                            deletion_queue=deletion_queue,
+                        ),
+                        n_clone_procs,
+                    ),
+                    ghcc.utils.Stage(
+                        "compile",
+                        functools.partial(
+                            compile_repo,
+                            binary_folder=args.binary_folder,
+                            clone_timeout=args.clone_timeout,
+                            compile_timeout=args.compile_timeout,
+                            docker_batch_compile=args.docker_batch_compile,
+                            record_libraries=(args.record_libraries is not None),
+                            record_metainfo=args.record_metainfo,
+                            gcc_override_flags=args.gcc_override_flags,
+                            build_key=build_key,
+                            deletion_queue=deletion_queue,
+                            job_pool=job_pool,
+                            makefile_workers=args.makefile_workers,
+                        ),
+                        n_compile_procs,
+                    ),
+                    ghcc.utils.Stage(
+                        "archive",
+                        functools.partial(
+                            archive_repo,
+                            clone_folder=args.clone_folder,
+                            archive_folder=args.archive_folder,
+                            clone_timeout=args.clone_timeout,
+                            max_archive_size=args.max_archive_size,
+                            compression_type=args.compression_type,
+                            compression_level=args.compression_level,
+                            compression_threads=args.compression_threads,
+                            indexed_archive=args.indexed_archives,
+                            deletion_queue=deletion_queue,
+                        ),
+                        n_archive_procs,
+                    ),
+                ],
+                is_final=is_final_result,
+                queue_size=args.stage_queue_size,
+            )
+            metrics.add_executor(executor)
+            results: Iterator[Optional[PipelineResult]] = executor.run(repos)
+        else:
+            pipeline_kwargs = dict(
+                clone_folder=args.clone_folder,
+                binary_folder=args.binary_folder,
+                archive_folder=args.archive_folder,
+                recursive_clone=args.recursive_clone,
+                probe_clone=args.probe_clone,
+                object_cache=object_cache,
+                submodule_cache=submodule_cache,
+                clone_timeout=args.clone_timeout,
+                compile_timeout=args.compile_timeout,
+                force_reclone=args.force_reclone,
+                force_recompile=args.force_recompile,
+                docker_batch_compile=args.docker_batch_compile,
+                max_archive_size=args.max_archive_size,
+                compression_type=args.compression_type,
+                compression_level=args.compression_level,
+                compression_threads=args.compression_threads,
+                indexed_archive=args.indexed_archives,
+                record_libraries=(args.record_libraries is not None),
+                record_metainfo=args.record_metainfo,
+                gcc_override_flags=args.gcc_override_flags,
+                build_key=build_key,
+                deletion_queue=deletion_queue,
+                job_pool=job_pool,
+                makefile_workers=args.makefile_workers,
+            )
+            progress = PoolProgress("pipeline", max(1, pool_procs))
+            metrics.add_executor(progress)
+            if args.group_revisions:
+                # Revisions of the same repository are built from a single clone by the same worker.
+                group_fn: Callable[
+                    [List[RepoInfo]], List[Optional[PipelineResult]]
+                ] = functools.partial(clone_and_compile_revisions, **pipeline_kwargs)
+                results = itertools.chain.from_iterable(
+                    progress.complete(
+                        pool.imap_unordered(
+                            group_fn, progress.submit(group_revisions(repos))
+                        )
+                    )
+                )
+            else:
+                pipeline_fn: Callable[
+                    [RepoInfo], Optional[PipelineResult]
+                ] = functools.partial(clone_and_compile, **pipeline_kwargs)
+                results = progress.complete(
+                    pool.imap_unordered(pipeline_fn, progress.submit(repos))
+                )
         repo_count = 0
-        meta_info = MetaInfo()
-        for result in pool.imap_unordered(pipeline_fn, iterator):
+        stage_report = StageReport()
+        for result in results:
             repo_count += 1
             if repo_count % 100 == 0:
                 flutes.log(f"Processed {repo_count} repositories", force_console=True)
+            metrics.add_result(result)
             if result is None:
                 continue
             repo_owner, repo_name, repo_branch, repo_commit_id, repo_tag = (
@@ -622,7 +2037,7 @@ def main() -> None:
                         if result.clone_success is not None
                         else True
                     )
-                    db.add_repo(
+                    db_writer.add_repo(
                         repo_owner,
                         repo_name,
                         repo_branch,
@@ -633,11 +2048,14 @@ def main() -> None:
                     )
                     flutes.log(f"Added {repo_owner}/{repo_name} to DB")
                 if result.makefiles is not None:
-                    update_result = db.update_makefile(
+                    update_result = db_writer.update_makefile(
                         repo_owner,
                         repo_name,
                         result.makefiles,
-                        ignore_length_mismatch=True,
+                        compile_time=result.compile_time,
+                        tree_hash=result.tree_hash,
+                        build_key=build_key,
+                        binary_dir=get_binary_subdir(result.repo_info),
                     )
                     if not update_result:
                         flutes.log(
@@ -645,17 +2063,28 @@ def main() -> None:
                             f"errors",
                             "error",
                         )
+                if result.stats is not None:
+                    db_writer.update_stats(
+                        repo_owner,
+                        repo_name,
+                        result.stats.timings,
+                        result.stats.bytes_read,
+                        result.stats.bytes_written,
+                    )
             if result.libraries is not None:
                 libraries.update(result.libraries)
                 if repo_count % 10 == 0:  # flush every 10 repos
                     flush_libraries()
 
+            stage_report.add_repo(result)
             if args.record_metainfo:
                 meta_info.add_repo(result)
                 if repo_count % 100 == 0:
                     flutes.log(repr(meta_info), force_console=True)
+                    flutes.log(repr(stage_report), force_console=True)
 
         flutes.log(repr(meta_info), force_console=True)
+        flutes.log(repr(stage_report), force_console=True)
 
 
 if __name__ == "__main__":
@@ -55,6 +55,10 @@ class Arguments(argtyped.Arguments):
     force_reprocess: Switch = (
         False  # also process repos that are recorded as processed in DB
     )
+    metrics_port: Optional[int] = None  # if specified, serve metrics on localhost
+    selective_extract: Switch = True  # only extract Makefile dirs, build files and headers
+    deletion_threads: int = 8  # 0 to delete repositories inline with `shutil.rmtree`
+    deletion_backlog: Optional[int] = 64  # max repos awaiting background deletion
 
 
 class RepoInfo(NamedTuple):
@@ -87,6 +91,7 @@ class Result(NamedTuple):
     files_found: int
     functions_found: int
     funcs_without_asts: int
+    time: Optional[float] = None  # time (seconds) spent on processing the repo
 
 
 DECOMPILED_CODE_HEADER = r"""
@@ -200,8 +205,10 @@ def match_functions(
     decompile_folder: str,
     use_fake_libc_headers: bool = True,
     preprocess_timeout: Optional[int] = None,
+    selective_extract: bool = True,
     *,
     progress_bar: Optional[flutes.ProgressBarManager.Proxy] = None,
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None,
 ) -> Result:
     # Directions:
     # 1. Clone or extract from archive.
@@ -214,7 +221,9 @@ def match_functions(
     total_files = sum(len(makefile) for makefile in repo_info.makefiles.values())
     repo_folder_name = f"{repo_info.repo_owner}_____{repo_info.repo_name}"
     repo_full_name = f"{repo_info.repo_owner}/{repo_info.repo_name}"
-    archive_path = (Path(archive_folder) / f"{repo_full_name}.tar.gz").absolute()
+    archive_path = ghcc.find_archive(
+        archive_folder, repo_info.repo_owner, repo_info.repo_name
+    )
     repo_dir = (Path(temp_folder) / repo_folder_name).absolute()
     repo_src_path = repo_dir / "src"
     repo_binary_dir = repo_dir / "bin"
@@ -230,10 +239,16 @@ def match_functions(
 
     flutes.log(f"Begin processing {repo_full_name} ({total_files} files)")
 
-    if os.path.exists(archive_path):
-        # Extract archive
-        flutes.run_command(["tar", f"xzf", str(archive_path)], cwd=str(repo_dir))
+    if archive_path is not None:
+        # Extract archive. Files outside the Makefile directories are not needed for preprocessing, except for files
+        # that could be included from them.
+        select = None
+        if selective_extract:
+            select = ghcc.subtree_filter(repo_folder_name, repo_info.makefiles.keys())
+        ghcc.extract_archive(archive_path, str(repo_dir), select=select)
         (repo_dir / repo_folder_name).rename(repo_src_path)
+        if select is not None:
+            ghcc.skip_missing_files(str(repo_src_path))
     else:
         # Clone repo
         if repo_src_path.exists():
@@ -499,7 +514,10 @@ def match_functions(
         if not has_error and len(matched_functions) > 0
         else ("warning" if not has_error or len(matched_functions) > 0 else "error")
     )
-    shutil.rmtree(repo_dir)
+    if deletion_queue is not None:
+        deletion_queue.delete(str(repo_dir))
+    else:
+        shutil.rmtree(repo_dir)
 
     end_time = time.time()
     funcs_without_asts = sum(
@@ -522,6 +540,7 @@ def match_functions(
         files_found=files_found,
         functions_found=functions_found,
         funcs_without_asts=funcs_without_asts,
+        time=end_time - start_time,
     )
 
 
@@ -636,17 +655,27 @@ def main() -> None:
     flutes.set_log_file(args.log_file)
     flutes.log("Running with arguments:\n" + args.to_string(), force_console=True)
 
+    deletion_queue: Optional[ghcc.utils.DeletionQueue] = None
+    if args.deletion_threads > 0:
+        deletion_queue = ghcc.utils.DeletionQueue(
+            os.path.join(args.temp_dir, ".trash"),
+            num_threads=args.deletion_threads,
+            max_backlog=args.deletion_backlog,
+        )
     if os.path.exists(args.temp_dir):
         flutes.log(
             f"Removing contents of temporary folder '{args.temp_dir}'...",
             "warning",
             force_console=True,
         )
-        ghcc.utils.run_docker_command(
-            ["rm", "-rf", "/usr/src/*"],
-            user=0,
-            directory_mapping={args.temp_dir: "/usr/src"},
-        )
+        if deletion_queue is not None:
+            deletion_queue.clear(args.temp_dir)
+        else:
+            ghcc.utils.run_docker_command(
+                ["rm", "-rf", "/usr/src/*"],
+                user=0,
+                directory_mapping={args.temp_dir: "/usr/src"},
+            )
 
     db = ghcc.MatchFuncDB()
     output_dir = Path(args.output_dir)
@@ -655,7 +684,33 @@ def main() -> None:
         verbose=args.show_progress,
         bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}{postfix}]",
     )
-    with flutes.safe_pool(args.n_procs, closing=[db, manager]) as pool:
+    metrics = ghcc.utils.MetricsRegistry()
+    processed_metric = metrics.counter(
+        "ghcc_match_repos_total",
+        'Processed repositories by status ("success" or "exception").',
+        ["status"],
+    )
+    files_metric = metrics.counter(
+        "ghcc_match_files_total", "Preprocessed files found with decompiled output."
+    )
+    functions_metric = metrics.counter(
+        "ghcc_match_functions_total", "Functions found and matched.", ["status"]
+    )
+    duration_metric = metrics.histogram(
+        "ghcc_match_duration_seconds", "Time spent on matching each repository."
+    )
+    closing = [db, manager]
+    if deletion_queue is not None:
+        deletion_queue.start()
+        closing.append(deletion_queue)
+    if args.metrics_port is not None:
+        metrics_server = ghcc.utils.MetricsServer(metrics, args.metrics_port)
+        flutes.log(
+            f"Serving metrics at http://localhost:{metrics_server.port}/metrics",
+            force_console=True,
+        )
+        closing.append(metrics_server)
+    with flutes.safe_pool(args.n_procs, closing=closing) as pool:
         iterator, stats = iter_repos(
             db,
             args.max_repos,
@@ -670,7 +725,9 @@ def main() -> None:
             decompile_folder=args.decompile_dir,
             use_fake_libc_headers=args.use_fake_libc_headers,
             preprocess_timeout=args.preprocess_timeout,
+            selective_extract=args.selective_extract,
             progress_bar=manager.proxy,
+            deletion_queue=deletion_queue,
         )
 
         repo_count = stats.repo_count
@@ -679,6 +736,7 @@ def main() -> None:
         for result in pool.imap_unordered(match_fn, iterator):
             if result is None:
                 # Exception occurred.
+                processed_metric.inc(status="exception")
                 if args.exit_on_exception:
                     flutes.log(
                         f"Exception occurred, exiting because 'exit_on_exception' is True",
@@ -687,8 +745,18 @@ def main() -> None:
                     break
                 continue
 
-            # Write the matched functions to disk.
             result: Result  # type: ignore
+            processed_metric.inc(status="success")
+            files_metric.inc(result.files_found)
+            functions_metric.inc(result.functions_found, status="found")
+            functions_metric.inc(len(result.matched_functions), status="matched")
+            functions_metric.inc(
+                result.funcs_without_asts, status="matched_without_ast"
+            )
+            if result.time is not None:
+                duration_metric.observe(result.time)
+
+            # Write the matched functions to disk.
             repo_dir = output_dir / result.repo_owner / result.repo_name
             repo_dir.mkdir(parents=True, exist_ok=True)
             with (repo_dir / "matched_funcs.jsonl").open("w") as f:
@@ -20,8 +20,9 @@ try:
         confirm = input(f"This will delete {parent} / {folder}. Confirm? [y/N] ")
         yes = confirm.lower() in ["y", "yes"]
     if yes:
-        ghcc.utils.run_docker_command(["rm", "-rf", f"/usr/src/{folder}"],
-                                      user=0, directory_mapping={parent: "/usr/src"})
+        # Delete what we can in parallel, and only resort to Docker for files owned by other users.
+        if len(ghcc.utils.parallel_rmtree(args.folder)) > 0:
+            ghcc.utils.docker_rmtree(args.folder)
 except subprocess.CalledProcessError as e:
     flutes.log(f"Command failed with retcode {e.returncode}", "error")
     output = e.output.decode("utf-8")
@@ -34,6 +34,7 @@ class Arguments(argtyped.Arguments):
     binary_mapping_cache_file: Optional[str] = "binary_mapping.pkl"
     timeout: int = 30  # decompilation timeout
     n_procs: int = 0  # number of processes
+    metrics_port: Optional[int] = None  # if specified, serve metrics on localhost
 
 
 SCRIPTS_DIR = Path(__file__).parent / "scripts" / "decompiler_scripts"
@@ -285,7 +286,30 @@ def main() -> None:
     file_count = 0
     db = ghcc.BinaryDB()
 
-    with flutes.safe_pool(args.n_procs, closing=[db]) as pool:
+    metrics = ghcc.utils.MetricsRegistry()
+    processed_metric = metrics.counter(
+        "ghcc_decompile_binaries_total",
+        'Processed binaries by status (or "exception").',
+        ["status"],
+    )
+    timeouts_metric = metrics.counter(
+        "ghcc_timeouts_total", "Timeouts by pipeline stage.", ["stage"]
+    )
+    duration_metric = metrics.histogram(
+        "ghcc_decompile_duration_seconds",
+        "Time spent on decompiling each binary.",
+        buckets=[1, 2, 5, 10, 20, 30, 60, 120],
+    )
+    closing = [db]
+    if args.metrics_port is not None:
+        metrics_server = ghcc.utils.MetricsServer(metrics, args.metrics_port)
+        flutes.log(
+            f"Serving metrics at http://localhost:{metrics_server.port}/metrics",
+            force_console=True,
+        )
+        closing.append(metrics_server)
+
+    with flutes.safe_pool(args.n_procs, closing=closing) as pool:
         decompile_fn: Callable[[BinaryInfo], DecompilationResult] = functools.partial(
             decompile,
             output_dir=args.output_dir,
@@ -294,7 +318,14 @@ def main() -> None:
         )
         for result in pool.imap_unordered(decompile_fn, iter_binaries(db, binaries)):
             file_count += 1
-            if result is not None:
+            if result is None:
+                processed_metric.inc(status="exception")
+            else:
+                processed_metric.inc(status=result.status.name)
+                if result.status is DecompilationStatus.TimedOut:
+                    timeouts_metric.inc(stage="decompile")
+                if result.time is not None:
+                    duration_metric.observe(result.time.total_seconds())
                 db.add_binary(
                     result.info["repo_owner"],
                     result.info["repo_name"],
@@ -20,6 +20,9 @@ class Arguments(argtyped.Arguments):
     gcc_override_flags: Optional[str] = None
     use_makefile_info_pkl: Switch = False
     single_process: Switch = False  # useful for debugging
+    job_pool: Optional[str] = None  # folder of the shared job token pool, see `ghcc.utils.JobTokenPool`
+    max_jobs: int = 1  # max parallel `make` jobs per Makefile, only used with `job_pool`
+    num_workers: int = 1  # independent Makefile directories compiled concurrently
     verbose: Switch = False
 
 
@@ -48,17 +51,23 @@ def compile_makefiles():
             return makefile_info[directory][path]
 
         compile_fn = functools.partial(
-            ghcc.compile._make_skeleton, make_fn=ghcc.compile._unsafe_make, check_file_fn=check_file_fn)
+            ghcc.compile._make_skeleton, make_fn=ghcc.compile._unsafe_make, check_file_fn=check_file_fn,
+            use_output_manifest=True)
         makefile_dirs = list(makefile_info.keys())
         kwargs = {"compile_fn": compile_fn, "hash_fn": hash_fn}
     else:
-        makefile_dirs = ghcc.find_makefiles(REPO_PATH)
+        makefile_dirs = ghcc.index_build_files(REPO_PATH).makefile_dirs
         kwargs = {"compile_fn": ghcc.unsafe_make}
 
+    job_pool = None
+    if args.job_pool is not None:
+        job_pool = ghcc.utils.JobTokenPool(args.job_pool, max_jobs=args.max_jobs)
+
     for makefile in ghcc.compile_and_move(
             BINARY_PATH, REPO_PATH, makefile_dirs,
             compile_timeout=args.compile_timeout, record_libraries=args.record_libraries,
-            gcc_override_flags=args.gcc_override_flags, **kwargs):
+            gcc_override_flags=args.gcc_override_flags, use_snapshot=True, job_pool=job_pool,
+            num_workers=args.num_workers, **kwargs):
         makefile['directory'] = os.path.relpath(makefile['directory'], REPO_PATH)
         yield makefile
 
@@ -12,7 +12,9 @@ sudo apt update && sudo apt install -y \
     gnupg \
     python3 \
     python3-pip \
-    python-is-python3
+    python-is-python3 \
+    xz-utils \
+    zstd
 
 # Add Docker's official GPG key:
 sudo install -m 0755 -d /etc/apt/keyrings
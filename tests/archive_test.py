@@ -0,0 +1,143 @@
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+
+import ghcc
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.repo_path = os.path.join(self.tempdir.name, "owner_____repo")
+        os.makedirs(os.path.join(self.repo_path, "src"))
+        with open(os.path.join(self.repo_path, "src", "main.c"), "w") as f:
+            f.write("int main() { return 0; }\n" * 100)
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_round_trip(self) -> None:
+        archive_folder = os.path.join(self.tempdir.name, "archives")
+        for compression_type in ghcc.ARCHIVE_TYPES:
+            archive_path = ghcc.get_archive_path(
+                archive_folder, "owner", "repo", compression_type
+            )
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            ghcc.create_archive(archive_path, self.repo_path, level=3, threads=2)
+            self.assertEqual(
+                archive_path, ghcc.find_archive(archive_folder, "owner", "repo")
+            )
+
+            extract_dir = os.path.join(self.tempdir.name, compression_type)
+            os.makedirs(extract_dir)
+            ghcc.extract_archive(archive_path, extract_dir)
+            with open(
+                os.path.join(extract_dir, "owner_____repo", "src", "main.c")
+            ) as f:
+                self.assertEqual("int main() { return 0; }\n" * 100, f.read())
+            os.remove(archive_path)
+
+    def test_indexed_chunks(self) -> None:
+        with open(os.path.join(self.repo_path, "src", "util.c"), "w") as f:
+            f.write("int util() { return 1; }\n")
+        archive_folder = os.path.join(self.tempdir.name, "archives")
+        for compression_type in ghcc.ARCHIVE_TYPES:
+            archive_path = ghcc.get_archive_path(
+                archive_folder, "owner", "repo", compression_type
+            )
+            archive_dir = os.path.dirname(archive_path)
+            os.makedirs(archive_dir, exist_ok=True)
+            ghcc.create_archive(
+                archive_path, self.repo_path, indexed=True, chunk_size=1
+            )
+            # Temporary files of uncompressed chunks are removed.
+            self.assertEqual(
+                sorted([archive_path, ghcc.get_index_path(archive_path)]),
+                sorted(
+                    os.path.join(archive_dir, name) for name in os.listdir(archive_dir)
+                ),
+            )
+            with open(ghcc.get_index_path(archive_path)) as f:
+                chunks = json.load(f)["chunks"]
+            self.assertGreater(len(chunks), 1)
+            # Each chunk is a separate compressed stream.
+            with open(archive_path, "rb") as f:
+                data = f.read()
+            for chunk in chunks:
+                subprocess.run(
+                    [compression_type, "-dc"],
+                    input=data[chunk["offset"] : chunk["offset"] + chunk["size"]],
+                    stdout=subprocess.DEVNULL,
+                    check=True,
+                )
+            self.assertEqual(len(data), sum(chunk["size"] for chunk in chunks))
+
+            extract_dir = os.path.join(self.tempdir.name, compression_type)
+            os.makedirs(extract_dir)
+            ghcc.extract_archive(archive_path, extract_dir)
+            with open(
+                os.path.join(extract_dir, "owner_____repo", "src", "util.c")
+            ) as f:
+                self.assertEqual("int util() { return 1; }\n", f.read())
+            ghcc.remove_archive(archive_path)
+
+    def test_find_archive(self) -> None:
+        archive_folder = os.path.join(self.tempdir.name, "archives")
+        self.assertIsNone(ghcc.find_archive(archive_folder, "owner", "repo"))
+        paths = {
+            compression_type: ghcc.get_archive_path(
+                archive_folder, "owner", "repo", compression_type
+            )
+            for compression_type in ["gzip", "zstd"]
+        }
+        os.makedirs(os.path.dirname(paths["gzip"]))
+        for path in paths.values():
+            open(path, "w").close()
+        # Archives of the requested type are preferred, but other types are found as well.
+        self.assertEqual(
+            paths["zstd"], ghcc.find_archive(archive_folder, "owner", "repo", "zstd")
+        )
+        self.assertEqual(
+            paths["gzip"], ghcc.find_archive(archive_folder, "owner", "repo", "xz")
+        )
+
+    def test_selective_extract(self) -> None:
+        for name, content in [
+            ("docs/manual.txt", "manual\n"),
+            ("include/util.h", "#pragma once\n"),
+        ]:
+            os.makedirs(
+                os.path.join(self.repo_path, os.path.dirname(name)), exist_ok=True
+            )
+            with open(os.path.join(self.repo_path, name), "w") as f:
+                f.write(content)
+        select = ghcc.subtree_filter("owner_____repo", ["src"])
+        assert select is not None
+        self.assertIsNone(ghcc.subtree_filter("owner_____repo", ["src", "."]))
+
+        archive_folder = os.path.join(self.tempdir.name, "archives")
+        for indexed in [False, True]:
+            archive_path = ghcc.get_archive_path(
+                archive_folder, "owner", "repo", "zstd"
+            )
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            ghcc.create_archive(
+                archive_path, self.repo_path, indexed=indexed, chunk_size=1
+            )
+            self.assertEqual(indexed, os.path.exists(ghcc.get_index_path(archive_path)))
+
+            extract_dir = os.path.join(self.tempdir.name, f"extract_{indexed}")
+            os.makedirs(extract_dir)
+            ghcc.extract_archive(archive_path, extract_dir, select=select)
+            files = {
+                os.path.relpath(os.path.join(root, file), extract_dir)
+                for root, _, files in os.walk(extract_dir)
+                for file in files
+            }
+            self.assertEqual(
+                {"owner_____repo/src/main.c", "owner_____repo/include/util.h"}, files
+            )
+            ghcc.remove_archive(archive_path)
+            self.assertFalse(os.path.exists(ghcc.get_index_path(archive_path)))
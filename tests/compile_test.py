@@ -3,6 +3,7 @@ import subprocess
 import tempfile
 import unittest
 from typing import List
+from unittest import mock
 
 import flutes
 
@@ -99,3 +100,213 @@ class CompileTest(unittest.TestCase):
         with open(library_log_path) as f:
             recorded_libraries = f.read().split()
             assert set(libraries) == set(recorded_libraries)
+
+
+class BuildIndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_index_build_files(self) -> None:
+        root = os.path.join(self.tempdir.name, "repo")
+        files = [
+            "CMakeLists.txt", "Makefile", "main.c",
+            "lib/GNUmakefile", "lib/configure.ac", "lib/autogen.sh",
+            "lib/sub/makefile", "lib/sub/configure",
+            "src/main.c", "tools/Makefile", "tools/configure.in",
+        ]
+        for file in files:
+            path = os.path.join(root, file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(file)
+        # Symlinks to directories are not followed.
+        os.symlink(os.path.join(root, "tools"), os.path.join(root, "link"))
+
+        index = ghcc.index_build_files(root)
+        self.assertEqual(ghcc.find_makefiles(root), index.makefile_dirs)
+        self.assertEqual(
+            [directory for directory, _, _ in os.walk(root) if ghcc.contains_files(directory, ["makefile"])],
+            index.makefile_dirs)
+        self.assertEqual([root], index.cmake_dirs)
+        self.assertEqual([os.path.join(root, "lib", "sub")], index.configure_dirs)
+        self.assertEqual({os.path.join(root, "lib"), os.path.join(root, "tools")}, set(index.autoconf_dirs))
+        self.assertEqual([os.path.join(root, "lib")], index.autogen_dirs)
+        self.assertEqual(len(files) + 1, index.num_files)
+        self.assertEqual(flutes.get_folder_size(root), index.total_size)
+
+
+class ELFTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_output_manifest(self) -> None:
+        repo = os.path.join(self.tempdir.name, "repo")
+        os.makedirs(repo)
+        files = {
+            "main.c": "int main() { return 0; }\n",
+            # `linked.o` is recorded by the mock linker, while `main.copy` is not produced by a mock program.
+            "Makefile": "all:\n\tgcc -c main.c -o main.o\n\tgcc main.o -o main\n\tld -r main.o -o linked.o\n"
+                        "\tcp main main.copy\n",
+        }
+        for name, content in files.items():
+            with open(os.path.join(repo, name), "w") as f:
+                f.write(content)
+        env = {
+            "GIT_AUTHOR_NAME": "ghcc", "GIT_AUTHOR_EMAIL": "ghcc@localhost",
+            "GIT_COMMITTER_NAME": "ghcc", "GIT_COMMITTER_EMAIL": "ghcc@localhost",
+        }
+        flutes.run_command(["git", "init", "-q"], cwd=repo)
+        flutes.run_command(["git", "add", "."], cwd=repo)
+        flutes.run_command(["git", "commit", "-q", "-m", "init"], cwd=repo, env=env)
+
+        mock_path = os.path.join(os.path.dirname(__file__), "..", "scripts", "mock_path")
+        make_env = {"PATH": f"{os.path.abspath(mock_path)}:{os.environ['PATH']}"}
+
+        # Only outputs of the mock programs are checked.
+        result = ghcc.unsafe_make(repo, timeout=60, env=make_env)
+        self.assertTrue(result.success, result.captured_output)
+        self.assertEqual(["main.o", "main", "linked.o"], result.elf_files)
+        self.assertEqual("relocatable", result.elf_info[0].elf_type)
+
+        # All unversioned files are checked without the manifest.
+        result = ghcc.compile._make_skeleton(repo, timeout=60, env=make_env, make_fn=ghcc.compile._unsafe_make)
+        self.assertEqual({"main.o", "main", "linked.o", "main.copy"}, set(result.elf_files))
+
+        # Without the mock programs, the manifest is empty and all unversioned files are checked.
+        result = ghcc.unsafe_make(repo, timeout=60, env={"PATH": os.environ["PATH"]})
+        self.assertTrue(result.success, result.captured_output)
+        self.assertEqual({"main.o", "main", "linked.o", "main.copy"}, set(result.elf_files))
+
+        # ELF headers read while collecting binaries are reused when moving them.
+        binary_dir = os.path.join(self.tempdir.name, "bin")
+        os.makedirs(binary_dir)
+
+        def compile_fn(directory, timeout=None, env=None, **kwargs):
+            return ghcc.unsafe_make(directory, timeout=timeout, env={**(env or {}), **make_env}, **kwargs)
+
+        with mock.patch.object(ghcc.compile, "read_elf_header", wraps=ghcc.read_elf_header) as read_elf_header:
+            entries = list(ghcc.compile_and_move(binary_dir, repo, [repo], compile_timeout=60, compile_fn=compile_fn))
+        self.assertEqual(["main.o", "main", "linked.o"], entries[0]["binaries"])
+        self.assertEqual("relocatable", entries[0]["elf_type"][0])
+        self.assertEqual(3, read_elf_header.call_count)
+
+    def test_read_elf_header(self) -> None:
+        source = os.path.join(self.tempdir.name, "main.c")
+        with open(source, "w") as f:
+            f.write("int main() { return 0; }\n")
+        outputs = {
+            "main.o": (["-c"], "relocatable"),
+            "main": (["-no-pie"], "executable"),
+            "main_pie": (["-fPIE", "-pie"], "pie-executable"),
+            "libmain.so": (["-fPIC", "-shared"], "shared-object"),
+        }
+        for name, (flags, elf_type) in outputs.items():
+            flutes.run_command(["gcc", *flags, source, "-o", name], cwd=self.tempdir.name)
+            info = ghcc.read_elf_header(os.path.join(self.tempdir.name, name))
+            self.assertIsNotNone(info)
+            self.assertEqual(elf_type, info.elf_type)
+            # Compare with the output of `file`, which was used before.
+            output = subprocess.check_output(["file", os.path.join(self.tempdir.name, name)]).decode("utf-8")
+            self.assertIn(f"ELF {info.elf_class}-bit", output)
+
+        self.assertIsNone(ghcc.read_elf_header(source))
+        self.assertIsNone(ghcc.read_elf_header(os.path.join(self.tempdir.name, "nonexistent")))
+
+
+class ConcurrentCompileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_group_nested_dirs(self) -> None:
+        dirs = ["/repo/a", "/repo/b", "/repo/a/x/nested", "/repo/ab", "/repo/b/nested", "/repo/a/x"]
+        self.assertEqual([["/repo/a", "/repo/a/x/nested", "/repo/a/x"], ["/repo/b", "/repo/b/nested"], ["/repo/ab"]],
+                         ghcc.compile._group_nested_dirs(dirs))
+
+    def _create_repo(self) -> str:
+        repo = os.path.join(self.tempdir.name, "repo")
+        makefile = "all:\n\tgcc main.c -o {name}\n"
+        for directory in ["a", "a/nested", "b", "c"]:
+            os.makedirs(os.path.join(repo, directory))
+            with open(os.path.join(repo, directory, "main.c"), "w") as f:
+                f.write("int main() { return 0; }\n")
+            with open(os.path.join(repo, directory, "Makefile"), "w") as f:
+                f.write(makefile.format(name=directory.replace("/", "_")))
+        env = {
+            "GIT_AUTHOR_NAME": "ghcc", "GIT_AUTHOR_EMAIL": "ghcc@localhost",
+            "GIT_COMMITTER_NAME": "ghcc", "GIT_COMMITTER_EMAIL": "ghcc@localhost",
+        }
+        flutes.run_command(["git", "init", "-q"], cwd=repo)
+        flutes.run_command(["git", "add", "."], cwd=repo)
+        flutes.run_command(["git", "commit", "-q", "-m", "init"], cwd=repo, env=env)
+        return repo
+
+    def _compile_and_move(self, repo: str, num_workers: int) -> List[ghcc.RepoDB.MakefileEntry]:
+        binary_dir = os.path.join(self.tempdir.name, "bin")
+        os.makedirs(binary_dir, exist_ok=True)
+        mock_path = os.path.join(os.path.dirname(__file__), "..", "scripts", "mock_path")
+        path = f"{os.path.abspath(mock_path)}:{os.environ['PATH']}"
+
+        def compile_fn(directory, timeout=None, env=None, **kwargs):
+            return ghcc.unsafe_make(directory, timeout=timeout, env={**(env or {}), "PATH": path}, **kwargs)
+
+        makefile_dirs = ghcc.index_build_files(repo).makefile_dirs
+        return list(ghcc.compile_and_move(
+            binary_dir, repo, makefile_dirs, compile_timeout=60, compile_fn=compile_fn, use_snapshot=True,
+            num_workers=num_workers))
+
+    def test_concurrent_compile_and_move(self) -> None:
+        repo = self._create_repo()
+        binary_dir = os.path.join(self.tempdir.name, "bin")
+        makefile_dirs = ghcc.index_build_files(repo).makefile_dirs
+        entries = self._compile_and_move(repo, num_workers=3)
+        directories = [os.path.relpath(entry["directory"], repo) for entry in entries]
+        self.assertEqual(sorted(makefile_dirs), sorted(entry["directory"] for entry in entries))
+        self.assertLess(directories.index("a"), directories.index(os.path.join("a", "nested")))
+        for entry in entries:
+            self.assertTrue(entry["success"])
+            self.assertEqual(1, len(entry["binaries"]))
+            self.assertTrue(os.path.exists(os.path.join(binary_dir, entry["sha256"][0])))
+        self.assertTrue(ghcc.is_clean(repo))
+
+    def test_concurrent_restore_failure(self) -> None:
+        repo = self._create_repo()
+        restore = ghcc.WorkspaceSnapshot.restore
+
+        def restore_fn(workspace: ghcc.WorkspaceSnapshot) -> bool:
+            # Fail to restore the part of the workspace for one group, while other groups are building.
+            if workspace.is_subtree and os.path.basename(workspace._root) == "b":
+                return False
+            return restore(workspace)
+
+        with mock.patch.object(ghcc.WorkspaceSnapshot, "restore", autospec=True, side_effect=restore_fn), \
+                mock.patch.object(ghcc.compile, "clean", wraps=ghcc.clean) as clean:
+            entries = self._compile_and_move(repo, num_workers=3)
+        # The repository is only cleaned with Git once all Makefiles are compiled.
+        clean.assert_called_once_with(repo)
+        entries = {os.path.relpath(entry["directory"], repo): entry for entry in entries}
+        self.assertEqual({"a", os.path.join("a", "nested"), "b", "c"}, set(entries.keys()))
+        self.assertFalse(entries["b"]["success"])
+        self.assertEqual([], entries["b"]["binaries"])
+        for directory in ["a", os.path.join("a", "nested"), "c"]:
+            self.assertTrue(entries[directory]["success"])
+        self.assertTrue(ghcc.is_clean(repo))
+
+    def test_clean_after_compile_and_move(self) -> None:
+        repo = self._create_repo()
+        for num_workers in [1, 3]:
+            # Untracked files present when the snapshot is taken, e.g. the CMake build folder.
+            os.makedirs(os.path.join(repo, "ghcc_build"))
+            with open(os.path.join(repo, "ghcc_build", "CMakeCache.txt"), "w") as f:
+                f.write("\n")
+            entries = self._compile_and_move(repo, num_workers)
+            self.assertEqual(4, len(entries))
+            self.assertTrue(ghcc.is_clean(repo))
@@ -0,0 +1,194 @@
+import time
+import unittest
+from typing import Any, Dict, List, Optional
+
+import pymongo
+
+import ghcc
+
+
+_OPERATORS = {
+    "$in": lambda value, arg: value in arg,
+    "$ne": lambda value, arg: value != arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$size": lambda value, arg: isinstance(value, list) and len(value) == arg,
+}
+
+
+def _matches(entry: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(entry, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(_matches(entry, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            for op, arg in condition.items():
+                if op == "$exists":
+                    if (key in entry) != arg:
+                        return False
+                elif not _OPERATORS[op](entry.get(key), arg):
+                    return False
+        elif entry.get(key) != condition:
+            return False
+    return True
+
+
+class FakeCollection:
+    r"""An in-memory stand-in for a MongoDB collection, supporting the queries used by :class:`ghcc.RepoDB`."""
+
+    def __init__(self, entries: Optional[List[Dict[str, Any]]] = None):
+        self.entries = entries or []
+        self.fetched: List[Dict[str, Any]] = []  # all entries returned by queries
+        self.batches: List[int] = []  # sizes of batches written by `bulk_write`
+        self.errors: List[Exception] = []  # exceptions to raise in the next calls to `bulk_write`
+
+    def find(self, query: Dict[str, Any], projection: Optional[Dict[str, bool]] = None):
+        results = [entry for entry in self.entries if _matches(entry, query)]
+        self.fetched.extend(results)
+        return iter(results)
+
+    def find_one(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return next(self.find(query), None)
+
+    def _update_one(self, operation: pymongo.UpdateOne) -> None:
+        update = operation._doc
+        for entry in self.entries:
+            if _matches(entry, operation._filter):
+                entry.update(update["$set"])
+                return
+        if operation._upsert:
+            self.entries.append({**operation._filter, **update.get("$setOnInsert", {}), **update["$set"]})
+
+    def bulk_write(self, operations: List[pymongo.UpdateOne], ordered: bool = True) -> None:
+        self.batches.append(len(operations))
+        if len(self.errors) > 0:
+            error = self.errors.pop(0)
+            if isinstance(error, pymongo.errors.BulkWriteError):
+                # Apply operations before the failed one.
+                for operation in operations[:error.details["writeErrors"][0]["index"]]:
+                    self._update_one(operation)
+            raise error
+        for operation in operations:
+            self._update_one(operation)
+
+    def get(self, repo_owner: str, repo_name: str) -> Optional[Dict[str, Any]]:
+        return next((entry for entry in self.entries
+                     if entry["repo_owner"] == repo_owner and entry["repo_name"] == repo_name), None)
+
+
+def _create_repo_db(collection: FakeCollection) -> ghcc.RepoDB:
+    # Skip the constructor, which connects to the DB.
+    db = ghcc.RepoDB.__new__(ghcc.RepoDB)
+    db.collection = collection
+    return db
+
+
+class RepoDBTest(unittest.TestCase):
+    def test_get_many(self) -> None:
+        entries = [
+            {"repo_owner": owner, "repo_name": name, "compiled": True}
+            for owner in ["A", "B"] for name in ["X", "Y"]
+        ]
+        collection = FakeCollection(entries)
+        db = _create_repo_db(collection)
+        result = db.get_many([("A", "X"), ("B", "Y"), ("C", "Z")])
+        self.assertEqual({("A", "X"), ("B", "Y")}, set(result.keys()))
+        # Entries of other combinations of the owners and names are not fetched.
+        self.assertEqual({("A", "X"), ("B", "Y")},
+                         {(entry["repo_owner"], entry["repo_name"]) for entry in collection.fetched})
+        self.assertEqual({}, db.get_many([]))
+
+    def test_find_build(self) -> None:
+        build = {"tree_hash": "tree", "build_key": "key", "compiled": True, "binary_dir": "dir", "num_binaries": 1}
+        entries = [
+            # Makefiles are not stored due to Unicode encoding errors, so binaries cannot be reused.
+            {"repo_owner": "A", "repo_name": "X", **build, "makefiles": []},
+            {"repo_owner": "B", "repo_name": "Y", **build, "makefiles": [{"binaries": ["a.out"]}]},
+        ]
+        db = _create_repo_db(FakeCollection(entries))
+        entry = db.find_build("tree", "key")
+        self.assertEqual(("B", "Y"), (entry["repo_owner"], entry["repo_name"]))
+        self.assertIsNone(db.find_build("tree", "key", exclude=("B", "Y")))
+
+
+class RepoDBWriterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.collection = FakeCollection()
+        self.db = _create_repo_db(self.collection)
+
+    def _add_repos(self, writer: ghcc.RepoDBWriter, names: List[str]) -> None:
+        for name in names:
+            writer.add_repo("owner", name, "master", "", "", True, repo_size=1)
+
+    def test_batching(self) -> None:
+        writer = ghcc.RepoDBWriter(self.db, batch_size=3, flush_interval=None)
+        self._add_repos(writer, ["a", "b"])
+        self.assertEqual([], self.collection.batches)
+        self._add_repos(writer, ["c"])
+        self.assertEqual([3], self.collection.batches)
+        self._add_repos(writer, ["d"])
+        writer.close()  # remaining operations are flushed on close
+        self.assertEqual([3, 1], self.collection.batches)
+        self.assertEqual(["a", "b", "c", "d"], [entry["repo_name"] for entry in self.collection.entries])
+
+    def test_periodic_flush(self) -> None:
+        writer = ghcc.RepoDBWriter(self.db, batch_size=100, flush_interval=0.01)
+        self._add_repos(writer, ["a"])
+        for _ in range(200):
+            if len(self.collection.entries) > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(self.collection.entries))
+        writer.close()
+
+    def test_write_failures(self) -> None:
+        writer = ghcc.RepoDBWriter(self.db, batch_size=2, flush_interval=None)
+        # Failures in flushes triggered by full buffers are logged, and operations are kept for the next flush.
+        self.collection.errors.append(pymongo.errors.AutoReconnect("connection lost"))
+        self._add_repos(writer, ["a", "b"])
+        self.assertEqual([], self.collection.entries)
+        writer.flush()
+        self.assertEqual(["a", "b"], [entry["repo_name"] for entry in self.collection.entries])
+
+        writer.close()
+
+        # The operation rejected by the DB is dropped, and the following operations are retried.
+        writer = ghcc.RepoDBWriter(self.db, batch_size=100, flush_interval=None)
+        self.collection.errors.append(pymongo.errors.BulkWriteError(
+            {"writeErrors": [{"index": 1, "code": 2, "errmsg": "invalid"}]}))
+        self._add_repos(writer, ["c", "d", "e"])
+        with self.assertRaises(pymongo.errors.BulkWriteError):
+            writer.flush()
+        writer.close()
+        self.assertEqual(["a", "b", "c", "e"], [entry["repo_name"] for entry in self.collection.entries])
+
+    def test_update_missing_entry(self) -> None:
+        writer = ghcc.RepoDBWriter(self.db, flush_interval=None)
+        self._add_repos(writer, ["a"])
+        makefiles = [{"directory": ".", "success": True, "binaries": ["a.out"], "sha256": ["0" * 64]}]
+        self.assertTrue(writer.update_makefile("owner", "a", makefiles, compile_time=1.0))
+        # Updates of entries that do not exist create them, instead of being silently ignored.
+        self.assertTrue(writer.update_makefile("owner", "b", makefiles))
+        writer.update_stats("owner", "c", {"clone": 1.0}, 0, 0)
+        writer.close()
+        entry = self.collection.get("owner", "a")
+        self.assertEqual((True, 1, 1, 1.0), (entry["compiled"], entry["num_binaries"], entry["repo_size"],
+                                             entry["compile_time"]))
+        entry = self.collection.get("owner", "b")
+        self.assertEqual((True, 1, -1), (entry["compiled"], entry["num_binaries"], entry["repo_size"]))
+        entry = self.collection.get("owner", "c")
+        self.assertEqual((False, {"clone": 1.0}), (entry["compiled"], entry["timings"]))
+
+    def test_update_unencodable_makefiles(self) -> None:
+        writer = ghcc.RepoDBWriter(self.db, flush_interval=None)
+        makefiles = [{"directory": "\udc80", "success": True, "binaries": ["a.out"], "sha256": ["0" * 64]}]
+        self.assertFalse(writer.update_makefile("owner", "a", makefiles, tree_hash="tree", build_key="key",
+                                                binary_dir="dir"))
+        writer.close()
+        entry = self.collection.get("owner", "a")
+        self.assertEqual(([], 1), (entry["makefiles"], entry["num_binaries"]))
+        # The build is not recorded for reuse.
+        self.assertNotIn("tree_hash", entry)
+        self.assertIsNone(self.db.find_build("tree", "key"))
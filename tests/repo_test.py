@@ -1,9 +1,22 @@
+import asyncio
 import os
+import shutil
+import subprocess
 import tempfile
 import unittest
+from typing import Dict
+
+import flutes
 
 import ghcc
 
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "ghcc",
+    "GIT_AUTHOR_EMAIL": "ghcc@localhost",
+    "GIT_COMMITTER_NAME": "ghcc",
+    "GIT_COMMITTER_EMAIL": "ghcc@localhost",
+}
+
 
 class RepoCloneTest(unittest.TestCase):
     def setUp(self) -> None:
@@ -28,3 +41,281 @@ class RepoCloneTest(unittest.TestCase):
         result = ghcc.clone("torvalds", "linux", clone_folder=self.tempdir.name, timeout=1)
         self.assertFalse(result.success, msg=result.captured_output)
         self.assertEqual(ghcc.CloneErrorType.Timeout, result.error_type, msg=result.captured_output)
+
+    def _create_repo(self, name: str, files: Dict[str, str]) -> str:
+        # Create a local repository with a single commit containing the specified files.
+        repo_path = os.path.join(self.tempdir.name, "remotes", name)
+        os.makedirs(repo_path)
+        flutes.run_command(["git", "init", "-q"], cwd=repo_path)
+        # Allow partial clones from this repository.
+        flutes.run_command(["git", "config", "uploadpack.allowFilter", "true"], cwd=repo_path)
+        for path, content in files.items():
+            os.makedirs(os.path.join(repo_path, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(repo_path, path), "w") as f:
+                f.write(content)
+        flutes.run_command(["git", "add", "."], cwd=repo_path)
+        flutes.run_command(["git", "commit", "-q", "-m", "init"], cwd=repo_path, env=GIT_ENV)
+        return repo_path
+
+    def test_repo_status(self) -> None:
+        repo_path = self._create_repo("repo", {"main.c": "int main() { return 0; }\n"})
+        commit = ghcc.get_head_commit(repo_path)
+        self.assertIsNotNone(commit)
+        self.assertTrue(ghcc.is_clean(repo_path))
+
+        # Build products are untracked files.
+        with open(os.path.join(repo_path, "main.o"), "w") as f:
+            f.write("\x7fELF")
+        self.assertFalse(ghcc.is_clean(repo_path))
+        ghcc.clean(repo_path)
+        self.assertTrue(ghcc.is_clean(repo_path))
+        self.assertEqual(commit, ghcc.get_head_commit(repo_path))
+
+        self.assertIsNone(ghcc.get_head_commit(self.tempdir.name))
+
+    def test_probe_clone(self) -> None:
+        c_repo = self._create_repo("c_repo", {
+            "Makefile": "all:\n\tgcc src/main.c\n",
+            "src/main.c": "int main() { return 0; }\n",
+        })
+        js_repo = self._create_repo("js_repo", {
+            "package.json": "{}\n",
+            "index.js": "console.log('hello');\n",
+            "Makefile": "all:\n\tnpm run build\n",
+        })
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+
+        result = ghcc.clone("owner", "c_repo", clone_folder=clone_folder, probe=True, url=f"file://{c_repo}")
+        self.assertTrue(result.success, msg=result.captured_output)
+        self.assertIsNone(result.error_type)
+        with open(os.path.join(clone_folder, "owner", "c_repo", "src", "main.c")) as f:
+            self.assertEqual("int main() { return 0; }\n", f.read())
+        self.assertTrue(ghcc.is_clean(os.path.join(clone_folder, "owner", "c_repo")))
+
+        result = ghcc.clone("owner", "js_repo", clone_folder=clone_folder, probe=True, url=f"file://{js_repo}")
+        self.assertTrue(result.success, msg=result.captured_output)
+        self.assertEqual(ghcc.CloneErrorType.NotCRepository, result.error_type)
+        self.assertFalse(os.path.exists(os.path.join(clone_folder, "owner", "js_repo")))
+
+    def test_object_cache(self) -> None:
+        files = {
+            "Makefile": "all:\n\tgcc main.c\n",
+            "main.c": "int main() { return 0; }\n",
+            "data.txt": "data\n" * 10000,
+        }
+        upstream = self._create_repo("upstream/project", files)
+        fork = self._create_repo("fork/project", {**files, "fork.c": "int fork;\n"})
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+        cache = ghcc.ObjectCache(os.path.join(self.tempdir.name, "cache"))
+
+        cache_path = os.path.join(cache.cache_folder, "project.git")
+        for owner, path in [("upstream", upstream), ("upstream", upstream), ("fork", fork)]:
+            shutil.rmtree(os.path.join(clone_folder, owner), ignore_errors=True)
+            result = ghcc.clone(owner, "project", clone_folder=clone_folder, url=f"file://{path}",
+                                object_cache=cache)
+            self.assertTrue(result.success, msg=result.captured_output)
+            repo_path = os.path.join(clone_folder, owner, "project")
+            self.assertTrue(os.path.exists(os.path.join(repo_path, "main.c")))
+            # Clones must not depend on the cache.
+            self.assertFalse(os.path.exists(os.path.join(repo_path, ".git", "objects", "info", "alternates")))
+            flutes.run_command(["git", "fsck"], cwd=repo_path)
+            # Entries are only created once another repository with the same key is cloned.
+            self.assertEqual(owner == "fork", os.path.exists(cache_path))
+        self.assertTrue(os.path.exists(os.path.join(clone_folder, "fork", "project", "fork.c")))
+
+        refs = flutes.run_command(["git", "for-each-ref", "--format=%(refname)"], cwd=cache_path,
+                                  return_output=True).captured_output.decode().split()
+        self.assertEqual(["refs/ghcc/fork/project"], sorted(refs))
+
+        # Evict everything when the cache is too large.
+        cache.max_size = 1
+        cache.evict()
+        self.assertFalse(os.path.exists(cache_path))
+
+    def test_object_cache_fork_behind(self) -> None:
+        # The upstream has commits c1 -> c2, while the fork is still at c1.
+        upstream = self._create_repo("upstream/project", {"main.c": "int main() { return 0; }\n"})
+        fork = os.path.join(self.tempdir.name, "remotes", "fork", "project")
+        flutes.run_command(["git", "clone", "-q", upstream, fork])
+        with open(os.path.join(upstream, "main.c"), "a") as f:
+            f.write("int x;\n")
+        flutes.run_command(["git", "commit", "-q", "-am", "update"], cwd=upstream, env=GIT_ENV)
+        # Forks share objects with the upstream on the server (as on GitHub), so the server knows about c2.
+        flutes.run_command(["git", "fetch", "-q"], cwd=fork)
+        other = os.path.join(self.tempdir.name, "remotes", "other", "project")
+        flutes.run_command(["git", "clone", "-q", upstream, other])
+
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+        cache = ghcc.ObjectCache(os.path.join(self.tempdir.name, "cache"))
+        # Clones of the upstream and another fork create the cache entry, which contains c2.
+        for owner, path in [("upstream", upstream), ("other", other), ("fork", fork)]:
+            result = ghcc.clone(owner, "project", clone_folder=clone_folder, url=f"file://{path}",
+                                object_cache=cache)
+            self.assertTrue(result.success, msg=result.captured_output)
+            repo_path = os.path.join(clone_folder, owner, "project")
+            self.assertEqual(ghcc.get_head_commit(path), ghcc.get_head_commit(repo_path))
+            flutes.run_command(["git", "fsck"], cwd=repo_path)
+
+    def test_submodule_cache(self) -> None:
+        library = self._create_repo("library", {"lib.c": "int lib() { return 0; }\n"})
+        library_commit = ghcc.get_head_commit(library)
+        # The submodule URL is unreachable, so the submodule can only be obtained from the mirror.
+        library_url = "https://example.invalid/owner/library.git"
+        repo = self._create_repo("repo", {
+            "Makefile": "all:\n\tgcc main.c lib/lib.c\n",
+            "main.c": "int main() { return 0; }\n",
+            ".gitmodules": f'[submodule "lib"]\n\tpath = lib\n\turl = {library_url}\n',
+        })
+        flutes.run_command(["git", "update-index", "--add", "--cacheinfo", f"160000,{library_commit},lib"],
+                           cwd=repo)
+        flutes.run_command(["git", "commit", "-q", "-m", "add submodule"], cwd=repo, env=GIT_ENV)
+
+        cache = ghcc.SubmoduleCache(os.path.join(self.tempdir.name, "cache"))
+        flutes.run_command(["git", "clone", "-q", "--mirror", library, cache.get_mirror_path(library_url)])
+        self.assertEqual(cache.get_mirror_path(library_url),
+                         cache.ensure(library_url, library_commit, timeout=10))
+
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+        result = ghcc.clone("owner", "repo", clone_folder=clone_folder, url=f"file://{repo}", recursive=True,
+                            submodule_cache=cache)
+        self.assertTrue(result.success, msg=result.captured_output)
+        self.assertIsNone(result.error_type, msg=result.captured_output)
+        repo_path = os.path.join(clone_folder, "owner", "repo")
+        self.assertTrue(os.path.exists(os.path.join(repo_path, "lib", "lib.c")))
+        self.assertEqual(library_commit, ghcc.get_head_commit(os.path.join(repo_path, "lib")))
+        # The submodule should still point to the original remote.
+        remote_url = flutes.run_command(["git", "config", "remote.origin.url"], cwd=os.path.join(repo_path, "lib"),
+                                        return_output=True).captured_output
+        self.assertEqual(library_url, remote_url.decode("utf-8").strip())
+
+    def test_pinned_clone(self) -> None:
+        repo = self._create_repo("repo", {"main.c": "int main() { return 0; }\n"})
+        flutes.run_command(["git", "tag", "v1.0"], cwd=repo)
+        first_commit = ghcc.get_head_commit(repo)
+        with open(os.path.join(repo, "main.c"), "w") as f:
+            f.write("int main() { return 1; }\n")
+        flutes.run_command(["git", "commit", "-q", "-am", "update"], cwd=repo, env=GIT_ENV)
+        last_commit = ghcc.get_head_commit(repo)
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+
+        for kwargs, expected_commit in [({}, last_commit), ({"commit": first_commit}, first_commit),
+                                        ({"tag": "v1.0"}, first_commit)]:
+            result = ghcc.clone("owner", "repo", clone_folder=clone_folder, url=f"file://{repo}",
+                                skip_if_exists=False, **kwargs)
+            self.assertTrue(result.success, msg=result.captured_output)
+            repo_path = os.path.join(clone_folder, "owner", "repo")
+            self.assertEqual(expected_commit, ghcc.get_head_commit(repo_path))
+            self.assertTrue(ghcc.is_clean(repo_path))
+            self.assertTrue(os.path.exists(os.path.join(repo_path, "main.c")))
+
+        result = ghcc.clone("owner", "repo", clone_folder=clone_folder, url=f"file://{repo}", skip_if_exists=False,
+                            commit="0" * 40)
+        self.assertFalse(result.success)
+        self.assertFalse(os.path.exists(os.path.join(clone_folder, "owner", "repo")))
+
+    def test_clone_async(self) -> None:
+        repo = self._create_repo("repo", {"main.c": "int main() { return 0; }\n"})
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+
+        async def clone_all():
+            return await asyncio.gather(*[
+                ghcc.clone_async("owner", "repo", clone_folder=clone_folder, folder_name=f"repo{idx}",
+                                 url=f"file://{repo}", recursive=True)
+                for idx in range(4)])
+
+        for idx, result in enumerate(asyncio.run(clone_all())):
+            self.assertTrue(result.success, msg=result.captured_output)
+            repo_path = os.path.join(clone_folder, f"repo{idx}")
+            self.assertEqual(ghcc.get_head_commit(repo), ghcc.get_head_commit(repo_path))
+            self.assertTrue(ghcc.is_clean(repo_path))
+
+        result = asyncio.run(ghcc.clone_async("owner", "repo", clone_folder=clone_folder,
+                                              url=f"file://{self.tempdir.name}/nonexistent"))
+        self.assertFalse(result.success)
+        self.assertEqual(ghcc.CloneErrorType.Unknown, result.error_type)
+
+    def test_worktree(self) -> None:
+        repo = self._create_repo("repo", {"main.c": "int main() { return 0; }\n"})
+        flutes.run_command(["git", "tag", "v1.0"], cwd=repo)
+        first_commit = ghcc.get_head_commit(repo)
+        with open(os.path.join(repo, "main.c"), "w") as f:
+            f.write("int main() { return 1; }\n")
+        flutes.run_command(["git", "commit", "-q", "-am", "update"], cwd=repo, env=GIT_ENV)
+        flutes.run_command(["git", "tag", "v2.0"], cwd=repo)
+        clone_folder = os.path.join(self.tempdir.name, "clones")
+        result = ghcc.clone("owner", "repo", clone_folder=clone_folder, url=f"file://{repo}", tag="v2.0")
+        self.assertTrue(result.success, msg=result.captured_output)
+        repo_path = os.path.join(clone_folder, "owner", "repo")
+
+        worktree_path = os.path.join(clone_folder, "owner_____repo@1")
+        for kwargs in [{"tag": "v1.0"}, {"commit": first_commit}]:
+            self.assertTrue(ghcc.add_worktree(repo_path, worktree_path, **kwargs))
+            self.assertEqual(first_commit, ghcc.get_head_commit(worktree_path))
+            with open(os.path.join(worktree_path, "main.c")) as f:
+                self.assertEqual("int main() { return 0; }\n", f.read())
+            # The base repository is unaffected.
+            with open(os.path.join(repo_path, "main.c")) as f:
+                self.assertEqual("int main() { return 1; }\n", f.read())
+            ghcc.remove_worktree(repo_path, worktree_path)
+            self.assertFalse(os.path.exists(worktree_path))
+            self.assertTrue(ghcc.is_clean(repo_path))
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            ghcc.add_worktree(repo_path, worktree_path, tag="v3.0")
+
+    def test_tree_hash(self) -> None:
+        files = {"main.c": "int main() { return 0; }\n", "src/util.h": "#pragma once\n"}
+        repo = self._create_repo("repo", files)
+        # A repository with a different history but the same contents, e.g., a squashed fork.
+        fork = self._create_repo("fork", {"README": "fork\n"})
+        flutes.run_command(["git", "rm", "-q", "README"], cwd=fork)
+        for path, content in files.items():
+            os.makedirs(os.path.join(fork, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(fork, path), "w") as f:
+                f.write(content)
+        flutes.run_command(["git", "add", "."], cwd=fork)
+        flutes.run_command(["git", "commit", "-q", "-m", "replace"], cwd=fork, env=GIT_ENV)
+
+        self.assertNotEqual(ghcc.get_head_commit(repo), ghcc.get_head_commit(fork))
+        self.assertEqual(ghcc.get_tree_hash(repo), ghcc.get_tree_hash(fork))
+        # Build products do not affect the tree hash.
+        with open(os.path.join(repo, "main.o"), "w") as f:
+            f.write("\x7fELF")
+        self.assertEqual(ghcc.get_tree_hash(repo), ghcc.get_tree_hash(fork))
+        self.assertIsNone(ghcc.get_tree_hash(self.tempdir.name))
+
+    def test_skip_missing_files(self) -> None:
+        repo = self._create_repo("repo", {"main.c": "int main() {}\n", "doc/README": "\n"})
+        shutil.rmtree(os.path.join(repo, "doc"))
+        ghcc.skip_missing_files(repo)
+        # Files missing from a partially extracted tree are not restored by cleaning.
+        ghcc.clean(repo)
+        self.assertFalse(os.path.exists(os.path.join(repo, "doc")))
+        self.assertTrue(ghcc.is_clean(repo))
+
+    def test_workspace_snapshot(self) -> None:
+        repo = self._create_repo("repo", {"main.c": "int main() {}\n", "src/util.c": "\n", "src/util.h": "\n"})
+        # Untracked files present when the snapshot is taken are kept.
+        os.makedirs(os.path.join(repo, "build"))
+        with open(os.path.join(repo, "build", "Makefile"), "w") as f:
+            f.write("all:\n")
+        snapshot = ghcc.WorkspaceSnapshot(repo)
+
+        # Simulate a build that creates, modifies, and deletes files.
+        os.makedirs(os.path.join(repo, "obj", "src"))
+        for path in ["main.o", "obj/src/util.o", "build/main"]:
+            with open(os.path.join(repo, path), "w") as f:
+                f.write("\x7fELF")
+        with open(os.path.join(repo, "main.c"), "a") as f:
+            f.write("// modified\n")
+        os.remove(os.path.join(repo, "src", "util.h"))
+        self.assertTrue(snapshot.restore())
+        self.assertTrue(os.path.exists(os.path.join(repo, "build", "Makefile")))
+        self.assertFalse(os.path.exists(os.path.join(repo, "build", "main")))
+
+        # Untracked files from the snapshot cannot be restored if they are modified.
+        with open(os.path.join(repo, "build", "Makefile"), "a") as f:
+            f.write("\tmake -C ..\n")
+        self.assertFalse(snapshot.restore())
+        ghcc.clean(repo)
+        self.assertTrue(ghcc.is_clean(repo))
@@ -0,0 +1,245 @@
+import asyncio
+import io
+import json
+import os
+import pickle
+import stat
+import subprocess
+import tempfile
+import time
+import unittest
+import urllib.request
+
+import ghcc
+
+
+def _square_or_stop(x: int):
+    time.sleep(0.001)
+    return ("stopped", x) if x % 3 == 0 else x * x
+
+
+def _negate(x: int) -> int:
+    return -x
+
+
+def _finish(x: int):
+    return ("done", x)
+
+
+def _is_final(result) -> bool:
+    return isinstance(result, tuple)
+
+
+async def _sleep_command(x: int) -> int:
+    await ghcc.utils.run_command_async(["sleep", "0.5"])
+    return x
+
+
+class StagedExecutorTest(unittest.TestCase):
+    def _test_executor(self, executor_class) -> None:
+        executor = executor_class(
+            [
+                ghcc.utils.Stage("square", _square_or_stop, 3),
+                ghcc.utils.Stage("negate", _negate, 2),
+                ghcc.utils.Stage("finish", _finish, 1),
+            ],
+            is_final=_is_final,
+            queue_size=2,
+        )
+        results = list(executor.run(range(30)))
+        expected = [
+            ("stopped", x) if x % 3 == 0 else ("done", -x * x) for x in range(30)
+        ]
+        self.assertEqual(sorted(expected), sorted(results))
+        self.assertEqual([0, 0, 0], executor.busy_workers())
+
+    def test_staged_executor(self) -> None:
+        self._test_executor(ghcc.utils.StagedExecutor)
+
+    def test_async_staged_executor(self) -> None:
+        self._test_executor(ghcc.utils.AsyncStagedExecutor)
+
+    def test_async_stage_function(self) -> None:
+        # Coroutine stages are not bounded by threads: 100 commands run at the same time.
+        executor = ghcc.utils.AsyncStagedExecutor(
+            [ghcc.utils.Stage("sleep", _sleep_command, 100)],
+            is_final=_is_final,
+        )
+        start_time = time.time()
+        results = list(executor.run(range(100)))
+        self.assertEqual(list(range(100)), sorted(results))
+        self.assertLess(time.time() - start_time, 5.0)
+
+    def test_run_command_async(self) -> None:
+        result = asyncio.run(
+            ghcc.utils.run_command_async(["echo", "hello"], return_output=True)
+        )
+        self.assertEqual(b"hello\n", result.captured_output)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            asyncio.run(
+                ghcc.utils.run_command_async(["sh", "-c", "echo error; exit 3"])
+            )
+        self.assertEqual(b"error\n", cm.exception.output)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            asyncio.run(ghcc.utils.run_command_async(["sleep", "10"], timeout=0.1))
+        result = asyncio.run(
+            ghcc.utils.run_command_async(
+                ["sleep", "10"], timeout=0.1, ignore_errors=True
+            )
+        )
+        self.assertEqual(-32768, result.return_code)
+
+
+class JSONStreamTest(unittest.TestCase):
+    def test_iter_json_array(self) -> None:
+        data = {
+            "version": {"nested": [1, 2, {"repos": "not this one"}]},
+            "repos": [
+                {"url": f"https://github.com/owner/repo{idx}", "tag": 'v1.0 "}]'}
+                for idx in range(100)
+            ]
+            + [12345, "string", [], {}, None, 1.5e-10],
+            "trailing": "ignored",
+        }
+        text = json.dumps(data, indent=2)
+        for buffer_size in [1, 7, 4096]:
+            values = list(
+                ghcc.utils.iter_json_array(
+                    io.StringIO(text), ["repos"], buffer_size=buffer_size
+                )
+            )
+            self.assertEqual(data["repos"], values)
+
+        self.assertEqual(
+            [],
+            list(ghcc.utils.iter_json_array(io.StringIO('{"repos": [ ]}'), ["repos"])),
+        )
+        self.assertEqual(
+            [1, 2],
+            list(ghcc.utils.iter_json_array(io.StringIO("[1,2]"), buffer_size=1)),
+        )
+        with self.assertRaises(ValueError):
+            list(ghcc.utils.iter_json_array(io.StringIO('{"other": []}'), ["repos"]))
+
+    def test_stop_early(self) -> None:
+        # Only the consumed part of the file should be read.
+        f = io.StringIO("[" + ", ".join(["0"] * 100000) + "]")
+        iterator = ghcc.utils.iter_json_array(f, buffer_size=16)
+        self.assertEqual([0] * 5, [next(iterator) for _ in range(5)])
+        self.assertLess(f.tell(), 100)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self) -> None:
+        registry = ghcc.utils.MetricsRegistry()
+        counter = registry.counter("items_total", "Processed items.", ["status"])
+        gauge = registry.gauge("queue_depth", "Queue depth.")
+        histogram = registry.histogram(
+            "latency_seconds", "Latency.", ["stage"], buckets=[1, 10]
+        )
+        counter.inc(status="ok")
+        counter.inc(2, status='a "quoted" value')
+        registry.add_collect_hook(lambda: gauge.set(5))
+        for value in [0.5, 2, 20]:
+            histogram.observe(value, stage="clone")
+        with self.assertRaises(ValueError):
+            counter.inc(wrong_label="ok")
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE items_total counter", lines)
+        self.assertIn('items_total{status="ok"} 1', lines)
+        self.assertIn('items_total{status="a \\"quoted\\" value"} 2', lines)
+        self.assertIn("queue_depth 5", lines)
+        self.assertIn('latency_seconds_bucket{stage="clone",le="1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{stage="clone",le="10"} 2', lines)
+        self.assertIn('latency_seconds_bucket{stage="clone",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_sum{stage="clone"} 22.5', lines)
+        self.assertIn('latency_seconds_count{stage="clone"} 3', lines)
+
+    def test_server(self) -> None:
+        registry = ghcc.utils.MetricsRegistry()
+        registry.counter("items_total", "Processed items.").inc()
+        server = ghcc.utils.MetricsServer(registry, port=0)
+        try:
+            url = f"http://127.0.0.1:{server.port}/metrics"
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode("utf-8")
+            self.assertIn("items_total 1", body.splitlines())
+        finally:
+            server.close()
+
+
+def _create_tree(path: str) -> None:
+    for idx in range(20):
+        directory = os.path.join(path, *[f"dir{depth}" for depth in range(idx % 5)], f"sub{idx}")
+        os.makedirs(directory, exist_ok=True)
+        for file_idx in range(10):
+            with open(os.path.join(directory, f"file{file_idx}"), "w") as f:
+                f.write("content")
+    os.symlink("/", os.path.join(path, "root_link"))  # must not be followed
+
+
+class DeletionTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_parallel_rmtree(self) -> None:
+        path = os.path.join(self.tempdir.name, "tree")
+        _create_tree(path)
+        # Directories without write permission are handled.
+        os.chmod(os.path.join(path, "sub0"), stat.S_IRUSR | stat.S_IXUSR)
+        self.assertEqual([], ghcc.utils.parallel_rmtree(path, num_threads=4))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([], ghcc.utils.parallel_rmtree(path))
+
+    def test_deletion_queue(self) -> None:
+        trash_folder = os.path.join(self.tempdir.name, "trash")
+        queue = ghcc.utils.DeletionQueue(trash_folder, num_threads=4, max_backlog=2, poll_interval=0.01)
+        paths = [os.path.join(self.tempdir.name, f"tree{idx}") for idx in range(4)]
+        for path in paths:
+            _create_tree(path)
+        # Trees are moved into the trash until the backlog is full, then deleted synchronously.
+        for path in paths:
+            pickle.loads(pickle.dumps(queue)).delete(path)
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(2, queue.backlog())
+
+        _create_tree(paths[0])
+        queue.clear(self.tempdir.name)
+        self.assertEqual(["trash"], os.listdir(self.tempdir.name))
+        queue.start()
+        queue.close()
+        self.assertEqual(0, queue.backlog())
+
+
+class JobTokenPoolTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_acquire(self) -> None:
+        pool_folder = os.path.join(self.tempdir.name, "jobs")
+        pool = ghcc.utils.JobTokenPool(pool_folder, num_tokens=5, max_jobs=4)
+        # Other processes open the existing pool.
+        other_pool = pickle.loads(pickle.dumps(ghcc.utils.JobTokenPool(pool_folder, max_jobs=8)))
+        with pool.acquire() as num_tokens:
+            self.assertEqual(3, num_tokens)
+            with other_pool.acquire() as other_tokens:
+                self.assertEqual(2, other_tokens)
+                with pool.acquire() as remaining_tokens:
+                    self.assertEqual(0, remaining_tokens)
+        # Tokens are returned to the pool.
+        with other_pool.acquire() as num_tokens:
+            self.assertEqual(5, num_tokens)
+        with pool.acquire(0) as num_tokens:
+            self.assertEqual(0, num_tokens)
+
+        # Recreating the pool resets the number of tokens.
+        pool = ghcc.utils.JobTokenPool(pool_folder, num_tokens=2, max_jobs=4)
+        with pool.acquire() as num_tokens:
+            self.assertEqual(2, num_tokens)